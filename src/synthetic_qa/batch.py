@@ -0,0 +1,343 @@
+"""
+Batch-prediction job mode for bulk LLM stages.
+
+Requests are written to a JSONL job file (one {"key", "request"} object per line),
+submitted as a job (several when they exceed the executor's job size limit), polled
+until done, and the results are joined back by key. Offline cohort runs trade latency for throughput and stay out of the
+per-request rate limits. Cached requests are answered locally and never submitted.
+
+Executors:
+    LocalBatchExecutor  - file-based stand-in that processes the job in a background
+                          thread (canned mock responses by default, or any callable)
+    GeminiBatchExecutor - Gemini Batch API (batchGenerateContent with inlined requests)
+
+LLM_BATCH_EXECUTOR selects the default executor (gemini | local). The Gemini executor
+fails if GEMINI_BATCH_URL is not set; the local one has to be chosen explicitly, and its
+(mock) results are never written to the response cache.
+"""
+# default
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+import concurrent.futures
+
+# custom
+import telemetry
+from utils import (check_cache, cacheable, join_response_chunks, update_response_metadata, record_response,
+                   post_with_retry, get_with_retry, retry_policy, LLMRequestError, CircuitOpenError,
+                   headers as api_headers)
+
+BATCH_EXECUTOR = os.environ.get('LLM_BATCH_EXECUTOR', 'gemini') # gemini | local (mock responses, for tests)
+BATCH_URL = os.environ.get('GEMINI_BATCH_URL', '') # .../models/<model>:batchGenerateContent
+BATCH_POLL_SECONDS = float(os.environ.get('LLM_BATCH_POLL_SECONDS', 30))
+BATCH_TIMEOUT = float(os.environ.get('LLM_BATCH_TIMEOUT', 24 * 3600)) # Gemini batch SLO is 24h
+BATCH_MAX_BYTES = int(os.environ.get('LLM_BATCH_MAX_BYTES', 18 * 1024 * 1024)) # inlined requests per job, the API takes ~20MB
+
+PENDING, RUNNING, SUCCEEDED, FAILED = "PENDING", "RUNNING", "SUCCEEDED", "FAILED"
+
+
+class BatchJobError(RuntimeError):
+    """Raised when a batch job does not finish in time"""
+
+
+class BatchItemError(RuntimeError):
+    """Stored in place of the response text for a request the batch job could not answer"""
+
+
+def write_job_file(path, requests):
+    """
+    Write {key: messages} as a JSONL job file
+    """
+    with open(path, "w") as ofile:
+        for key, messages in requests.items():
+            ofile.write(json.dumps({"key": key, "request": messages}) + "\n")
+    return path
+
+
+def split_jobs(requests, max_bytes=None):
+    """
+    Split {key: messages} into jobs whose serialized requests stay under `max_bytes`
+    (a request that is larger on its own gets a job to itself)
+    """
+    if not max_bytes:
+        return [requests]
+    jobs, job, size = [], {}, 0
+    for key, messages in requests.items():
+        request_bytes = len(json.dumps({"request": messages, "metadata": {"key": key}}).encode())
+        if job and size + request_bytes > max_bytes:
+            jobs.append(job)
+            job, size = {}, 0
+        job[key] = messages
+        size += request_bytes
+    if job:
+        jobs.append(job)
+    return jobs
+
+
+def read_jsonl(path):
+    with open(path) as ifile:
+        for line in ifile:
+            if line.strip():
+                yield json.loads(line)
+
+
+class LocalBatchExecutor:
+    """
+    File-based batch executor for tests and offline runs.
+
+    Each job gets a directory with input.jsonl, output.jsonl and status.json. Requests
+    are answered by `respond(messages) -> GenerateContentResponse` (canned mock
+    responses by default; wrap utils.get_question to run a real job synchronously).
+    """
+
+    poll_interval = 0.2
+    max_job_bytes = None # no size limit on a local job
+    cache_results = False # answers may be canned mock responses, keep them out of the response cache
+
+    def __init__(self, workdir=None, respond=None, max_workers=8):
+        self.workdir = workdir or tempfile.mkdtemp(prefix="batch_jobs_")
+        if respond is None:
+            from mock_server import canned_response
+            respond = canned_response
+        self.respond = respond
+        self.max_workers = max_workers
+
+    def _job_dir(self, job_id):
+        return os.path.join(self.workdir, job_id)
+
+    def _set_status(self, job_id, state, **extra):
+        path = os.path.join(self._job_dir(job_id), "status.json")
+        with open(f"{path}.tmp", "w") as ofile:
+            json.dump({"state": state, **extra}, ofile)
+        os.replace(f"{path}.tmp", path)
+
+    def submit(self, input_path, display_name=""):
+        job_id = f"{display_name or 'job'}-{uuid.uuid4().hex[:12]}"
+        os.makedirs(self._job_dir(job_id))
+        self._set_status(job_id, PENDING)
+        threading.Thread(target=self._run, args=(job_id, input_path), daemon=True).start()
+        return job_id
+
+    def _answer(self, line):
+        try:
+            return {"key": line["key"], "response": self.respond(line["request"])}
+        except Exception as e:
+            return {"key": line["key"], "error": {"message": f"{type(e).__name__}: {e}"}}
+
+    def _run(self, job_id, input_path):
+        self._set_status(job_id, RUNNING)
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                results = executor.map(self._answer, read_jsonl(input_path))
+                with open(os.path.join(self._job_dir(job_id), "output.jsonl"), "w") as ofile:
+                    for result in results:
+                        ofile.write(json.dumps(result) + "\n")
+        except Exception as e:
+            self._set_status(job_id, FAILED, error=str(e))
+            return
+        self._set_status(job_id, SUCCEEDED)
+
+    def status(self, job_id):
+        with open(os.path.join(self._job_dir(job_id), "status.json")) as ifile:
+            return json.load(ifile)["state"]
+
+    def results(self, job_id):
+        return os.path.join(self._job_dir(job_id), "output.jsonl")
+
+
+class GeminiBatchExecutor:
+    """
+    Gemini Batch API executor. Requests are inlined in the create call (run_batch keeps
+    each job under max_job_bytes), the returned long-running operation is polled, and
+    the inlined responses are written back out as JSONL.
+    """
+
+    poll_interval = BATCH_POLL_SECONDS
+    max_job_bytes = BATCH_MAX_BYTES
+    cache_results = True
+
+    STATES = {
+        "BATCH_STATE_PENDING": PENDING,
+        "BATCH_STATE_RUNNING": RUNNING,
+        "BATCH_STATE_SUCCEEDED": SUCCEEDED,
+        "BATCH_STATE_FAILED": FAILED,
+        "BATCH_STATE_CANCELLED": FAILED,
+        "BATCH_STATE_EXPIRED": FAILED,
+    }
+
+    def __init__(self, batch_url=BATCH_URL, request_headers=None, workdir=None):
+        if not batch_url:
+            raise ValueError("GEMINI_BATCH_URL is not set")
+        self.batch_url = batch_url
+        self.base_url = batch_url.split("/models/")[0]
+        self.headers = request_headers or api_headers
+        self.workdir = workdir or tempfile.mkdtemp(prefix="batch_jobs_")
+
+    def submit(self, input_path, display_name=""):
+        payload = {"batch": {
+            "display_name": display_name or "synthetic_qa",
+            "input_config": {"requests": {"requests": [
+                {"request": line["request"], "metadata": {"key": line["key"]}}
+                for line in read_jsonl(input_path)
+            ]}},
+        }}
+        response = post_with_retry(self.batch_url, self.headers, json.dumps(payload), stage="batch")
+        return response.json()["name"]
+
+    def _operation(self, job_id):
+        return get_with_retry(f"{self.base_url}/{job_id}", self.headers, stage="batch")
+
+    def status(self, job_id):
+        operation = self._operation(job_id)
+        if operation.get("error"):
+            return FAILED
+        return self.STATES.get(operation.get("metadata", {}).get("state"), RUNNING)
+
+    def results(self, job_id):
+        operation = self._operation(job_id)
+        inlined = operation.get("response", {}).get("inlinedResponses", {}).get("inlinedResponses", [])
+        path = os.path.join(self.workdir, f"{job_id.replace('/', '_')}.jsonl")
+        with open(path, "w") as ofile:
+            for item in inlined:
+                result = {"key": item.get("metadata", {}).get("key")}
+                if "error" in item:
+                    result["error"] = item["error"]
+                else:
+                    result["response"] = item["response"]
+                ofile.write(json.dumps(result) + "\n")
+        return path
+
+
+def get_executor():
+    """
+    Default executor selected by LLM_BATCH_EXECUTOR
+    """
+    if BATCH_EXECUTOR == "local":
+        return LocalBatchExecutor()
+    if BATCH_EXECUTOR != "gemini":
+        raise ValueError(f"Unknown LLM_BATCH_EXECUTOR {BATCH_EXECUTOR!r} (gemini | local)")
+    return GeminiBatchExecutor()
+
+
+def is_transient(error):
+    """
+    Whether a failed status check is worth polling again: network errors, an open circuit
+    and retryable statuses are; a fatal status (unknown job, bad credentials) is not
+    """
+    if isinstance(error, LLMRequestError):
+        return error.status is None or retry_policy.is_retryable(error.status)
+    return isinstance(error, (CircuitOpenError, OSError))
+
+
+def wait_for_job(executor, job_id, poll_interval, timeout=BATCH_TIMEOUT):
+    """
+    Poll a job until it succeeds or fails; a status check that fails transiently is
+    logged and retried on the next poll instead of giving up on the job
+    """
+    start = time.monotonic()
+    while True:
+        try:
+            state = executor.status(job_id)
+        except Exception as e:
+            if not is_transient(e):
+                raise
+            logging.warning(f"Status check of batch job {job_id} failed, polling again: {type(e).__name__}: {e}")
+        else:
+            if state in (SUCCEEDED, FAILED):
+                return state
+        if time.monotonic() - start > timeout:
+            raise BatchJobError(f"Batch job {job_id} did not finish within {timeout}s")
+        time.sleep(poll_interval)
+
+
+def run_batch(requests, stage="default", family=None, executor=None, workdir=None,
+              poll_interval=None, timeout=BATCH_TIMEOUT):
+    """
+    Answer many independent requests with batch jobs (one, unless the requests exceed
+    the executor's max_job_bytes).
+
+    Args:
+        requests (dict): request key -> messages payload (as built for get_question)
+        stage (str): pipeline stage, used for the job name and telemetry
+        family (str or dict): response family of the requests (or request key -> family);
+            responses that do not parse against it are not cached
+        poll_interval (float): seconds between status checks, defaults to the executor's
+
+    Returns:
+        dict of key -> response text, or a BatchItemError for requests that failed
+    """
+    results = {}
+    pending = {}
+    for key, messages in requests.items():
+        cache, cache_key, cached = check_cache(messages)
+        if cached is not None:
+            results[key] = cached
+        else:
+            pending[key] = (messages, cache, cache_key)
+    if not pending:
+        return results
+
+    executor = executor or get_executor()
+    workdir = workdir or tempfile.mkdtemp(prefix=f"batch_{stage}_")
+    waited = time.monotonic()
+    jobs = []
+    for n, job in enumerate(split_jobs({key: messages for key, (messages, _, _) in pending.items()},
+                                       getattr(executor, "max_job_bytes", None))):
+        input_path = write_job_file(os.path.join(workdir, f"input_{n}.jsonl"), job)
+        jobs.append((executor.submit(input_path, display_name=stage), job))
+
+    for job_id, job in jobs:
+        if wait_for_job(executor, job_id, poll_interval or executor.poll_interval, timeout) != SUCCEEDED:
+            # the requests of the other jobs are still answered
+            logging.error(f"Batch job {job_id} failed ({len(job)} requests)")
+            for key in job:
+                results[key] = BatchItemError(f"Batch job {job_id} failed")
+            continue
+        # the wall time this job added is spread over its requests, so that the stage's
+        # busy time in telemetry counts it once instead of once per request
+        done = time.monotonic()
+        latency = (done - waited) / len(job)
+        waited = done
+
+        for line in read_jsonl(executor.results(job_id)):
+            key = line.get("key")
+            if key not in pending:
+                continue
+            messages, cache, cache_key = pending[key]
+            if "error" in line:
+                results[key] = BatchItemError(str(line["error"]))
+                continue
+            meta = {}
+            try:
+                content = join_response_chunks([line["response"]])
+                update_response_metadata(meta, line["response"])
+            except Exception as e:
+                # e.g. no candidates when the prompt was blocked; only this request fails
+                results[key] = BatchItemError(f"Unusable response for request {key}: {type(e).__name__}: {e}")
+                continue
+            record = {
+                "timestamp": time.time(),
+                "stage": stage,
+                "patient_id": telemetry.current_patient.get(),
+                "prompt_chars": len(json.dumps(messages)),
+                "attempts": 1,
+                "cache_hit": False,
+                "error": None,
+                "latency": latency,
+                "batch": True,
+            }
+            record_response(record, content, meta)
+            telemetry.emit(record)
+            key_family = family.get(key) if isinstance(family, dict) else family
+            if (cache is not None and getattr(executor, "cache_results", False)
+                    and cacheable(content, meta.get("finish_reason"), key_family)):
+                cache.put(cache_key, content)
+            results[key] = content
+
+    for key in pending:
+        results.setdefault(key, BatchItemError(f"No result for request {key}"))
+    return results
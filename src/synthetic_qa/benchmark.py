@@ -0,0 +1,341 @@
+"""
+End-to-end benchmark of the phase-1 pipeline stages against the local mock server.
+
+For each corpus size a synthetic patient chart is generated and pushed through
+format_records/load_notes, chunk_note, extract_facts_from_notes, deduplicate_facts,
+run_parallel_parts, extract_topics_from_notes and filter_questions. Every stage
+reports wall-clock time, throughput, peak RSS, LLM calls and HTTP requests. Results
+can be saved as a baseline and later runs compared against it.
+
+Example usage:
+    python benchmark.py --notes 10,200,2000 --latency lognormal:-1.0,0.5 --output bench.json
+    python benchmark.py --notes 2000 --baseline bench.json --fail-on-regression
+"""
+# default
+import argparse
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+# benchmark runs offline and must never replay cached responses; the client-side
+# rate limiter is off unless LLM_RATE_LIMIT_RPM is set explicitly
+os.environ.setdefault('SECURE_GPT_KEY', 'benchmark')
+os.environ.setdefault('LLM_RATE_LIMIT_RPM', '0')
+os.environ['LLM_CACHE_MODE'] = 'off'
+
+# pip
+import pandas as pd
+
+# custom
+import utils
+import telemetry
+from mock_server import start_mock_server
+from format_data import format_records
+from extract_facts import chunk_note, extract_facts_from_notes, deduplicate_facts, CHUNK_SIZE, PATTERN
+from generate_questions import run_parallel_parts
+from sample_questions import extract_topics_from_notes
+from filter_questions import filter_questions
+
+CONDITIONS = ["hypertension", "type 2 diabetes", "atrial fibrillation", "chronic kidney disease",
+              "asthma", "heart failure", "hyperlipidemia", "hypothyroidism", "anemia", "COPD"]
+MEDICATIONS = ["metformin", "lisinopril", "apixaban", "atorvastatin", "levothyroxine",
+               "albuterol", "furosemide", "insulin glargine", "amlodipine", "metoprolol"]
+PROCEDURES = ["echocardiogram", "colonoscopy", "chest x-ray", "CT abdomen", "cardiac catheterization",
+              "renal ultrasound", "MRI brain", "pulmonary function test"]
+TITLES = ["progress notes", "telephone encounter", "discharge summary", "consults", "ed provider notes"]
+MIN_WALL_DELTA = 0.05 # seconds; smaller wall-clock increases are not reported as regressions
+
+
+def make_sentence(rng, note_date):
+    kind = rng.randrange(4)
+    if kind == 0:
+        return f"Patient has a history of {rng.choice(CONDITIONS)}."
+    if kind == 1:
+        return f"Patient takes {rng.choice(MEDICATIONS)} {rng.choice([5, 10, 20, 40, 500])} mg daily."
+    if kind == 2:
+        event = (note_date - pd.Timedelta(days=rng.randrange(0, 900))).date()
+        return f"Patient underwent {rng.choice(PROCEDURES)} on {event} with unremarkable findings."
+    return f"Blood pressure was {rng.randrange(100, 170)}/{rng.randrange(60, 100)} at this visit."
+
+
+def make_corpus(n_notes, note_chars=3000, seed=42):
+    """
+    Synthetic chart with n_notes notes over two years. Long notes and copy-forward
+    repeats are mixed in so chunking and deduplication see realistic inputs.
+
+    Returns:
+        DataFrame shaped like format_data output, with the H&P note as row 0
+    """
+    rng = random.Random(seed)
+    end = pd.Timestamp("2024-06-01")
+    rows = [{"note_date": str(end), "note_title": "h&p", "text": "H&P. " + make_sentence(rng, end)}]
+    carried = []
+    for _ in range(n_notes):
+        note_date = end - pd.Timedelta(minutes=rng.randrange(0, 2 * 365 * 24 * 60))
+        length = int(rng.lognormvariate(0, 0.8) * note_chars)
+        sentences = list(carried[:rng.randrange(0, 6)]) # copy-forward
+        while sum(len(s) + 1 for s in sentences) < length:
+            sentences.append(make_sentence(rng, note_date))
+        carried = sentences[-8:]
+        rows.append({"note_date": str(note_date), "note_title": rng.choice(TITLES), "text": " ".join(sentences)})
+    return pd.DataFrame(rows)
+
+
+class RssSampler:
+    """
+    Track the peak resident set size while a stage runs by polling /proc/self/statm
+    (falls back to the process high-water mark where /proc is unavailable)
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def current_rss():
+        try:
+            with open("/proc/self/statm") as ifile:
+                return int(ifile.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError):
+            scale = 1 if sys.platform == "darwin" else 1024
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self.current_rss())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.start = self.peak = self.current_rss()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.current_rss())
+
+
+def mock_requests(stats_url):
+    import requests
+    return requests.get(stats_url, timeout=10).json()["requests"]
+
+
+def run_stage(name, func, stats_url, results):
+    """
+    Run one stage and record wall time, throughput, peak RSS and LLM traffic.
+    `func` returns (number of items processed, value passed to later stages).
+    """
+    calls_before = telemetry.call_count()
+    requests_before = mock_requests(stats_url)
+    with RssSampler() as rss:
+        start = time.perf_counter()
+        n_items, value = func()
+        wall = time.perf_counter() - start
+    results[name] = {
+        "items": n_items,
+        "wall_s": round(wall, 4),
+        "items_per_s": round(n_items / wall, 2) if wall > 0 else None,
+        "peak_rss_mb": round(rss.peak / 1024 ** 2, 1),
+        "rss_growth_mb": round((rss.peak - rss.start) / 1024 ** 2, 1),
+        "llm_calls": telemetry.call_count() - calls_before,
+        "http_requests": mock_requests(stats_url) - requests_before,
+    }
+    return value
+
+
+def benchmark_corpus(n_notes, args, stats_url):
+    """
+    Push one synthetic chart through every stage
+    """
+    results = {}
+    workdir = tempfile.mkdtemp(prefix="bench_")
+    df = make_corpus(n_notes, note_chars=args.note_chars, seed=args.seed)
+    telemetry.current_patient.set(f"bench-{n_notes}")
+
+    def load():
+        format_records(df, "bench", workdir, 0)
+        notes = utils.load_notes(f"{workdir}/bench_subsetrecords.json")
+        return len(notes), notes
+    notes_df = run_stage("load_notes", load, stats_url, results)
+
+    def chunk():
+        chunks = [c for text in notes_df["text"] for c in chunk_note(text, CHUNK_SIZE)]
+        return len(chunks), None
+    run_stage("chunk_note", chunk, stats_url, results)
+
+    def extract():
+        _, facts = extract_facts_from_notes(notes_df, chunk_size=CHUNK_SIZE, pattern=PATTERN)
+        return len(notes_df), facts
+    facts = run_stage("extract_facts", extract, stats_url, results)
+
+    def extract_stream():
+        # notes are read from the file as the bounded submission window frees up
+        notes = utils.iter_notes(f"{workdir}/bench_subsetrecords.json")
+        _, facts = extract_facts_from_notes(notes, chunk_size=CHUNK_SIZE, pattern=PATTERN)
+        return len(notes_df), facts
+    run_stage("extract_facts_stream", extract_stream, stats_url, results)
+
+    def dedup():
+        deduped, _ = deduplicate_facts(facts)
+        return len(facts), deduped
+    deduped = run_stage("deduplicate_facts", dedup, stats_url, results)
+
+    hp = {"reference_timestamp": df.iloc[0]["note_date"], "note_title": "h&p", "text": df.iloc[0]["text"]}
+    def generate():
+        questions = run_parallel_parts(deduped, hp)
+        return len(questions), pd.DataFrame(questions)
+    questions = run_stage("run_parallel_parts", generate, stats_url, results)
+
+    questions["person_id"] = 0
+    def topics():
+        return len(questions), extract_topics_from_notes(questions)
+    run_stage("extract_topics", topics, stats_url, results)
+
+    to_filter = questions.assign(reason_for_admission="", clinical_summary="", visit_type="inpatient", note=hp["text"])
+    to_filter = to_filter[["question", "answer", "reference_timestamp", "reason_for_admission",
+                           "clinical_summary", "visit_type", "note"]]
+    def filter_stage():
+        return len(to_filter), filter_questions(to_filter)
+    run_stage("filter_questions", filter_stage, stats_url, results)
+
+    results["_corpus"] = {"notes": n_notes, "raw_facts": len(facts), "deduped_facts": len(deduped)}
+    return results
+
+
+def compare(current, baseline, tolerance):
+    """
+    Print per-stage deltas against a baseline.
+
+    Returns:
+        list of (corpus, stage, metric, baseline, current) regressions beyond tolerance
+    """
+    regressions = []
+    for corpus, stages in current.items():
+        if corpus not in baseline:
+            continue
+        print(f"\n== {corpus} notes vs baseline ==")
+        for stage, metrics in stages.items():
+            base = baseline[corpus].get(stage)
+            if stage.startswith("_") or base is None:
+                continue
+            for metric in ("wall_s", "peak_rss_mb", "rss_growth_mb", "llm_calls"):
+                old, new = base.get(metric), metrics.get(metric)
+                if not old or new is None:
+                    continue
+                # ignore timer noise on stages that take a few milliseconds
+                if metric == "wall_s" and new - old < MIN_WALL_DELTA:
+                    continue
+                delta = (new - old) / old
+                flag = " REGRESSION" if delta > tolerance else ""
+                print(f"{stage:<20}{metric:<14}{old:>12}{new:>12}{delta:>+9.1%}{flag}")
+                if flag:
+                    regressions.append((corpus, stage, metric, old, new))
+    return regressions
+
+
+def print_results(results):
+    for corpus, stages in results.items():
+        print(f"\n== {corpus} notes: {stages['_corpus']} ==")
+        print(f"{'stage':<22}{'items':>8}{'wall_s':>10}{'items/s':>10}{'rss_mb':>9}{'+rss_mb':>9}{'llm':>7}{'http':>7}")
+        for stage, m in stages.items():
+            if stage.startswith("_"):
+                continue
+            print(f"{stage:<22}{m['items']:>8}{m['wall_s']:>10.3f}{m['items_per_s'] or 0:>10.1f}"
+                  f"{m['peak_rss_mb']:>9.1f}{m.get('rss_growth_mb', 0):>9.1f}{m['llm_calls']:>7}{m['http_requests']:>7}")
+
+
+def parse_args():
+    """
+    Description: Parse the arguments
+    Example usage: python benchmark.py --notes 10,200,2000 --output bench.json
+
+    """
+    parser = argparse.ArgumentParser(description="Pipeline benchmark")
+    parser.add_argument('-n',
+                        '--notes',
+                        type=str,
+                        help="Corpus sizes (notes per patient), separated by commas",
+                        default="10,100")
+    parser.add_argument('--note-chars',
+                        type=int,
+                        help="Median note length in characters",
+                        default=3000)
+    parser.add_argument('-l',
+                        '--latency',
+                        type=str,
+                        help="Mock time-to-first-token distribution (see mock_server.py)",
+                        default="lognormal:-2.0,0.5")
+    parser.add_argument('--token-latency',
+                        type=float,
+                        help="Mock seconds per output token",
+                        default=0.0)
+    parser.add_argument('--rate-429',
+                        type=float,
+                        default=0.0)
+    parser.add_argument('--rate-5xx',
+                        type=float,
+                        default=0.0)
+    parser.add_argument('--seed',
+                        type=int,
+                        default=42)
+    parser.add_argument('-o',
+                        '--output',
+                        type=str,
+                        help="Write results (usable as a baseline) to this JSON file",
+                        default="")
+    parser.add_argument('-b',
+                        '--baseline',
+                        type=str,
+                        help="Compare against a previous --output file",
+                        default="")
+    parser.add_argument('--tolerance',
+                        type=float,
+                        help="Relative increase counted as a regression",
+                        default=0.10)
+    parser.add_argument('--fail-on-regression',
+                        action='store_true')
+    return parser.parse_args()
+
+
+def main(args):
+    server, url = start_mock_server(latency=args.latency,
+                                    token_latency=args.token_latency,
+                                    rate_429=args.rate_429,
+                                    rate_5xx=args.rate_5xx,
+                                    retry_after=0.1,
+                                    seed=args.seed)
+    utils.url = url
+    stats_url = url.rsplit("/", 1)[0] + "/stats"
+
+    results = {}
+    for n_notes in [int(n) for n in args.notes.split(',')]:
+        results[str(n_notes)] = benchmark_corpus(n_notes, args, stats_url)
+    server.shutdown()
+
+    print_results(results)
+    print()
+    telemetry.report()
+
+    if args.output:
+        with open(args.output, 'w') as ofile:
+            json.dump(results, ofile, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as ifile:
+            regressions = compare(results, json.load(ifile), args.tolerance)
+        if regressions and args.fail_on_regression:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args)
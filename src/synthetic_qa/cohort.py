@@ -0,0 +1,105 @@
+"""
+Cohort scheduler: runs the per-patient work of many patients at once.
+
+Patients are started on a small pool (at most `max_patients` in progress, which bounds
+how many note tables and fact lists are held in memory) while their LLM tasks (note
+chunks, dedup batches, question generation) all go to one shared worker pool. A patient
+with a handful of notes no longer leaves most workers idle, and the tail of one patient
+overlaps the next.
+
+Each patient logs to its own file through a handler that only accepts records emitted
+in that patient's context (telemetry.current_patient, which ContextThreadPoolExecutor
+and asyncio tasks carry into the workers), so concurrent patients do not share a log.
+"""
+# default
+import concurrent.futures
+import logging
+import os
+from contextlib import contextmanager
+
+# pip
+import tqdm
+
+# custom
+import telemetry
+from utils import ContextThreadPoolExecutor, SharedWorkerPool, shared_pool
+
+COHORT_PATIENTS = int(os.environ.get('LLM_COHORT_PATIENTS', 4)) # patients in progress at once
+COHORT_WORKERS = int(os.environ.get('LLM_COHORT_WORKERS', 32)) # shared LLM worker threads
+LOG_FORMAT = '[%(asctime)s]\t%(message)s'
+
+
+class PatientFilter(logging.Filter):
+    """
+    Accept only records logged while working on `patient_id`
+    """
+
+    def __init__(self, patient_id):
+        super().__init__()
+        self.patient_id = patient_id
+
+    def filter(self, record):
+        return telemetry.current_patient.get() == self.patient_id
+
+
+@contextmanager
+def patient_log(path, patient_id):
+    """
+    Log everything done for `patient_id` inside the block to `path` (truncated first)
+    """
+    handler = logging.FileHandler(path, mode="w")
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    handler.addFilter(PatientFilter(patient_id))
+    root_logger = logging.getLogger()
+    if root_logger.getEffectiveLevel() > logging.INFO:
+        root_logger.setLevel(logging.INFO)
+    logging.getLogger("LiteLLM").setLevel(logging.CRITICAL + 1)
+    logging.getLogger("httpx").setLevel(logging.WARNING + 1)
+    root_logger.addHandler(handler)
+    try:
+        yield handler
+    finally:
+        root_logger.removeHandler(handler)
+        handler.close()
+
+
+def run_patient(id, process_patient):
+    with telemetry.patient_context(id):
+        try:
+            return process_patient(id)
+        except Exception:
+            logging.exception(f"Processing {id} failed")
+            raise
+
+
+def run_cohort(id_list, process_patient, max_patients=COHORT_PATIENTS,
+               max_workers=COHORT_WORKERS, on_complete=None):
+    """
+    Run `process_patient(id)` for every patient, up to `max_patients` at a time, with all
+    of their fan-outs (utils.worker_pool) sharing one pool of `max_workers` threads.
+
+    Args:
+        on_complete (callable): called as on_complete(id, result) as each patient finishes;
+            result is the exception for a patient that failed
+
+    Returns:
+        dict of id -> result of process_patient, or the exception it raised
+    """
+    results = {}
+    with SharedWorkerPool(max_workers=max_workers) as pool:
+        token = shared_pool.set(pool)
+        try:
+            with ContextThreadPoolExecutor(max_workers=max_patients) as patients:
+                futures = {patients.submit(run_patient, id, process_patient): id for id in id_list}
+                for future in tqdm.tqdm(concurrent.futures.as_completed(futures), total=len(futures)):
+                    id = futures[future]
+                    try:
+                        results[id] = future.result()
+                    except Exception as e:
+                        tqdm.tqdm.write(f"{id} failed: {type(e).__name__}: {e}")
+                        results[id] = e
+                    if on_complete is not None:
+                        on_complete(id, results[id])
+        finally:
+            shared_pool.reset(token)
+    return {id: results[id] for id in id_list}
@@ -4,12 +4,16 @@ import os
 import re
 import random
 
+import asyncio
 import logging
-import tqdm
+import functools
 import json
 import concurrent.futures
+import zlib
+from collections import Counter
 
 # pip
+import numpy as np
 import pandas as pd
 
 
@@ -18,192 +22,1042 @@ PATTERN = r"\(\d{4}-\d{2}-\d{2}\)$"
 BATCH_SIZE = 500 # batch size to find duplicate facts
 CHUNK_SIZE= 20000 # amount to chunk notes by
 MAX_WORKERS=12 # number of threads to run
+SHINGLE_SIZE = 4 # character n-grams hashed into MinHash signatures
+MINHASH_PERM = 64 # signature length
+LSH_BANDS = 16 # bands x rows = MINHASH_PERM, candidates above ~(1/bands)^(1/rows) = 0.5 Jaccard
+LSH_THRESHOLD = 0.5 # estimated Jaccard a band collision must reach to join a cluster
+MINHASH_PRIME = (1 << 31) - 1
+DEDUP_NEIGHBORS = 8 # nearest neighbours per fact that should be compared by the LLM
+NEIGHBOR_MIN_SIM = 0.5 # cosine similarity below which a neighbour is not a candidate pair
+COVERAGE_TARGET = 0.95 # stop cross-batch passes once this share of candidate pairs has been compared
+NEIGHBOR_BLOCK_ELEMENTS = 1 << 22 # similarities computed at once in the neighbour search (16MB of float32)
+DEDUP_INPUT_TOKENS = int(os.environ.get('LLM_DEDUP_INPUT_TOKENS', 16000)) # target prompt size per dedup call
+DEDUP_OUTPUT_TOKENS = int(os.environ.get('LLM_DEDUP_OUTPUT_TOKENS', 4000)) # target response size per dedup call
+DEDUP_OUTPUT_PER_FACT = 3 # response tokens per fact if every fact were redundant
+FACT_OVERHEAD_TOKENS = 4 # JSON index key and quoting per fact
+EXTRACT_INPUT_TOKENS = int(os.environ.get('LLM_EXTRACT_INPUT_TOKENS', 5000)) # target note tokens per extraction call
+EXTRACT_OUTPUT_TOKENS = int(os.environ.get('LLM_EXTRACT_OUTPUT_TOKENS', 16000)) # target response size per extraction call
+EXTRACT_OUTPUT_RATIO = 1.0 # response tokens per note token (claims restate the note with dates)
+MIN_SPLIT_CHARS = 500 # do not split chunks below this size after a failed call
+CHUNK_OVERLAP = 200 # characters of trailing sentences repeated at the start of the next chunk
+PACK_MAX_NOTES = 20 # short notes packed into one extraction request
+PACK_NOTE_OVERHEAD = 64 # characters of JSON around each packed note
+SECTION_PATTERN = re.compile(r"\n[ \t]*\n|\n(?=[A-Z][A-Za-z /&()-]{1,40}:)") # blank line or "Heading:" line
+SENTENCE_PATTERN = re.compile(r"(?<=[.!?])\s+")
 
 
 # custom
-from prompts.extract_facts import EXTRACT_SYS, DEDUP_SYS, format_extract, format_dedup
-from utils import load_notes, send_single_message
+from prompts.extract_facts import EXTRACT_SYS, EXTRACT_NOTES_SYS, DEDUP_SYS, format_extract, format_extract_notes, format_dedup
+from utils import load_notes, send_structured_message, async_send_structured_message, gather_with_limit, run_async, worker_pool, build_single_message
+from utils import estimate_tokens, AdaptiveSizer, TruncatedResponseError, ASYNC_CONCURRENCY
+from batch import run_batch
+from structured import parse_response, MalformedResponseError
+from journal import ChunkJournal, chunk_key
+from manifest import NoteManifest, note_keys
+from fact_store import store_path, load_facts, write_facts, facts_frame, concat, mark_status, is_deduplicated, kept_facts
+from cohort import run_cohort, patient_log, COHORT_PATIENTS
+import telemetry
 
 # setting the seed
 random.seed(42)
 
-def apply_facts_module(note_date, text):
+# shared across patients, shrink after truncated/unparsable responses
+DEDUP_SIZER = AdaptiveSizer("dedup", DEDUP_INPUT_TOKENS, DEDUP_OUTPUT_TOKENS)
+EXTRACT_SIZER = AdaptiveSizer("extract", EXTRACT_INPUT_TOKENS, EXTRACT_OUTPUT_TOKENS)
+
+def apply_facts_module(note_date, text, on_claim=None):
     """
-    Extract list of atomic facts from the note
+    Extract list of atomic facts from the note.
+    If `on_claim` is given the response is streamed and each claim is passed to it as soon as it is parsed.
     """
     user_input = format_extract(note_date=note_date,
                                 text=text)
-    response = send_single_message(system_instructions=EXTRACT_SYS,
-                               user_prompt=user_input)
-    return json.loads(response[7:-3])['claims']
+    response = send_structured_message(system_instructions=EXTRACT_SYS,
+                                       user_prompt=user_input,
+                                       family="claims",
+                                       stage="extract",
+                                       on_item=on_claim,
+                                       cache_prefix=True,
+                                       item_key="claims",
+                                       raise_truncated=True)
+    return response['claims']
+
+async def async_apply_facts_module(note_date, text):
+    """
+    Async version of apply_facts_module
+    """
+    user_input = format_extract(note_date=note_date,
+                                text=text)
+    response = await async_send_structured_message(system_instructions=EXTRACT_SYS,
+                                                   user_prompt=user_input,
+                                                   family="claims",
+                                                   stage="extract",
+                                                   cache_prefix=True,
+                                                   raise_truncated=True)
+    return response['claims']
+
+def build_facts_request(note_date, text):
+    """
+    Request payload for apply_facts_module, for batch jobs
+    """
+    return build_single_message(user_prompt=format_extract(note_date=note_date, text=text),
+                                system_instructions=EXTRACT_SYS,
+                                family="claims")
+
+def parse_facts_response(response):
+    return parse_response(response, "claims")['claims']
+
+def apply_notes_facts_module(notes, on_claim=None):
+    """
+    Extract atomic facts from several short notes in one request.
+    `notes` is a list of (note_id, note_date, text); returns {note_id: claims}
+    """
+    user_input = format_extract_notes(notes)
+    response = send_structured_message(system_instructions=EXTRACT_NOTES_SYS,
+                                       user_prompt=user_input,
+                                       family="notes",
+                                       stage="extract",
+                                       on_item=note_claims_callback(on_claim),
+                                       cache_prefix=True,
+                                       item_key="notes",
+                                       raise_truncated=True)
+    return notes_claims(response)
+
+async def async_apply_notes_facts_module(notes):
+    """
+    Async version of apply_notes_facts_module
+    """
+    user_input = format_extract_notes(notes)
+    response = await async_send_structured_message(system_instructions=EXTRACT_NOTES_SYS,
+                                                   user_prompt=user_input,
+                                                   family="notes",
+                                                   stage="extract",
+                                                   cache_prefix=True,
+                                                   raise_truncated=True)
+    return notes_claims(response)
+
+def build_notes_facts_request(notes):
+    """
+    Request payload for apply_notes_facts_module, for batch jobs
+    """
+    return build_single_message(user_prompt=format_extract_notes(notes),
+                                system_instructions=EXTRACT_NOTES_SYS,
+                                family="notes")
+
+def note_claims_callback(on_claim):
+    # streamed items are whole notes, pass on their claims
+    if on_claim is None:
+        return None
+    def on_note(note):
+        for claim in note.get("claims", []):
+            on_claim(claim)
+    return on_note
+
+def notes_claims(response):
+    return {str(note['note_id']): note['claims'] for note in response['notes']}
+
+def parse_notes_facts_response(response):
+    return notes_claims(parse_response(response, "notes"))
 
 def apply_redundancy_module(fact_list):
     """
     Return indices of redundant facts from fact list
     """
     user_input = format_dedup(input_fact_list=fact_list)
-    response = send_single_message(system_instructions=DEDUP_SYS,
-                                    user_prompt=user_input)
-    # extracting JSON in case there is an explanation
-    match = re.search(r"```(.*?)```", response, re.DOTALL)
-    if match:
-        response= match.group(0).strip()
-    return json.loads(response[7:-3])['redundant_fact_indices']
+    response = send_structured_message(system_instructions=DEDUP_SYS,
+                                       user_prompt=user_input,
+                                       family="dedup",
+                                       stage="dedup",
+                                       cache_prefix=True,
+                                       raise_truncated=True)
+    return response['redundant_fact_indices']
     # return [int(i) for i in response if i.isdigit() ]
 
+async def async_apply_redundancy_module(fact_list):
+    """
+    Async version of apply_redundancy_module
+    """
+    user_input = format_dedup(input_fact_list=fact_list)
+    response = await async_send_structured_message(system_instructions=DEDUP_SYS,
+                                                   user_prompt=user_input,
+                                                   family="dedup",
+                                                   stage="dedup",
+                                                   cache_prefix=True,
+                                                   raise_truncated=True)
+    return response['redundant_fact_indices']
 
-def shuffle_with_mapping(original_list):
+def build_redundancy_request(fact_list):
+    """
+    Request payload for apply_redundancy_module, for batch jobs
     """
-    Shuffles a list and returns the shuffled list and a mapping to the original indices.
+    return build_single_message(user_prompt=format_dedup(input_fact_list=fact_list),
+                                system_instructions=DEDUP_SYS,
+                                family="dedup")
 
-    Args:
-        original_list (list): The list to shuffle.
+def parse_redundancy_response(response):
+    # tolerates an explanation around the JSON
+    return parse_response(response, "dedup")['redundant_fact_indices']
+
+
+def tfidf_embeddings(facts_list, dim=64, seed=0, pattern=PATTERN, block=1 << 16):
+    """
+    Dense embeddings of the facts: TF-IDF over words plus a date token, kept as COO
+    arrays and randomly projected to `dim` dimensions, L2-normalized
 
     Returns:
-        tuple: A tuple containing the shuffled list and a list of original indices.
+        np.ndarray (len(facts_list) x dim)
     """
-    n = len(original_list)
-    indices = list(range(n))
-    random.shuffle(indices) # Shuffle the indices, not the list itself
+    vocab = {}
+    rows, cols = [], []
+    for row, fact in enumerate(facts_list):
+        text, date = normalize_fact(fact, pattern)
+        for token in re.findall(r"[a-z0-9]+", text) + [f"date:{date}"]:
+            rows.append(row)
+            cols.append(vocab.setdefault(token, len(vocab)))
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
 
-    # Use the shuffled indices to create the new, shuffled list
-    shuffled_list = [original_list[i] for i in indices]
+    # collapse repeated (row, term) pairs into term frequencies
+    pairs, tf = np.unique(rows * len(vocab) + cols, return_counts=True)
+    rows, cols = pairs // len(vocab), pairs % len(vocab)
+    df = np.bincount(cols, minlength=len(vocab))
+    values = tf * (np.log((1 + len(facts_list)) / (1 + df)) + 1)[cols]
+    values /= np.sqrt(np.bincount(rows, weights=values ** 2, minlength=len(facts_list)))[rows]
 
-    # Create the mapping: `shuffled_index -> original_index`
-    mapping = {new_idx: old_idx for new_idx, old_idx in enumerate(indices)}
-    
-    return shuffled_list, mapping
+    projection = np.random.default_rng(seed).standard_normal((len(vocab), dim)) / np.sqrt(dim)
+    embeddings = np.zeros((len(facts_list), dim))
+    # rows are sorted; project `block` entries at a time so memory stays O(block * dim)
+    for start in range(0, len(rows), block):
+        r, c, v = rows[start:start+block], cols[start:start+block], values[start:start+block]
+        firsts = np.flatnonzero(np.r_[True, r[1:] != r[:-1]])
+        embeddings[r[firsts]] += np.add.reduceat(v[:, None] * projection[c], firsts, axis=0)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.where(norms > 0, norms, 1)
+
+def similarity_blocks(embeddings, batch_size=BATCH_SIZE, power_iter=8):
+    """
+    Split rows into blocks of at most batch_size by recursive median bisection along the
+    principal direction, so that similar rows end up in the same block
+
+    Returns:
+        list of arrays of row positions
+    """
+    blocks = []
+    stack = [np.arange(len(embeddings))]
+    while stack:
+        ids = stack.pop()
+        if len(ids) <= batch_size:
+            blocks.append(ids)
+            continue
+        centered = embeddings[ids] - embeddings[ids].mean(axis=0)
+        # principal direction by power iteration, started deterministically
+        direction = np.ones(embeddings.shape[1])
+        for _ in range(power_iter):
+            direction = centered.T @ (centered @ direction)
+            direction /= np.linalg.norm(direction) or 1
+        order = ids[np.argsort(centered @ direction, kind="stable")]
+        # split on a multiple of batch_size so the blocks stay full
+        half = max(batch_size, int(np.ceil(len(ids) / 2 / batch_size)) * batch_size)
+        stack.extend([order[half:], order[:half]])
+    return blocks
 
-def chunk_facts(facts_list, batch_size=BATCH_SIZE):
+def chunk_facts(facts_list, batch_size=BATCH_SIZE, sizer=None):
     """
     Helper function to batches fact list
+    With a sizer, a batch is also closed once its estimated prompt or response
+    tokens would exceed the sizer's budget
     """
-    
-    return [
-        (i, facts_list[i:i+batch_size])
-        for i in range(0, len(facts_list), batch_size)
-    ]
+    if sizer is None:
+        return [
+            (i, facts_list[i:i+batch_size])
+            for i in range(0, len(facts_list), batch_size)
+        ]
+
+    batches = []
+    start, tokens = 0, 0
+    for i, fact in enumerate(facts_list):
+        fact_tokens = estimate_tokens(fact) + FACT_OVERHEAD_TOKENS
+        size = i - start
+        if size and (size >= batch_size
+                     or not sizer.fits(tokens + fact_tokens, (size + 1) * DEDUP_OUTPUT_PER_FACT)):
+            batches.append((start, facts_list[start:i]))
+            start, tokens = i, 0
+        tokens += fact_tokens
+    if start < len(facts_list):
+        batches.append((start, facts_list[start:]))
+    return batches
     # returns list of (start_index, batch_facts)
 
-def run_within_batch_deduplication(facts_list,  batch_size=BATCH_SIZE, max_workers=MAX_WORKERS):
+def dedup_batch_size(facts_list, batch_size=BATCH_SIZE, sizer=DEDUP_SIZER):
     """
-    Helper function:
-    1. batches shuffled list
-    2. returns duplicate indices
+    Helper function: number of facts per dedup call that fits the sizer's budget,
+    from the average fact length
     """
-    to_remove = set()
-    batches = chunk_facts(facts_list, batch_size)
+    if not facts_list:
+        return batch_size
+    fact_tokens = sum(estimate_tokens(f) for f in facts_list) / len(facts_list) + FACT_OVERHEAD_TOKENS
+    fits = min(sizer.input_budget() / fact_tokens, sizer.output_budget() / DEDUP_OUTPUT_PER_FACT)
+    return max(2, min(batch_size, int(fits)))
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = {
-            executor.submit(
-                apply_redundancy_module,
-                {start_idx + i: fact for i, fact in enumerate(batch)}
-            ): start_idx
-            for start_idx, batch in batches
-        }
+# a response that is cut off or unusable means the call asked for too much; other errors are not retried in halves
+SIZE_ERRORS = (TruncatedResponseError, MalformedResponseError)
 
-        for future in concurrent.futures.as_completed(futures):
-            try:
-                redundant = future.result()
-                to_remove.update(redundant)
-            except Exception as e:
-                logging.info(f"Error in within-batch deduplication: {e}")
-                continue
+def split_batch(batch):
+    items = list(batch.items())
+    return [dict(items[:len(items) // 2]), dict(items[len(items) // 2:])]
 
-    return to_remove
+def find_redundant(batch, sizer=DEDUP_SIZER):
+    """
+    Helper function: apply_redundancy_module, retried on halves of the batch when the
+    response was truncated or unparsable
 
-def run_cross_batch_deduplication(facts_list, keep_indices, batch_size=BATCH_SIZE, max_workers=MAX_WORKERS):
+    Returns:
+        list of (sub-batch that was answered, its redundant indices); pairs across two
+        halves were not compared
     """
-    Helper function
-    1. shuffles the fact list
-    2. batches shuffled list
-    3. returns duplicate indices
+    try:
+        redundant = apply_redundancy_module(batch)
+    except SIZE_ERRORS as e:
+        sizer.record_failure()
+        if len(batch) < 2:
+            raise
+        logging.info(f"Retrying dedup batch of {len(batch)} facts in halves: {e}")
+        return [part for half in split_batch(batch) for part in find_redundant(half, sizer)]
+    sizer.record_success()
+    return [(batch, set(redundant))]
+
+async def async_find_redundant(batch, sizer=DEDUP_SIZER):
     """
-    to_remove = set()
+    Async version of find_redundant
+    """
+    try:
+        redundant = await async_apply_redundancy_module(batch)
+    except SIZE_ERRORS as e:
+        sizer.record_failure()
+        if len(batch) < 2:
+            raise
+        logging.info(f"Retrying dedup batch of {len(batch)} facts in halves: {e}")
+        parts = []
+        for half in split_batch(batch):
+            parts.extend(await async_find_redundant(half, sizer))
+        return parts
+    sizer.record_success()
+    return [(batch, set(redundant))]
 
-    # shuffle the kept facts list
-    keep_facts_shuffled, keep_indices_mapping = shuffle_with_mapping(
-        [facts_list[i] for i in keep_indices]
-    )
-    groups = chunk_facts(keep_facts_shuffled, batch_size)
+def run_dedup_batches(batches, label, max_workers=MAX_WORKERS):
+    """
+    Helper function: send each {index: fact} batch to the redundancy module
+    in parallel
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = {
-            executor.submit(
-                apply_redundancy_module,
-                {start_idx + i: fact for i, fact in enumerate(group)}
-            ): (start_idx, group)
-            for start_idx, group in groups
-        }
+    Returns:
+        per batch, the (sub-batch, redundant indices) answered by find_redundant, None
+        for the batches that failed
+    """
+    results = [None] * len(batches)
+
+    with worker_pool(max_workers) as executor:
+        futures = {executor.submit(find_redundant, batch): pos for pos, batch in enumerate(batches)}
 
         for future in concurrent.futures.as_completed(futures):
             try:
-                redundant = future.result()
-                # ignore indices that are out of bounds
-                global_redundant = [
-                    keep_indices_mapping[i] for i in redundant if i < len(keep_indices)
-                ]
-                to_remove.update(global_redundant)
+                results[futures[future]] = future.result()
             except Exception as e:
-                logging.info(f"Error in cross-batch deduplication: {e}")
+                logging.info(f"Error in {label} deduplication: {e}")
                 continue
 
+    return results
+
+async def async_run_dedup_batches(batches, label):
+    """
+    Async version of run_dedup_batches
+    """
+    results = await gather_with_limit(
+        [async_find_redundant(batch) for batch in batches],
+        return_exceptions=True,
+    )
+    for pos, parts in enumerate(results):
+        if isinstance(parts, Exception):
+            logging.info(f"Error in {label} deduplication: {parts}")
+            results[pos] = None
+    return results
+
+def batch_run_dedup_batches(batches, label):
+    """
+    Batch-job version of run_dedup_batches: all batches go out as one job
+    """
+    results = [None] * len(batches)
+    responses = run_batch({str(i): build_redundancy_request(batch) for i, batch in enumerate(batches)},
+                          stage="dedup", family="dedup")
+    for key, response in responses.items():
+        try:
+            if isinstance(response, Exception):
+                raise response
+            results[int(key)] = [(batches[int(key)], set(parse_redundancy_response(response)))]
+            DEDUP_SIZER.record_success()
+        except Exception as e:
+            if isinstance(e, SIZE_ERRORS):
+                DEDUP_SIZER.record_failure()
+            logging.info(f"Error in {label} deduplication: {e}")
+            continue
+    return results
+
+def completed_removals(results, coverage=None):
+    """
+    Helper function: union of the redundant indices the batches returned, restricted to
+    the indices that were sent. With a coverage, only the pairs within the (sub-)batches
+    that were answered are marked as compared (a failed batch compared nothing)
+    """
+    to_remove = set()
+    for parts in results:
+        if parts is None:
+            continue
+        for sub_batch, redundant in parts:
+            to_remove.update(redundant & set(sub_batch))
+            if coverage is not None:
+                coverage.mark(sub_batch)
     return to_remove
 
-def deduplicate_facts(facts_list, max_iter=3, threshold=5):
+def within_batches(facts_list, batch_size=BATCH_SIZE):
+    """
+    Helper function: batches the list in order, keyed by global index
+    """
+    return [
+        {start_idx + i: fact for i, fact in enumerate(batch)}
+        for start_idx, batch in chunk_facts(facts_list, batch_size, sizer=DEDUP_SIZER)
+    ]
+
+def run_within_batch_deduplication(facts_list,  batch_size=BATCH_SIZE, max_workers=MAX_WORKERS):
+    """
+    Helper function:
+    1. batches the list in order
+    2. returns duplicate indices
+    """
+    batches = within_batches(facts_list, batch_size)
+    return completed_removals(run_dedup_batches(batches, "within-batch", max_workers))
+
+async def async_run_within_batch_deduplication(facts_list, batch_size=BATCH_SIZE):
+    """
+    Async version of run_within_batch_deduplication
+    """
+    batches = within_batches(facts_list, batch_size)
+    return completed_removals(await async_run_dedup_batches(batches, "within-batch"))
+
+def cross_batches(facts_list, keep_indices, batch_size=BATCH_SIZE, iteration=0):
+    """
+    Helper function: blocks the kept facts by TF-IDF similarity and date so likely
+    duplicates share a batch; each iteration uses a different projection, which moves
+    the block boundaries
+
+    Returns:
+        batches keyed by global index
+    """
+    keep_indices = np.asarray(keep_indices, dtype=np.int64)
+    if len(keep_indices) == 0:
+        return []
+    embeddings = tfidf_embeddings([facts_list[i] for i in keep_indices], seed=iteration)
+    return [
+        {int(i): facts_list[i] for i in np.sort(keep_indices[block])}
+        for block in similarity_blocks(embeddings, batch_size)
+    ]
+
+def run_cross_batch_deduplication(facts_list, keep_indices, batch_size=BATCH_SIZE, max_workers=MAX_WORKERS, iteration=0):
+    """
+    Helper function: one similarity-blocked pass over the kept facts, without coverage
+    tracking (deduplicate_facts builds its cross batches with coverage_batches)
+    1. blocks the kept facts by similarity
+    2. returns duplicate indices
+    """
+    batches = cross_batches(facts_list, keep_indices, batch_size, iteration)
+    return completed_removals(run_dedup_batches(batches, "cross-batch", max_workers))
+
+async def async_run_cross_batch_deduplication(facts_list, keep_indices, batch_size=BATCH_SIZE, iteration=0):
+    """
+    Async version of run_cross_batch_deduplication
+    """
+    batches = cross_batches(facts_list, keep_indices, batch_size, iteration)
+    return completed_removals(await async_run_dedup_batches(batches, "cross-batch"))
+
+def normalize_fact(fact, pattern=PATTERN):
+    """
+    Helper function: split a fact into (normalized text, date); case, whitespace and
+    surrounding punctuation are ignored
+    """
+    date = re.search(pattern, fact)
+    text = fact[:date.start()] if date else fact
+    text = " ".join(text.lower().split()).strip(" .;,")
+    return text, (date.group(0)[1:-1] if date else "")
+
+def shingle_hashes(text, size=SHINGLE_SIZE):
+    """
+    Helper function: crc32 of the character n-grams of a text (deterministic across runs)
+    """
+    text = f" {text} "
+    grams = {text[i:i+size] for i in range(max(1, len(text) - size + 1))}
+    return np.fromiter((zlib.crc32(g.encode("utf-8")) for g in grams), dtype=np.uint64, count=len(grams))
+
+def minhash_signatures(texts, num_perm=MINHASH_PERM, seed=42, block=1024):
+    """
+    MinHash signatures (len(texts) x num_perm) using universal hashes (a*x + b) mod p
+    """
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, MINHASH_PRIME, size=num_perm, dtype=np.uint64)
+    b = rng.integers(0, MINHASH_PRIME, size=num_perm, dtype=np.uint64)
+    signatures = np.empty((len(texts), num_perm), dtype=np.uint64)
+    for start in range(0, len(texts), block):
+        shingles = [shingle_hashes(t) for t in texts[start:start+block]]
+        offsets = np.cumsum([0] + [len(x) for x in shingles[:-1]])
+        values = np.concatenate(shingles)
+        # x < 2^32 and a < 2^31, so a*x + b fits in uint64
+        hashed = (values[None, :] * a[:, None] + b[:, None]) % MINHASH_PRIME
+        signatures[start:start+len(shingles)] = np.minimum.reduceat(hashed, offsets, axis=1).T
+    return signatures
+
+def near_duplicate_clusters(facts_list, bands=LSH_BANDS, threshold=LSH_THRESHOLD, pattern=PATTERN):
+    """
+    Local near-duplicate pass ahead of the LLM.
+
+    1. Facts with the same normalized text and date are exact duplicates: the first is kept
+    2. The remaining facts are MinHashed and LSH-banded; facts that share a band and a
+       date (and agree on >= threshold of the signature) form candidate clusters. Facts that only differ by date are never grouped,
+       the dedup prompt keeps those.
+
+    Returns:
+        (indices of exact duplicates, list of ambiguous clusters of global indices)
+    """
+    first_seen = {}
+    exact = set()
+    for idx, fact in enumerate(facts_list):
+        key = normalize_fact(fact, pattern)
+        if key in first_seen:
+            exact.add(idx)
+        else:
+            first_seen[key] = idx
+    if len(first_seen) < 2:
+        return exact, []
+
+    keys = list(first_seen)
+    indices = list(first_seen.values())
+    signatures = minhash_signatures([text for text, _ in keys])
+    rows = signatures.shape[1] // bands
+
+    # union-find over facts that collide in any band and whose signatures agree enough
+    parent = list(range(len(keys)))
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for band in range(bands):
+        buckets = {}
+        band_values = signatures[:, band*rows:(band+1)*rows]
+        for i, (_, date) in enumerate(keys):
+            bucket = (date, band_values[i].tobytes())
+            if bucket in buckets:
+                j = buckets[bucket]
+                if np.mean(signatures[i] == signatures[j]) >= threshold:
+                    parent[find(i)] = find(j)
+            else:
+                buckets[bucket] = i
+
+    clusters = {}
+    for i in range(len(keys)):
+        clusters.setdefault(find(i), []).append(indices[i])
+    return exact, [c for c in clusters.values() if len(c) > 1]
+
+def cluster_batches(facts_list, clusters, batch_size=BATCH_SIZE):
+    """
+    Helper function: pack whole clusters into {global index: fact} batches of at most
+    batch_size facts (clusters larger than a batch are split)
+    """
+    batches = []
+    current = {}
+    for cluster in sorted(clusters, key=len, reverse=True):
+        for start in range(0, len(cluster), batch_size):
+            part = cluster[start:start+batch_size]
+            if len(current) + len(part) > batch_size:
+                batches.append(current)
+                current = {}
+            current.update({i: facts_list[i] for i in part})
+    if current:
+        batches.append(current)
+    return batches
+
+class PairCoverage:
+    """
+    Which candidate pairs have been sent to the LLM in the same batch: one flag per
+    candidate pair plus a per-fact index of its pairs, so memory grows with the number
+    of candidate pairs (about DEDUP_NEIGHBORS per fact) instead of n^2
+    """
+
+    def __init__(self, n, pairs):
+        self.n = n
+        self.i, self.j = pairs
+        self.compared = np.zeros(len(self.i), dtype=bool)
+        ends = np.concatenate([self.i, self.j])
+        self._pairs = np.argsort(ends, kind="stable") % max(1, len(self.i)) # pair positions grouped by fact
+        self._start = np.concatenate([[0], np.cumsum(np.bincount(ends, minlength=n))])
+
+    def pairs_of(self, indices):
+        """Positions of the candidate pairs that involve any of the facts"""
+        starts = self._start[indices]
+        counts = self._start[indices + 1] - starts
+        offsets = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        return self._pairs[offsets]
+
+    def mark(self, indices):
+        """Record every candidate pair within one batch as compared"""
+        indices = np.fromiter(indices, dtype=np.int64)
+        member = np.zeros(self.n, dtype=bool)
+        member[indices] = True
+        touched = self.pairs_of(indices)
+        self.compared[touched[member[self.i[touched]] & member[self.j[touched]]]] = True
+
+    def live(self, keep_indices):
+        """Boolean array: are both facts of the pair still kept"""
+        kept = np.zeros(self.n, dtype=bool)
+        kept[list(keep_indices)] = True
+        return kept[self.i] & kept[self.j]
+
+def top_neighbors(embeddings, queries, candidates, k, min_sim, block_elements):
+    """
+    Helper function: (query, candidate) pairs of each query's k most similar candidates,
+    computed in blocks of at most block_elements similarities
+    """
+    k = min(k, len(candidates) - 1)
+    if k <= 0 or not len(queries):
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    rows, cols = [], []
+    target = embeddings[candidates].T
+    step = max(1, block_elements // len(candidates))
+    for start in range(0, len(queries), step):
+        query = queries[start:start+step]
+        sims = embeddings[query] @ target
+        sims[candidates[None, :] == query[:, None]] = -np.inf
+        top = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+        keep = (np.take_along_axis(sims, top, axis=1) >= min_sim).ravel()
+        rows.append(np.repeat(query, k)[keep])
+        cols.append(candidates[top.ravel()[keep]])
+    return np.concatenate(rows), np.concatenate(cols)
+
+def candidate_pairs(embeddings, dates, rows=None, k=DEDUP_NEIGHBORS, min_sim=NEIGHBOR_MIN_SIM,
+                    block_elements=NEIGHBOR_BLOCK_ELEMENTS):
+    """
+    Pairs (i < j) of facts among each other's k most similar facts. Facts that differ
+    by date are never redundant (see the dedup prompt), so a dated fact is only compared
+    with the facts of its date and the undated ones; an undated fact with every fact.
+
+    Args:
+        dates (list): date of each fact, "" if undated (normalize_fact)
+        rows (array): only look up the neighbours of these facts (default all), e.g. the
+            facts added since the last deduplication
+
+    Returns:
+        (i, j) arrays
+    """
+    n = len(embeddings)
+    embeddings = embeddings.astype(np.float32)
+    dates = np.asarray(dates, dtype=object)
+    queried = np.zeros(n, dtype=bool)
+    queried[np.arange(n) if rows is None else rows] = True
+    undated = np.flatnonzero(dates == "")
+    pairs = [top_neighbors(embeddings, undated[queried[undated]], np.arange(n), k, min_sim, block_elements)]
+    order = np.argsort(dates, kind="stable")
+    bounds = np.flatnonzero(dates[order][1:] != dates[order][:-1]) + 1
+    for group in np.split(order, bounds):
+        if not len(group) or dates[group[0]] == "":
+            continue
+        candidates = np.concatenate([group, undated])
+        pairs.append(top_neighbors(embeddings, group[queried[group]], candidates, k, min_sim, block_elements))
+    i = np.concatenate([p[0] for p in pairs])
+    j = np.concatenate([p[1] for p in pairs])
+    if not len(i):
+        return i, j
+    codes = np.unique(np.minimum(i, j) * n + np.maximum(i, j))
+    return codes // n, codes % n
+
+def pair_coverage_ratio(coverage, keep_indices):
+    """
+    Share of candidate pairs between kept facts that have been compared
+    """
+    live = coverage.live(keep_indices)
+    if not live.any():
+        return 1.0
+    return float(coverage.compared[live].mean())
+
+def coverage_batches(facts_list, keep_indices, coverage, batch_size=BATCH_SIZE):
+    """
+    Greedy batch construction maximizing the number of not yet compared candidate pairs
+    per call. Each fact goes into at most one batch per pass, so two facts can never
+    remove each other; facts without open pairs are not sent.
+
+    Returns:
+        batches keyed by global index
+    """
+    open_pairs = coverage.live(keep_indices) & ~coverage.compared
+
+    neighbors = {}
+    for a, b in zip(coverage.i[open_pairs].tolist(), coverage.j[open_pairs].tolist()):
+        neighbors.setdefault(a, set()).add(b)
+        neighbors.setdefault(b, set()).add(a)
+
+    groups = []
+    available = set(neighbors)
+    # seed with the fact that has the most open pairs, grow by largest gain
+    for seed in sorted(neighbors, key=lambda f: (-len(neighbors[f]), f)):
+        if seed not in available:
+            continue
+        group = [seed]
+        available.discard(seed)
+        gain = {f: 1 for f in neighbors[seed] if f in available}
+        while gain and len(group) < batch_size:
+            best = max(gain, key=lambda f: (gain[f], -f))
+            del gain[best]
+            group.append(best)
+            available.discard(best)
+            for f in neighbors[best]:
+                if f in available:
+                    gain[f] = gain.get(f, 0) + 1
+        groups.append(group)
+
+    # pack the groups into as few calls as possible (first fit decreasing)
+    batches = []
+    for group in sorted(groups, key=len, reverse=True):
+        for batch in batches:
+            if len(batch) + len(group) <= batch_size:
+                batch.update({f: facts_list[f] for f in group})
+                break
+        else:
+            batches.append({f: facts_list[f] for f in group})
+    return [dict(sorted(batch.items())) for batch in batches]
+
+def deduplicate_facts(facts_list, max_iter=3, coverage_target=COVERAGE_TARGET, engine="thread", prefilter="lsh",
+                      deduped_prefix=0):
     """
     Function to remove duplicate facts
-    1. Remove within batch
-    2. Iteratively remove across batches until threshold or max iterations are met
+    1. Remove within batch (or the LSH clusters, see prefilter)
+    2. Build cross batches from the candidate pairs (nearest neighbours by TF-IDF) that
+       have not been compared yet, until coverage_target or max iterations are met
+
+    engine="async" runs each pass on the asyncio engine instead of a thread pool,
+    engine="batch" submits each pass as one batch job.
+
+    prefilter="lsh" removes exact duplicates locally and sends the ambiguous near-duplicate
+    clusters (see near_duplicate_clusters) in place of the within-batch pass; the
+    coverage passes then compare the candidate pairs the clusters did not cover.
+    prefilter="none" sends the whole list in the within-batch pass.
+
+    deduped_prefix=N declares the first N facts an already deduplicated list (e.g. from an
+    earlier run): only pairs involving the facts after it are compared.
     """
+    def run_batches(batches, label):
+        if engine == "async":
+            return run_async(async_run_dedup_batches(batches, label))
+        if engine == "batch":
+            return batch_run_dedup_batches(batches, label)
+        return run_dedup_batches(batches, label)
+
     all_to_remove = set()
 
-    # Remove within batches (these are notes close together)
-    # Within-batch pass
-    batch_removals = run_within_batch_deduplication(facts_list)
-    logging.info(f'Batch Removals: {batch_removals}')
-    all_to_remove.update(batch_removals)
+    # only the facts after the deduplicated prefix look up neighbours, so every pair involves one
+    dates = [normalize_fact(fact)[1] for fact in facts_list]
+    pairs = candidate_pairs(tfidf_embeddings(facts_list), dates, rows=np.arange(deduped_prefix, len(facts_list)))
+    coverage = PairCoverage(len(facts_list), pairs)
+
+    if prefilter == "lsh":
+        exact, clusters = near_duplicate_clusters(facts_list)
+        clusters = [c for c in clusters if max(c) >= deduped_prefix]
+        batches = cluster_batches(facts_list, clusters, dedup_batch_size(facts_list))
+        logging.info(f'Prefilter: {len(exact)} exact duplicates, {len(clusters)} clusters '
+                     f'({sum(len(c) for c in clusters)} facts) in {len(batches)} batches')
+        all_to_remove.update(exact)
+        cluster_removals = completed_removals(run_batches(batches, "cluster"), coverage)
+        logging.info(f'Cluster Removals: {cluster_removals}')
+        all_to_remove.update(cluster_removals)
+    else:
+        # Remove within batches (these are notes close together)
+        # Within-batch pass
+        batches = [
+            {deduped_prefix + i: fact for i, fact in batch.items()}
+            for batch in within_batches(facts_list[deduped_prefix:])
+        ]
+        batch_removals = completed_removals(run_batches(batches, "within-batch"), coverage)
+        logging.info(f'Batch Removals: {batch_removals}')
+        all_to_remove.update(batch_removals)
 
     keep_indices = [i for i in range(len(facts_list)) if i not in all_to_remove]
 
-    
-    # shuffle the list and then remove duplicates until very few are left
+    # compare the candidate pairs not seen together yet until the coverage target is met
     for idx in range(max_iter):
+        ratio = pair_coverage_ratio(coverage, keep_indices)
+        logging.info(f'Index {idx}: Pair coverage {ratio:.3f} of {len(pairs[0])} candidate pairs')
+        if ratio >= coverage_target:
+            break
+        batches = coverage_batches(facts_list, keep_indices, coverage, dedup_batch_size(facts_list))
+        if not batches:
+            break
         # Cross-batch pass
-        original_size = len(all_to_remove)
-        cross_removals = run_cross_batch_deduplication(facts_list, keep_indices)
+        cross_removals = completed_removals(run_batches(batches, "cross-batch"), coverage)
         all_to_remove.update(cross_removals)
         logging.info(f'Index {idx}: Cross Removals: {cross_removals}')
-
-        new_size = len(all_to_remove)
-        if new_size - original_size < threshold:
-            break
+        keep_indices = [i for i in keep_indices if i not in cross_removals]
     # deduplicate at the end of the iteration
     deduped_list = [facts_list[i] for i in range(len(facts_list)) if i not in all_to_remove]
 
     return deduped_list, all_to_remove
 
 
-def chunk_note(text: str, chunk_size: int):
-    """Split note text into fixed-size chunks."""
+def extract_chunk_size(chunk_size, sizer=None, adaptive=True):
+    """Cap the chunk size so prompt and expected response fit the sizer's budget
+    (its configured budget, without the runtime scale, if not adaptive)."""
+    if sizer is None:
+        return chunk_size
+    if adaptive:
+        budget = min(sizer.input_budget(), sizer.output_budget() / EXTRACT_OUTPUT_RATIO)
+    else:
+        budget = min(sizer.input_tokens, sizer.output_tokens / EXTRACT_OUTPUT_RATIO)
+    return max(MIN_SPLIT_CHARS, min(chunk_size, int(budget * 4)))
+
+def split_on(text, pattern):
+    """Split text after every match of pattern; the pieces concatenate back to text."""
+    cuts = [m.end() for m in pattern.finditer(text)]
+    return [text[start:end] for start, end in zip([0] + cuts, cuts + [len(text)]) if end > start]
+
+def text_segments(text, max_len):
+    """Sections, broken into sentences (and then fixed slices) where longer than max_len."""
+    for section in split_on(text, SECTION_PATTERN):
+        if len(section) <= max_len:
+            yield section
+            continue
+        for sentence in split_on(section, SENTENCE_PATTERN):
+            if len(sentence) <= max_len:
+                yield sentence
+            else:
+                yield from (sentence[i:i+max_len] for i in range(0, len(sentence), max_len))
+
+def chunk_note(text: str, chunk_size: int, sizer=None, overlap=CHUNK_OVERLAP):
+    """Split note text into chunks of at most chunk_size on section and sentence boundaries.
+    Each chunk starts with up to `overlap` characters of whole sentences from the previous one.
+    With a sizer the chunk size is capped so prompt and expected response fit its budget."""
+    chunk_size = extract_chunk_size(chunk_size, sizer)
     if len(text) < chunk_size:
         return [text]
-    return [text[i:i+chunk_size] for i in range(0, len(text), chunk_size)]
+    overlap = min(overlap, chunk_size // 4)
+
+    chunks = []
+    current, size = [], 0
+    for segment in text_segments(text, chunk_size - overlap):
+        if current and size + len(segment) > chunk_size:
+            chunks.append("".join(current))
+            # carry the trailing segments that fit in the overlap
+            tail, tail_size = [], 0
+            for previous in reversed(current):
+                if tail_size + len(previous) > overlap:
+                    break
+                tail.insert(0, previous)
+                tail_size += len(previous)
+            current, size = tail, tail_size
+        current.append(segment)
+        size += len(segment)
+    if current:
+        chunks.append("".join(current))
+    return chunks
+
+def note_rows(notes):
+    """
+    Rows of a notes DataFrame, or the rows of a note iterator (e.g. utils.iter_notes) as they are read
+    """
+    if isinstance(notes, pd.DataFrame):
+        return (row for _, row in notes.iterrows())
+    return iter(notes)
+
+def extraction_jobs(notes, chunk_size, sizer=None):
+    """
+    Plan the extraction requests: long notes are chunked, short notes (that fit in one
+    chunk) are packed in order into shared requests of up to PACK_MAX_NOTES notes.
+    Notes are only read and chunked as the jobs are consumed.
+
+    The plan uses the sizer's configured budget, not its runtime scale, so every run
+    plans the same chunks and their journal keys match; a shrunk sizer splits the
+    chunks further at request time (extract_claims, extract_pack_claims).
+
+    Yields:
+        ("chunk", row, chunk_idx, chunk) and ("pack", [rows])
+    """
+    capacity = extract_chunk_size(chunk_size, sizer, adaptive=False)
+    pack, pack_size = [], 0
 
-def process_chunk(row, chunk_idx, chunk, pattern):
+    def close_pack():
+        if len(pack) == 1:
+            yield ("chunk", pack[0], 0, pack[0]["text"])
+        elif pack:
+            yield ("pack", list(pack))
+        pack.clear()
+
+    for row in note_rows(notes):
+        chunk_list = chunk_note(row["text"], capacity)
+        if len(chunk_list) > 1:
+            yield from (("chunk", row, chunk_idx, chunk) for chunk_idx, chunk in enumerate(chunk_list))
+            continue
+        note_size = len(row["text"]) + PACK_NOTE_OVERHEAD
+        if pack and (pack_size + note_size > capacity or len(pack) >= PACK_MAX_NOTES):
+            yield from close_pack()
+            pack_size = 0
+        pack.append(row)
+        pack_size += note_size
+    yield from close_pack()
+
+def split_text(text):
+    """Split text in two halves, at the whitespace closest to the middle."""
+    middle = len(text) // 2
+    cut = text.rfind(" ", 0, middle)
+    cut = cut if cut > 0 else middle
+    return [text[:cut], text[cut:]]
+
+def sub_chunks(text, sizer):
+    """Pieces of a planned chunk that fit the sizer's current budget (the chunk itself if it fits)"""
+    capacity = extract_chunk_size(len(text), sizer)
+    if len(text) <= capacity:
+        return [text]
+    logging.info(f"Splitting a chunk of {len(text)} characters to the current budget of {capacity}")
+    return chunk_note(text, capacity)
+
+def pack_fits(rows, sizer):
+    size = sum(len(row["text"]) + PACK_NOTE_OVERHEAD for row in rows)
+    return size <= extract_chunk_size(size, sizer)
+
+def extract_claims(note_date, text, on_claim=None, sizer=EXTRACT_SIZER):
+    """apply_facts_module, retried on halves of the text when the response was truncated or unparsable.
+    A chunk larger than the sizer's current budget is split first."""
+    pieces = sub_chunks(text, sizer)
+    if len(pieces) > 1:
+        return [c for piece in pieces for c in extract_claims(note_date, piece, on_claim, sizer)]
+    try:
+        claims = apply_facts_module(note_date=note_date, text=text, on_claim=on_claim)
+    except SIZE_ERRORS as e:
+        sizer.record_failure()
+        if len(text) < 2 * MIN_SPLIT_CHARS:
+            raise
+        logging.info(f"Retrying extraction of {len(text)} characters in halves: {e}")
+        return [c for half in split_text(text) for c in extract_claims(note_date, half, on_claim, sizer)]
+    sizer.record_success()
+    return claims
+
+async def async_extract_claims(note_date, text, sizer=EXTRACT_SIZER):
+    """Async version of extract_claims"""
+    pieces = sub_chunks(text, sizer)
+    if len(pieces) > 1:
+        claims = []
+        for piece in pieces:
+            claims.extend(await async_extract_claims(note_date, piece, sizer))
+        return claims
+    try:
+        claims = await async_apply_facts_module(note_date=note_date, text=text)
+    except SIZE_ERRORS as e:
+        sizer.record_failure()
+        if len(text) < 2 * MIN_SPLIT_CHARS:
+            raise
+        logging.info(f"Retrying extraction of {len(text)} characters in halves: {e}")
+        claims = []
+        for half in split_text(text):
+            claims.extend(await async_extract_claims(note_date, half, sizer))
+        return claims
+    sizer.record_success()
+    return claims
+
+def pack_notes(rows):
+    return [(str(row.name), str(row["note_date"]), row["text"]) for row in rows]
+
+def extract_pack_claims(rows, on_claim=None, sizer=EXTRACT_SIZER):
+    """apply_notes_facts_module, retried on halves of the pack when the response was truncated
+    or unparsable; notes missing from the response are extracted on their own."""
+    if len(rows) == 1:
+        return {str(rows[0].name): extract_claims(str(rows[0]["note_date"]), rows[0]["text"], on_claim, sizer)}
+    if not pack_fits(rows, sizer):
+        half = len(rows) // 2
+        return {**extract_pack_claims(rows[:half], on_claim, sizer), **extract_pack_claims(rows[half:], on_claim, sizer)}
+    try:
+        claims = apply_notes_facts_module(pack_notes(rows), on_claim=on_claim)
+    except SIZE_ERRORS as e:
+        sizer.record_failure()
+        logging.info(f"Retrying pack of {len(rows)} notes in halves: {e}")
+        half = len(rows) // 2
+        return {**extract_pack_claims(rows[:half], on_claim, sizer), **extract_pack_claims(rows[half:], on_claim, sizer)}
+    sizer.record_success()
+    for row in rows:
+        if str(row.name) not in claims:
+            claims[str(row.name)] = extract_claims(str(row["note_date"]), row["text"], on_claim, sizer)
+    return claims
+
+async def async_extract_pack_claims(rows, sizer=EXTRACT_SIZER):
+    """Async version of extract_pack_claims"""
+    if len(rows) == 1:
+        return {str(rows[0].name): await async_extract_claims(str(rows[0]["note_date"]), rows[0]["text"], sizer)}
+    if not pack_fits(rows, sizer):
+        half = len(rows) // 2
+        return {**await async_extract_pack_claims(rows[:half], sizer), **await async_extract_pack_claims(rows[half:], sizer)}
+    try:
+        claims = await async_apply_notes_facts_module(pack_notes(rows))
+    except SIZE_ERRORS as e:
+        sizer.record_failure()
+        logging.info(f"Retrying pack of {len(rows)} notes in halves: {e}")
+        half = len(rows) // 2
+        return {**await async_extract_pack_claims(rows[:half], sizer), **await async_extract_pack_claims(rows[half:], sizer)}
+    sizer.record_success()
+    for row in rows:
+        if str(row.name) not in claims:
+            claims[str(row.name)] = await async_extract_claims(str(row["note_date"]), row["text"], sizer)
+    return claims
+
+def process_pack(rows, pattern, on_claim=None):
+    """Process a pack of short notes in one request, return a (structured dict, facts) per note."""
+    claims = extract_pack_claims(rows, on_claim=on_claim)
+    return [build_chunk_record(row, 0, claims[str(row.name)], pattern) for row in rows]
+
+async def async_process_pack(rows, pattern):
+    """Async version of process_pack"""
+    claims = await async_extract_pack_claims(rows)
+    return [build_chunk_record(row, 0, claims[str(row.name)], pattern) for row in rows]
+
+def process_job(job, pattern, on_claim=None):
+    """Run one planned extraction request (see extraction_jobs), return a list of (structured dict, facts)."""
+    if job[0] == "pack":
+        return process_pack(job[1], pattern, on_claim)
+    _, row, chunk_idx, chunk = job
+    return [process_chunk(row, chunk_idx, chunk, pattern, on_claim)]
+
+async def async_process_job(job, pattern):
+    """Async version of process_job"""
+    if job[0] == "pack":
+        return await async_process_pack(job[1], pattern)
+    _, row, chunk_idx, chunk = job
+    return [await async_process_chunk(row, chunk_idx, chunk, pattern)]
+
+def process_chunk(row, chunk_idx, chunk, pattern, on_claim=None):
     """Process one chunk: send to Gemini, parse, return structured dict + facts."""
+    claims = extract_claims(note_date=str(row["note_date"]), text=chunk, on_claim=on_claim)
+    return build_chunk_record(row, chunk_idx, claims, pattern)
+
+async def async_process_chunk(row, chunk_idx, chunk, pattern):
+    """Async version of process_chunk"""
+    claims = await async_extract_claims(note_date=str(row["note_date"]), text=chunk)
+    return build_chunk_record(row, chunk_idx, claims, pattern)
+
+def build_chunk_record(row, chunk_idx, claims, pattern):
+    """
+    Date-stamp the extracted claims and attach chunk provenance. The chunk text is not
+    kept, so finished chunks do not hold on to the notes.
+    """
     temp = {
         "note_number": row.name,
         "note_date": str(row["note_date"]),
         "note_title": row["note_title"],
         "chunk_num": chunk_idx,
-        "text": chunk,
         "facts": []
     }
 
     facts = []
-    for f in apply_facts_module(note_date=temp["note_date"], text=chunk):
+    for f in claims:
         if re.search(pattern, f):
             fact = f"{f}"
         else:
@@ -214,36 +1068,236 @@ def process_chunk(row, chunk_idx, chunk, pattern):
     return temp, facts
 
 
-def extract_facts_from_notes(notes_df, chunk_size, pattern, max_workers=MAX_WORKERS):
+def job_chunks(job):
+    """(row, text) of every chunk an extraction job covers"""
+    if job[0] == "pack":
+        return [(row, row["text"]) for row in job[1]]
+    _, row, chunk_idx, chunk = job
+    return [(row, chunk)]
+
+def job_keys(job):
+    return [chunk_key(row["note_date"], row["note_title"], text) for row, text in job_chunks(job)]
+
+def journaled_records(journal, job):
+    """Records of the job's chunks that finished in an earlier run (None for the others)"""
+    if journal is None:
+        return [None] * len(job_chunks(job))
+    records = []
+    for (row, text), key in zip(job_chunks(job), job_keys(job)):
+        entry = journal.get(key)
+        if entry is None:
+            records.append(None)
+            continue
+        temp = {k: entry[k] for k in ("note_date", "note_title", "chunk_num", "facts")}
+        temp["note_number"] = row.name
+        records.append((temp, temp["facts"]))
+    return records
+
+def resume_job(journal, job):
+    """
+    Split a job into the records journaled in an earlier run and the job still to run
+    (None when every chunk is journaled); of a pack only the missing notes are resent
+    """
+    records = journaled_records(journal, job)
+    done = [record for record in records if record is not None]
+    if len(done) == len(records):
+        return done, None
+    if not done:
+        return [], job
+    rows = [row for row, record in zip(job[1], records) if record is None]
+    return done, (("pack", rows) if len(rows) > 1 else ("chunk", rows[0], 0, rows[0]["text"]))
+
+def journal_result(journal, job, records=None, error=None):
+    """Append a finished (records) or failed (error) job to the journal"""
+    if journal is None:
+        return
+    for key, record in zip(job_keys(job), records or [None] * len(job_chunks(job))):
+        if record is None:
+            journal.fail(key, error)
+        else:
+            temp, _ = record
+            journal.record(key, temp)
+
+def plan_extraction(notes, chunk_size, journal=None):
+    """
+    Plan the extraction requests and pick up the jobs already in the journal
+
+    Returns:
+        (jobs, {job index: records} of finished jobs, indices of jobs to run)
+    """
+    jobs = list(extraction_jobs(notes, chunk_size, sizer=EXTRACT_SIZER))
+    results = {}
+    pending = []
+    for job_idx, job in enumerate(jobs):
+        records, jobs[job_idx] = resume_job(journal, job)
+        if records:
+            results[job_idx] = records
+        if jobs[job_idx] is not None:
+            pending.append(job_idx)
+    log_resumed(len(jobs) - len(pending), len(jobs))
+    return jobs, results, pending
+
+def log_resumed(resumed, total):
+    if resumed:
+        logging.info(f"Resuming extraction: {resumed} of {total} requests already in the journal")
+
+def collect_records(results):
+    """Flatten the records in plan order (independent of completion order)"""
     fact_dict = []
     all_facts = []
+    for job_idx in sorted(results):
+        for temp, facts in results[job_idx]:
+            fact_dict.append(temp)
+            all_facts.extend(facts)
+    return fact_dict, all_facts
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = []
-        for row_idx, row in notes_df.iterrows():
-            chunk_list = chunk_note(row["text"], chunk_size)
-            for chunk_idx, chunk in enumerate(chunk_list):
-                futures.append(
-                    executor.submit(process_chunk, row, chunk_idx, chunk, pattern)
-                )
 
-        for future in concurrent.futures.as_completed(futures):
+def extract_facts_from_notes(notes, chunk_size, pattern, max_workers=MAX_WORKERS, on_claim=None, journal=None,
+                             max_in_flight=None):
+    """
+    Extract facts from every chunk of every note in parallel.
+    `notes` is a DataFrame or an iterator of note rows (e.g. utils.iter_notes); notes are
+    chunked as requests are submitted and at most `max_in_flight` requests (default
+    2 x max_workers) are pending at once, so only their chunks are held in memory.
+    `on_claim(claim)` is called for each raw claim as responses stream in.
+    With a `journal` (ChunkJournal), chunks finished in an earlier run are not sent again
+    and every result or failure is journaled as soon as it arrives.
+    """
+    max_in_flight = max_in_flight or 2 * max_workers
+    results = {}
+    futures = {}
+    resumed = total = 0
+
+    def collect(done):
+        for future in done:
+            job_idx, job = futures.pop(future)
             try:
-                temp, facts = future.result()
-                fact_dict.append(temp)
-                all_facts.extend(facts)
-                logging.info(
-                    f"[Note Number: {temp['note_number']} "
-                    f"Note Date: {temp['note_date']} "
-                    f"Title: {temp['note_title']} "
-                    f"Chunk {temp['chunk_num']}] "
-                    f"N={len(temp['facts'])} Facts={temp['facts']}"
-                )
+                records = future.result()
             except Exception as e:
                 logging.info(f"Error extracting facts: {e}")
+                journal_result(journal, job, error=e)
                 continue
+            journal_result(journal, job, records)
+            results[job_idx] = results.get(job_idx, []) + records
+            for temp, facts in records:
+                log_chunk_record(temp)
 
-    return fact_dict, all_facts
+    with worker_pool(max_workers) as executor:
+        for job_idx, job in enumerate(extraction_jobs(notes, chunk_size, sizer=EXTRACT_SIZER)):
+            total += 1
+            records, job = resume_job(journal, job)
+            if records:
+                results[job_idx] = records
+            if job is None:
+                resumed += 1
+                continue
+            futures[executor.submit(process_job, job, pattern, on_claim)] = (job_idx, job)
+            if len(futures) >= max_in_flight:
+                done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                collect(done)
+        collect(concurrent.futures.as_completed(list(futures)))
+
+    log_resumed(resumed, total)
+    return collect_records(results)
+
+
+def log_chunk_record(temp):
+    logging.info(
+        f"[Note Number: {temp['note_number']} "
+        f"Note Date: {temp['note_date']} "
+        f"Title: {temp['note_title']} "
+        f"Chunk {temp['chunk_num']}] "
+        f"N={len(temp['facts'])} Facts={temp['facts']}"
+    )
+
+
+async def async_extract_facts_from_notes(notes, chunk_size, pattern, journal=None, max_in_flight=ASYNC_CONCURRENCY):
+    """
+    Async version of extract_facts_from_notes
+    """
+    results = {}
+    running = set()
+    slots = asyncio.Semaphore(max_in_flight)
+    resumed = total = 0
+
+    async def run_job(job_idx, job):
+        try:
+            records = await async_process_job(job, pattern)
+        except Exception as e:
+            logging.info(f"Error extracting facts: {e}")
+            journal_result(journal, job, error=e)
+            return
+        finally:
+            slots.release()
+        journal_result(journal, job, records)
+        results[job_idx] = results.get(job_idx, []) + records
+        for temp, facts in records:
+            log_chunk_record(temp)
+
+    for job_idx, job in enumerate(extraction_jobs(notes, chunk_size, sizer=EXTRACT_SIZER)):
+        total += 1
+        records, job = resume_job(journal, job)
+        if records:
+            results[job_idx] = records
+        if job is None:
+            resumed += 1
+            continue
+        await slots.acquire()
+        task = asyncio.create_task(run_job(job_idx, job))
+        running.add(task)
+        task.add_done_callback(running.discard)
+    await asyncio.gather(*running)
+
+    log_resumed(resumed, total)
+    return collect_records(results)
+
+
+def batch_extract_facts_from_notes(notes_df, chunk_size, pattern, journal=None):
+    """
+    Batch-job version of extract_facts_from_notes: every chunk goes out in one job
+    """
+    jobs, results, pending = plan_extraction(notes_df, chunk_size, journal)
+
+    requests, families = {}, {}
+    for job_idx in pending:
+        job = jobs[job_idx]
+        if job[0] == "pack":
+            requests[str(job_idx)] = build_notes_facts_request(pack_notes(job[1]))
+            families[str(job_idx)] = "notes"
+        else:
+            _, row, chunk_idx, chunk = job
+            requests[str(job_idx)] = build_facts_request(str(row["note_date"]), chunk)
+            families[str(job_idx)] = "claims"
+
+    responses = run_batch(requests, stage="extract", family=families) if requests else {}
+    for job_idx in pending:
+        job = jobs[job_idx]
+        try:
+            response = responses[str(job_idx)]
+            if isinstance(response, Exception):
+                raise response
+            if job[0] == "pack":
+                claims = parse_notes_facts_response(response)
+                records = [build_chunk_record(row, 0, claims[str(row.name)], pattern) if str(row.name) in claims else None
+                           for row in job[1]]
+            else:
+                _, row, chunk_idx, chunk = job
+                records = [build_chunk_record(row, chunk_idx, parse_facts_response(response), pattern)]
+        except Exception as e:
+            logging.info(f"Error extracting facts: {e}")
+            journal_result(journal, job, error=e)
+            continue
+        # notes the model left out of a pack are failed on their own, a rerun resends only them
+        missing = sum(record is None for record in records)
+        if missing:
+            logging.info(f"Error extracting facts: {missing} of {len(records)} notes missing from the pack response")
+        journal_result(journal, job, records, error=MalformedResponseError("note missing from the pack response"))
+        records = [record for record in records if record is not None]
+        results[job_idx] = results.get(job_idx, []) + records
+        for temp, facts in records:
+            log_chunk_record(temp)
+
+    return collect_records(results)
 
 
 def parse_args():
@@ -266,23 +1320,120 @@ def parse_args():
                         '--output', 
                         type=str, 
                         help="Output directory")
+    parser.add_argument('-e',
+                        '--engine',
+                        type=str,
+                        choices=["thread", "async", "batch"],
+                        help="Run LLM calls on a thread pool, the asyncio engine or as batch jobs",
+                        default="thread")
+    parser.add_argument('--dedup-prefilter',
+                        type=str,
+                        choices=["lsh", "none"],
+                        help="Collapse exact duplicates locally and send near-duplicate clusters instead of the within-batch pass",
+                        default="lsh")
+    parser.add_argument('--allow-failed-chunks',
+                        action='store_true',
+                        help="Write the raw fact file even if some chunks failed (otherwise rerun to retry them)")
+    parser.add_argument('-p',
+                        '--max-patients',
+                        type=int,
+                        help="Patients processed at once, sharing one LLM worker pool",
+                        default=COHORT_PATIENTS)
     return parser.parse_args()
 
 
-def main(args):
-    id_list= args.id.split(',')
-    for id in tqdm.tqdm(id_list):
-        # clear file
-        with open(f"{args.output}/{id}.log", 'w+'):
-            pass  
-        logging.basicConfig(format='[%(asctime)s]\t%(message)s', level=logging.INFO, filename=f"{args.output}/{id}.log")
+def remove_stale_facts(facts_list, stale_facts):
+    """
+    Mask of the facts to keep after dropping one occurrence of every stale fact (from a
+    changed or deleted note)
+    """
+    stale = Counter(stale_facts)
+    keep = []
+    for fact in facts_list:
+        if stale[fact] > 0:
+            stale[fact] -= 1
+            keep.append(False)
+        else:
+            keep.append(True)
+    return keep
 
-        
-        logging.getLogger("LiteLLM").setLevel(logging.CRITICAL + 1)
-        logging.getLogger("httpx").setLevel(logging.WARNING + 1)
+
+def drop_stale_rows(facts_df, stale, stale_facts):
+    """
+    Remove the facts of changed or deleted notes (manifest keys `stale`) from the store
+
+    Returns:
+        (remaining rows, their deduplicated facts)
+    """
+    if facts_df["note_id"].notna().all():
+        stale_rows = facts_df["note_id"].astype(str).isin(stale).to_numpy()
+    else:
+        # stores converted from the old TSVs have no note ids, match the stale facts by text
+        stale_rows = ~np.array(remove_stale_facts(facts_df["fact"].astype(str), stale_facts), dtype=bool)
+    remaining = facts_df[~stale_rows]
+    deduped_list = kept_facts(remaining)
+    # a fact kept only through a stale row is still represented by its duplicates in other notes
+    orphaned = set(kept_facts(facts_df[stale_rows])) - set(deduped_list)
+    deduped_list += [f for f in dict.fromkeys(remaining["fact"].astype(str)) if f in orphaned]
+    return remaining, deduped_list
+
+
+def note_id_map(notes_df):
+    """notes_df index -> stable note key (as in the manifest)"""
+    return dict(zip(notes_df.index, note_keys(notes_df)))
+
+
+def run_extraction(notes_df, engine, journal):
+    """
+    Extract the facts of the notes with the selected engine
+
+    Returns:
+        (chunk records, facts list)
+    """
+    if engine == "async":
+        result = run_async(async_extract_facts_from_notes(
+            notes_df,
+            chunk_size=CHUNK_SIZE,
+            pattern=PATTERN,
+            journal=journal,
+        ))
+    elif engine == "batch":
+        result = batch_extract_facts_from_notes(
+            notes_df,
+            chunk_size=CHUNK_SIZE,
+            pattern=PATTERN,
+            journal=journal,
+        )
+    else:
+        result = extract_facts_from_notes(
+            notes_df,
+            chunk_size=CHUNK_SIZE,
+            pattern=PATTERN,
+            max_workers=MAX_WORKERS,
+            journal=journal,
+        )
+    journal.close()
+    return result
+
+
+def log_failed_chunks(journal):
+    logging.info("--------------------------------\n")
+    logging.info(f'{len(journal.run_failures)} chunks failed, rerun to retry them \n')
+    logging.info("--------------------------------\n")
+
+
+def process_patient(args, id):
+    """
+    Extract and deduplicate the facts of one patient into its fact store, logging to {output}/{id}.log
+
+    Returns:
+        deduplicated facts, or None if some chunks failed (rerun to retry them)
+    """
+    with patient_log(f"{args.output}/{id}.log", id):
+        fact_path = store_path(args.output, id)
         logging.info(f'Running fact extraction for {id}\n')
         logging.info("--------------------------------\n")
-        logging.info(f'Output: {f"{args.output}/{id}.tsv"}\n')
+        logging.info(f'Output: {fact_path}\n')
         logging.info(f'Logfile: {f"{args.output}/{id}.log"}\n')
         logging.info("--------------------------------\n")
 
@@ -291,28 +1442,58 @@ def main(args):
         # read notes
         notes_df = load_notes(f"{args.input}/{id}_subsetrecords.json")
 
-        if os.path.exists(f"{args.output}/{id}_raw.tsv"):
-            facts_list = []
-            with open(f"{args.output}/{id}_raw.tsv", "r") as ifile:
-                next(ifile)  
-                for line in ifile:
-                    _, fact = line.strip().split("\t", 1)
-                    facts_list.append(fact)
+        facts_df = load_facts(args.output, id)
+        manifest_path = f"{args.output}/{id}_manifest.json"
+        manifest, fresh, stale = None, [], []
+        if facts_df is not None and os.path.exists(manifest_path):
+            manifest = NoteManifest.load(manifest_path)
+            fresh, stale = manifest.diff(notes_df)
+
+        if manifest is not None and (any(fresh) or stale):
+            # only extract the new/changed notes and swap their facts into the existing store
+            logging.info("--------------------------------\n")
+            logging.info(f'Refreshing: {sum(fresh)} new or changed notes, {len(stale)} outdated \n')
+            logging.info("--------------------------------\n")
+            journal = ChunkJournal(f"{args.output}/{id}_chunks.jsonl")
+            fact_dict, new_facts = run_extraction(notes_df[fresh], args.engine, journal)
+            if journal.run_failures and not args.allow_failed_chunks:
+                log_failed_chunks(journal)
+                telemetry.log_summary(patient_id=id)
+                return
+
+            stale_facts = manifest.drop(stale)
+            manifest.update(notes_df[fresh], fact_dict, keys=note_id_map(notes_df))
+            deduplicated = is_deduplicated(facts_df)
+            facts_df, deduped_list = drop_stale_rows(facts_df, stale, stale_facts)
+            facts_df = concat([facts_df, facts_frame(fact_dict, note_id_map(notes_df))])
+            if deduplicated:
+                deduped_list, all_to_remove = deduplicate_facts(deduped_list + new_facts, engine=args.engine,
+                                                                prefilter=args.dedup_prefilter,
+                                                                deduped_prefix=len(deduped_list))
+                facts_df = mark_status(facts_df, deduped_list)
+                logging.info(f'Refreshed deduplication: Kept: {len(deduped_list)}, Removed {len(all_to_remove)} \n')
+            write_facts(fact_path, facts_df)
+            manifest.save(manifest_path)
+
+            logging.info("--------------------------------\n")
+            logging.info(f'Finished fact refresh: N=[{len(facts_df)}] (+{len(new_facts)}, -{len(stale_facts)}) \n')
             logging.info("--------------------------------\n")
-            logging.info(f'Loading raw fact file:  N=[{len(facts_list)}] \n')
+        elif facts_df is not None:
+            logging.info("--------------------------------\n")
+            logging.info(f'Loading fact store:  N=[{len(facts_df)}] \n')
             logging.info("--------------------------------\n")
         else:
-            _, facts_list = extract_facts_from_notes(
-                notes_df,
-                chunk_size=CHUNK_SIZE,
-                pattern=PATTERN,
-                max_workers=MAX_WORKERS  
-            )
-
-            with open(f"{args.output}/{id}_raw.tsv", 'w+') as ofile:
-                ofile.write('index\tfact\n')
-                for idx, fact in enumerate(facts_list):
-                    ofile.write(f'{idx}\t{fact}\n')
+            # finished chunks are journaled as they arrive, so a rerun only sends the rest
+            journal = ChunkJournal(f"{args.output}/{id}_chunks.jsonl")
+            fact_dict, facts_list = run_extraction(notes_df, args.engine, journal)
+            if journal.run_failures and not args.allow_failed_chunks:
+                log_failed_chunks(journal)
+                telemetry.log_summary(patient_id=id)
+                return
+
+            facts_df = facts_frame(fact_dict, note_id_map(notes_df))
+            write_facts(fact_path, facts_df)
+            NoteManifest.from_records(notes_df, fact_dict).save(manifest_path)
 
             logging.info("--------------------------------\n")
             logging.info(f'Finished fact extraction: N=[{len(facts_list)}] \n')
@@ -322,34 +1503,31 @@ def main(args):
         logging.info("--------------------------------\n")
         logging.info(f'Beginning deduplication \n')
         logging.info("--------------------------------\n")
-        if os.path.exists(f"{args.output}/{id}.tsv"):
-            deduped_list = []
-            with open(f"{args.output}/{id}.tsv", "r") as ifile:
-                next(ifile)  
-                for line in ifile:
-                    _, fact = line.strip().split("\t", 1)
-                    deduped_list.append(fact)
+        if is_deduplicated(facts_df):
+            deduped_list = kept_facts(facts_df)
             logging.info("--------------------------------\n")
-            logging.info(f'Loading deduped list:  N=[{len(deduped_list)}] (-{len(facts_list)-len(deduped_list)}) \n')
+            logging.info(f'Loading deduped list:  N=[{len(deduped_list)}] (-{len(facts_df)-len(deduped_list)}) \n')
             logging.info("--------------------------------\n")
         else:
-            deduped_list, all_to_remove = deduplicate_facts(facts_list)
-            with open(f"{args.output}/{id}.tsv", 'w+') as ofile:
-                ofile.write('index\tfact\n')
-                for idx, fact in enumerate(deduped_list):
-                    ofile.write(f'{idx}\t{fact}\n')
+            deduped_list, all_to_remove = deduplicate_facts(facts_df["fact"].astype(str).tolist(), engine=args.engine,
+                                                               prefilter=args.dedup_prefilter)
+            facts_df = mark_status(facts_df, deduped_list)
+            write_facts(fact_path, facts_df)
 
             logging.info("--------------------------------\n")
             logging.info(f'End duplication: Kept: {len(deduped_list)}, Removed {len(all_to_remove)} \n')
             logging.info(f'List of indicies to remove: {all_to_remove} \n')
             logging.info("--------------------------------\n")
 
-        
-        # clean up logger
-        root_logger = logging.getLogger()
-        for handler in root_logger.handlers[:]:
-            handler.close()
-            root_logger.removeHandler(handler)
+
+        telemetry.log_summary(patient_id=id)
+        return deduped_list
+
+
+def main(args):
+    id_list= args.id.split(',')
+    run_cohort(id_list, functools.partial(process_patient, args), max_patients=args.max_patients)
+    telemetry.report()
 
 if __name__ == '__main__':
     args = parse_args()
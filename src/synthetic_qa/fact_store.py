@@ -0,0 +1,224 @@
+"""
+Columnar fact store ({id}_facts.parquet) replacing the index/fact TSVs ({id}_raw.tsv, {id}.tsv).
+
+One row per extracted fact in extraction order, with its provenance (note_id, note_number,
+note_date, note_title, chunk_num), the date parsed from the fact text and its
+deduplication status: "pending" until deduplication has run, then "kept" or
+"duplicate". The deduplicated list is the kept rows. Text columns are dictionary-encoded.
+Readers memory-map the file and load only the columns they ask for.
+
+pyarrow is optional (pip install synthetic_qa[parquet]). Without it, or with
+LLM_FACT_STORE=tsv, the same table is written to {id}_facts.tsv. Fact directories that
+only have the old TSVs are still read, without provenance.
+"""
+# default
+import os
+import re
+from collections import Counter
+
+# pip
+import pandas as pd
+
+FACT_STORE = os.environ.get('LLM_FACT_STORE', 'parquet') # parquet (needs pyarrow) or tsv
+DATE_PATTERN = re.compile(r"\((\d{4}-\d{2}-\d{2})\)\s*$") # date stamp at the end of a fact
+PENDING, KEPT, DUPLICATE = "pending", "kept", "duplicate"
+COLUMNS = ["fact", "note_id", "note_number", "note_date", "note_title", "chunk_num", "fact_date", "status"]
+CATEGORY_COLUMNS = ["fact", "note_id", "note_title", "status"] # dictionary-encoded
+INT_COLUMNS = ["note_number", "chunk_num"]
+DATE_COLUMNS = ["note_date", "fact_date"]
+
+
+def have_pyarrow():
+    try:
+        import pyarrow.parquet
+    except ImportError:
+        return False
+    return True
+
+
+def store_path(directory, id):
+    """
+    Path of a patient's store: an existing file of either format, else the configured format
+    """
+    parquet, tsv = f"{directory}/{id}_facts.parquet", f"{directory}/{id}_facts.tsv"
+    if os.path.exists(parquet):
+        return parquet
+    if os.path.exists(tsv):
+        return tsv
+    return parquet if FACT_STORE == "parquet" and have_pyarrow() else tsv
+
+
+def fact_date(fact, note_date=None):
+    """
+    Date stamped at the end of a fact, falling back to the note date
+    """
+    match = DATE_PATTERN.search(fact)
+    return match.group(1) if match else note_date
+
+
+def typed(df):
+    """
+    Store dtypes: categorical text, nullable integers, datetimes
+    """
+    df = df.reindex(columns=COLUMNS)
+    for column in CATEGORY_COLUMNS:
+        df[column] = df[column].astype("string").astype("category")
+    for column in INT_COLUMNS:
+        df[column] = pd.to_numeric(df[column], errors="coerce").astype("Int64")
+    for column in DATE_COLUMNS:
+        # fact dates are days, note dates may carry a time: parse each value on its own
+        df[column] = pd.to_datetime(df[column], format="ISO8601", errors="coerce")
+    return df.reset_index(drop=True)
+
+
+def facts_frame(fact_dict, note_ids=None):
+    """
+    Store rows for the facts of chunk records (extract_facts.collect_records order)
+
+    Args:
+        note_ids (dict): note_number -> stable note key (manifest.note_keys)
+    """
+    rows = []
+    for record in fact_dict:
+        note_id = (note_ids or {}).get(record["note_number"])
+        for fact in record["facts"]:
+            rows.append({
+                "fact": fact,
+                "note_id": note_id,
+                "note_number": record["note_number"],
+                "note_date": record["note_date"],
+                "note_title": record["note_title"],
+                "chunk_num": record["chunk_num"],
+                "fact_date": fact_date(fact, record["note_date"]),
+                "status": PENDING,
+            })
+    return typed(pd.DataFrame(rows, columns=COLUMNS))
+
+
+def legacy_frame(facts_list):
+    """
+    Store rows for facts without provenance (from the old TSVs)
+    """
+    return typed(pd.DataFrame({"fact": facts_list,
+                               "fact_date": [fact_date(f) for f in facts_list],
+                               "status": PENDING}))
+
+
+def concat(frames):
+    return typed(pd.concat([frame.astype(object) for frame in frames], ignore_index=True))
+
+
+def mark_status(df, deduped_list):
+    """
+    Mark the rows that make up `deduped_list` as kept (first occurrences), the rest as duplicate
+    """
+    remaining = Counter(deduped_list)
+    status = []
+    for fact in df["fact"]:
+        if remaining[fact] > 0:
+            remaining[fact] -= 1
+            status.append(KEPT)
+        else:
+            status.append(DUPLICATE)
+    df = df.copy()
+    df["status"] = pd.Categorical(status)
+    return df
+
+
+def is_deduplicated(df):
+    return not (df["status"] == PENDING).any()
+
+
+def kept_facts(df):
+    return df.loc[df["status"] == KEPT, "fact"].astype(str).tolist()
+
+
+def write_facts(path, df):
+    """
+    Write the store atomically (parquet or tsv by extension)
+    """
+    tmp = f"{path}.tmp"
+    df = typed(df)
+    if path.endswith(".parquet"):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        pq.write_table(pa.Table.from_pandas(df, preserve_index=False), tmp, use_dictionary=CATEGORY_COLUMNS)
+    else:
+        df.to_csv(tmp, sep="\t", index=False, date_format="%Y-%m-%d")
+    os.replace(tmp, path)
+
+
+def read_store(path, columns=None, status=None):
+    """
+    Read `columns` (default all) of a store, optionally only the rows with `status`
+    """
+    columns = list(columns or COLUMNS)
+    wanted = columns + (["status"] if status is not None and "status" not in columns else [])
+    if path.endswith(".parquet"):
+        import pyarrow.compute as pc
+        import pyarrow.parquet as pq
+
+        table = pq.read_table(path, columns=wanted, memory_map=True,
+                              read_dictionary=[c for c in wanted if c in CATEGORY_COLUMNS])
+        if status is not None:
+            table = table.filter(pc.equal(table["status"].cast("string"), status))
+        df = table.select(columns).to_pandas()
+    else:
+        df = pd.read_csv(path, sep="\t", usecols=wanted, keep_default_na=False, na_values=[""])
+        if status is not None:
+            df = df[df["status"] == status]
+        df = df[columns]
+    return typed(df)[columns].reset_index(drop=True)
+
+
+def load_facts(directory, id):
+    """
+    The full store of a patient, None if there is none. Old {id}_raw.tsv / {id}.tsv files
+    are converted (without provenance).
+    """
+    path = store_path(directory, id)
+    if os.path.exists(path):
+        return read_store(path)
+    raw_path, deduped_path = f"{directory}/{id}_raw.tsv", f"{directory}/{id}.tsv"
+    if not os.path.exists(raw_path):
+        return None
+    df = legacy_frame(read_fact_tsv(raw_path))
+    if os.path.exists(deduped_path):
+        df = mark_status(df, read_fact_tsv(deduped_path))
+    return df
+
+
+def read_facts(directory, id, columns=("fact",), status=KEPT):
+    """
+    Columns of the deduplicated facts (status=None for all rows) for downstream stages
+    """
+    path = store_path(directory, id)
+    if not os.path.exists(path):
+        df = load_facts(directory, id)
+        if df is None:
+            raise FileNotFoundError(f"No fact store for {id} in {directory}")
+        return (df if status is None else df[df["status"] == status])[list(columns)].reset_index(drop=True)
+    return read_store(path, columns, status)
+
+
+def read_cohort(directory, id_list, columns=("fact", "fact_date", "status")):
+    """
+    One table of the given columns for several patients, with a person_id column
+    """
+    frames = []
+    for id in id_list:
+        df = read_facts(directory, id, columns, status=None)
+        df.insert(0, "person_id", id)
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True)
+
+
+def read_fact_tsv(path):
+    facts_list = []
+    with open(path, "r") as ifile:
+        next(ifile)
+        for line in ifile:
+            _, fact = line.strip().split("\t", 1)
+            facts_list.append(fact)
+    return facts_list
@@ -1,6 +1,7 @@
 # default
 import argparse
 import json
+import logging
 import concurrent.futures
 import random
 
@@ -8,7 +9,10 @@ import random
 import pandas as pd
 
 # custom
-from utils import send_single_message
+from utils import send_structured_message, async_send_structured_message, gather_with_limit, run_async, ContextThreadPoolExecutor, build_single_message
+from batch import run_batch, BatchItemError
+from structured import parse_response, MalformedResponseError
+import telemetry
 from prompts.filter_questions import FILTER_SYS
 
 random.seed(42)
@@ -42,18 +46,55 @@ def parse_args():
                         '--output', 
                         type=str, 
                         help="Output directory")
+    parser.add_argument('-e',
+                        '--engine',
+                        type=str,
+                        choices=["thread", "async", "batch"],
+                        help="Run LLM calls on a thread pool, the asyncio engine or as batch jobs",
+                        default="thread")
     return parser.parse_args()
 
 
 def apply_filter_module(row):
+    try:
+        response = send_structured_message(system_instructions=FILTER_SYS,
+                                           user_prompt=str(row.to_dict()),
+                                           family="filter",
+                                           stage="filter")
+    except MalformedResponseError as e:
+        logging.warning(f"Failed to decode filter response for question {row.name}: {e}")
+        response = None
+    return merge_filter_response(row, response)
+
+async def async_apply_filter_module(row):
+    try:
+        response = await async_send_structured_message(system_instructions=FILTER_SYS,
+                                                       user_prompt=str(row.to_dict()),
+                                                       family="filter",
+                                                       stage="filter")
+    except MalformedResponseError as e:
+        logging.warning(f"Failed to decode filter response for question {row.name}: {e}")
+        response = None
+    return merge_filter_response(row, response)
+
+def build_filter_request(row):
+    """
+    Request payload for apply_filter_module, for batch jobs
+    """
+    return build_single_message(user_prompt=str(row.to_dict()),
+                                system_instructions=FILTER_SYS,
+                                family="filter")
+
+FILTER_LABELS = ["question-relevance", "question-rephrase", "question-defined", "explanation"]
+
+def merge_filter_response(row, response):
+    """
+    Add the filter labels to a question; they are left empty (NaN) when the response
+    could not be used
+    """
     row_copy = row.copy()
-    response = send_single_message(system_instructions=FILTER_SYS,
-                               user_prompt=str(row.to_dict()))
-    response = json.loads(response[7:-3])
-    row_copy["question-relevance"] = response["question-relevance"]
-    row_copy["question-rephrase"] = response["question-rephrase"]
-    row_copy["question-defined"] = response["question-defined"]
-    row_copy["explanation"] = response["explanation"]
+    for label in FILTER_LABELS:
+        row_copy[label] = response[label] if response is not None else float("nan")
     return row_copy
 
 
@@ -61,7 +102,7 @@ def apply_filter_module(row):
 def filter_questions(df, max_workers=30):
     ret = []
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+    with ContextThreadPoolExecutor(max_workers=max_workers) as executor:
         futures = []
         for row_idx, row in df.iterrows():
             futures.append(
@@ -73,6 +114,35 @@ def filter_questions(df, max_workers=30):
             
     ret = pd.DataFrame(ret).sort_index()
     return ret
+
+async def async_filter_questions(df):
+    """
+    Async version of filter_questions
+    """
+    ret = await gather_with_limit([async_apply_filter_module(row) for row_idx, row in df.iterrows()])
+    ret = pd.DataFrame(ret).sort_index()
+    return ret
+
+def batch_filter_questions(df):
+    """
+    Batch-job version of filter_questions
+    """
+    results = run_batch({str(row_idx): build_filter_request(row) for row_idx, row in df.iterrows()},
+                        stage="filter", family="filter")
+    ret = []
+    for row_idx, row in df.iterrows():
+        try:
+            response = results[str(row_idx)]
+            if isinstance(response, BatchItemError):
+                raise response
+            response = parse_response(response, "filter")
+        except (BatchItemError, MalformedResponseError) as e:
+            logging.warning(f"Failed to get filter response for question {row_idx}: {e}")
+            response = None
+        ret.append(merge_filter_response(row, response))
+    ret = pd.DataFrame(ret).sort_index()
+    return ret
+
 def main(args):
     df=pd.read_csv(f'{args.output}/sampled_questions.csv', index_col=0)
     # remove if sampled questions also have hp note
@@ -80,7 +150,14 @@ def main(args):
     df =df.merge(hp, on="person_id", how="left")[['question', 'answer',  'reference_timestamp', 'reason_for_admission', 'clinical_summary', 'visit_type', 'note']]
     df['question_id'] = df.index
     # end remove
-    filter_questions(df).to_csv(f'{args.output}/sampled_questions_filter.csv', index=False)
+    if args.engine == "async":
+        df = run_async(async_filter_questions(df))
+    elif args.engine == "batch":
+        df = batch_filter_questions(df)
+    else:
+        df = filter_questions(df)
+    df.to_csv(f'{args.output}/sampled_questions_filter.csv', index=False)
+    telemetry.report()
 
 
 
@@ -4,14 +4,23 @@ import os
 import json 
 
 # pip
-from google.cloud import bigquery
 import pandas as pd
 import tqdm
 
 # initialize google cloud
 project = 'example-project'
 os.environ['GCLOUD_PROJECT'] = project
-client = bigquery.Client(project= project)
+client = None
+
+def get_client():
+    """
+    Create the BigQuery client on first use so the formatting helpers can be imported offline
+    """
+    global client
+    if client is None:
+        from google.cloud import bigquery
+        client = bigquery.Client(project= project)
+    return client
 
 # parse args
 def parse_args():
@@ -109,24 +118,31 @@ def pull(id, prefix):
         LIMIT 1000;
         """
 
-        query_job =client.query(QUERY)   
+        query_job =get_client().query(QUERY)   
         df=query_job.to_dataframe()
         df.to_csv(f'{prefix}/{id}_allrecords.csv', index=False)
     return df
 
 
 
+def format_patient(id, prefix):
+    """
+    Pull the notes of one patient and write its H&P and note subset files
+    """
+    df = pull(id, prefix)
+    # if df.shape[0] > 100:
+    #     return
+    index = extract_HP(df, id, prefix)
+    # standardize to project conventions
+    df.rename(columns={"note_DATETIME": 'note_date', 'note_text': 'text'}, inplace=True)
+    df['note_date'] = df['note_date'].astype(str)
+    format_records(df, id, prefix, index)
+
+
 def main(args):
     id_list = args.id.split(',')
     for id in tqdm.tqdm(id_list):
-        df = pull(id, args.prefix)
-        # if df.shape[0] > 100:
-        #     continue
-        index = extract_HP(df, id, args.prefix)
-        # standardize to project conventions
-        df.rename(columns={"note_DATETIME": 'note_date', 'note_text': 'text'}, inplace=True)
-        df['note_date'] = df['note_date'].astype(str)
-        format_records(df, id, args.prefix, index)
+        format_patient(id, args.prefix)
         
     
 if __name__ == "__main__":
@@ -3,16 +3,26 @@ import argparse
 from typing import Union, List
 import json
 import time
+import asyncio
 import concurrent.futures
 import logging
+import functools
 import os
 
 # pip
-import tqdm 
 import pandas as pd
 
 from prompts.generate_questions import GENERATE_HP_SYS, GENERATE_SYS, GENERATE_USER, FACT_SYS, HP_SYS, TIMESTAMP_SYS
-from utils import get_question
+from utils import get_question, async_get_question, structured_value, async_structured_value, run_async, worker_pool
+from structured import response_format, MalformedResponseError
+from cohort import run_cohort, patient_log, COHORT_PATIENTS
+from fact_store import read_facts
+from timeline import FactTimeline
+from hierarchy import condense_facts, async_condense_facts
+import telemetry
+
+RECENT_DAYS = 730 # "single hop recent" events are less than 2 years before the reference timestamp
+FACT_WINDOWS = ["all", "history", "recent", "past"] # facts sent to the Both/Fact parts, see window_timeline
 
 def system_prompt_builder(timestamp: str,
                         fact_list: Union[List[str], None] = None, 
@@ -29,6 +39,58 @@ def system_prompt_builder(timestamp: str,
         return GENERATE_HP_SYS + TIMESTAMP_SYS.format(TIMESTAMP=timestamp) + HP_SYS.format(NOTE=note)
     
 
+def window_timeline(timeline, timestamp, window="all"):
+    """
+    Timeline of the facts in a window relative to the reference timestamp:
+    all: every fact in its original order
+    history: facts dated on or before the reference, then the undated ones
+    recent / past: facts dated less / more than RECENT_DAYS before the reference
+    Windowed facts are in chronological order.
+    """
+    if window == "all":
+        return timeline
+    try:
+        reference = pd.Timestamp(timestamp)
+    except ValueError:
+        logging.warning(f"Unparseable reference timestamp {timestamp!r}, sending all facts")
+        return timeline
+    if window == "history":
+        return timeline.subset(timeline.until(reference), undated=True)
+    if window == "recent":
+        return timeline.subset(timeline.last(reference, RECENT_DAYS))
+    return timeline.subset(timeline.older_than(reference, RECENT_DAYS))
+
+
+def prepare_facts(fact_list, hp, window="all", scaling="hierarchical"):
+    """
+    Facts sent with a patient's prompts: those in `window`, condensed by period and
+    category (hierarchy.py) if they exceed the prompt budget and scaling="hierarchical"
+    """
+    timeline = FactTimeline.of(fact_list)
+    windowed = window_timeline(timeline, hp['reference_timestamp'], window)
+    if scaling == "hierarchical" and len(windowed):
+        windowed = condense_facts(windowed, hp['reference_timestamp'])
+    log_prepared(timeline, windowed, window, scaling)
+    return windowed.facts
+
+
+async def async_prepare_facts(fact_list, hp, window="all", scaling="hierarchical"):
+    """
+    Async version of prepare_facts
+    """
+    timeline = FactTimeline.of(fact_list)
+    windowed = window_timeline(timeline, hp['reference_timestamp'], window)
+    if scaling == "hierarchical" and len(windowed):
+        windowed = await async_condense_facts(windowed, hp['reference_timestamp'])
+    log_prepared(timeline, windowed, window, scaling)
+    return windowed.facts
+
+
+def log_prepared(timeline, prepared, window, scaling):
+    if window != "all" or len(prepared) != len(timeline):
+        logging.info(f"Fact window {window}, scaling {scaling}: sending {len(prepared)} of {len(timeline)} facts")
+
+
 def build_messages(part, fact_list, hp):
     """
     Build initial messages dict for a given part.
@@ -46,6 +108,7 @@ def build_messages(part, fact_list, hp):
     return {
         "generationConfig": {
             "maxOutputTokens": 65535,
+            **response_format("questions"),
         },
         "system_instruction": {
             "parts": [{"text": prompt}]
@@ -53,9 +116,11 @@ def build_messages(part, fact_list, hp):
         "contents": [],
     }
 
-def run_part_conversation(part, fact_list, hp):
+def run_part_conversation(part, fact_list, hp, on_question=None):
     """
     Runs all iterations sequentially for a given part.
+    If `on_question` is given the responses are streamed and each question (tagged
+    with part and iteration) is passed to it as soon as it is parsed.
     """
     messages = build_messages(part, fact_list, hp)
     results = []
@@ -69,34 +134,86 @@ def run_part_conversation(part, fact_list, hp):
         )
 
         # Get assistant's response
-        result = get_question(messages)
+        # the system prompt (facts + H&P) is identical on every turn, send it as a cached prefix
+        result = get_question(messages, stage="generate",
+                              on_item=tag_question(on_question, part, i),
+                              cache_prefix=True,
+                              family="questions")
+        try:
+            questions = structured_value(messages, result, "questions", stage="generate", cache_prefix=True)
+        except MalformedResponseError as e:
+            logging.warning(f"Failed to decode for part={part}, iter={i}: {e}")
+            questions = []
+        results.extend(record_turn(messages, result, questions, part, i))
+
+    return results
+
+
+async def async_run_part_conversation(part, fact_list, hp):
+    """
+    Async version of run_part_conversation
+    """
+    messages = build_messages(part, fact_list, hp)
+    results = []
 
-        # Append assistant response
+    for i in range(3):
+        logging.info(f"Part={part}, Iter={i}: sending request")
         messages["contents"].append(
-            {"role": "model", "parts": [{"text": result}]}
+            {"role": "user", "parts": [{"text": GENERATE_USER}]}
         )
-
-        # Decode result
+        result = await async_get_question(messages, stage="generate", cache_prefix=True, family="questions")
         try:
-            for item in json.loads(result[7:-3]):
-                item["part"] = part
-                item["iteration"] = i
-                results.append(item)
-        except Exception as e:
+            questions = await async_structured_value(messages, result, "questions", stage="generate", cache_prefix=True)
+        except MalformedResponseError as e:
             logging.warning(f"Failed to decode for part={part}, iter={i}: {e}")
+            questions = []
+        results.extend(record_turn(messages, result, questions, part, i))
 
     return results
 
 
-def run_parallel_parts(fact_list, hp, max_workers=3):
+def tag_question(on_question, part, i):
+    """
+    Wrap a streaming callback so partial questions carry their part and iteration
+    """
+    if on_question is None:
+        return None
+
+    def on_item(item):
+        if isinstance(item, dict):
+            item = {**item, "part": part, "iteration": i}
+        on_question(item)
+    return on_item
+
+
+def record_turn(messages, result, questions, part, i):
+    """
+    Append the assistant response to the conversation and tag its decoded questions
+    """
+    # Append assistant response
+    messages["contents"].append(
+        {"role": "model", "parts": [{"text": result}]}
+    )
+
+    items = []
+    for item in questions:
+        item["part"] = part
+        item["iteration"] = i
+        items.append(item)
+    return items
+
+
+def run_parallel_parts(fact_list, hp, max_workers=3, on_question=None, window="all", scaling="hierarchical"):
     """
     Parallelize across different input types, preserve sequential iterations inside each part.
+    `fact_list` is a list of facts or a FactTimeline; see prepare_facts for `window` and `scaling`.
     """
     result_list = []
     parts = ["Both", "Fact", "H&P"]
+    fact_list = prepare_facts(fact_list, hp, window, scaling)
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = {executor.submit(run_part_conversation, part, fact_list, hp): part for part in parts}
+    with worker_pool(max_workers) as executor:
+        futures = {executor.submit(run_part_conversation, part, fact_list, hp, on_question): part for part in parts}
 
         for future in concurrent.futures.as_completed(futures):
             part = futures[future]
@@ -109,6 +226,28 @@ def run_parallel_parts(fact_list, hp, max_workers=3):
 
     return result_list
 
+
+async def async_run_parallel_parts(fact_list, hp, window="all", scaling="hierarchical"):
+    """
+    Async version of run_parallel_parts
+    """
+    result_list = []
+    parts = ["Both", "Fact", "H&P"]
+    fact_list = await async_prepare_facts(fact_list, hp, window, scaling)
+
+    results = await asyncio.gather(
+        *(async_run_part_conversation(part, fact_list, hp) for part in parts),
+        return_exceptions=True,
+    )
+    for part, items in zip(parts, results):
+        if isinstance(items, Exception):
+            logging.error(f"Error in part={part}: {items}")
+            continue
+        result_list.extend(items)
+        logging.info(f"Finished all iterations for part={part}, N={len(items)}")
+
+    return result_list
+
 def parse_args():
     """
     Description: Parse the arguments
@@ -133,19 +272,38 @@ def parse_args():
                         '--output', 
                         type=str, 
                         help="Output directory")
+    parser.add_argument('-e',
+                        '--engine',
+                        type=str,
+                        choices=["thread", "async"],
+                        help="Run LLM calls on a thread pool or the asyncio engine",
+                        default="thread")
+    parser.add_argument('-w',
+                        '--fact-window',
+                        type=str,
+                        choices=FACT_WINDOWS,
+                        help="Facts sent with the prompts, relative to the reference timestamp",
+                        default="all")
+    parser.add_argument('-s',
+                        '--scaling',
+                        type=str,
+                        choices=["full", "hierarchical"],
+                        help="hierarchical condenses fact lists over LLM_GENERATE_FACT_TOKENS by period and category",
+                        default="hierarchical")
+    parser.add_argument('-p',
+                        '--max-patients',
+                        type=int,
+                        help="Patients processed at once, sharing one LLM worker pool",
+                        default=COHORT_PATIENTS)
     return parser.parse_args()
 
 
 
-def main(args):
-    id_list= args.id.split(',')
-    for id in tqdm.tqdm(id_list):
-        # initialize logger
-        with open(f"{args.output}/{id}.log", 'w+'):
-            pass  
-        logging.basicConfig(format='[%(asctime)s]\t%(message)s', level=logging.INFO, filename=f"{args.output}/{id}.log")
-        logging.getLogger("LiteLLM").setLevel(logging.CRITICAL + 1)
-        logging.getLogger("httpx").setLevel(logging.WARNING + 1)
+def process_patient(args, id):
+    """
+    Generate the questions of one patient, logging to {output}/{id}.log
+    """
+    with patient_log(f"{args.output}/{id}.log", id):
         logging.info(f'Running  question generation for {id}\n')
         logging.info("--------------------------------\n")
         logging.info(f'Output: {f"{args.output}/{id}.csv"}\n')
@@ -163,27 +321,36 @@ def main(args):
             logging.info("--------------------------------\n")
             logging.info(f'Starting question generation"\n')
             logging.info("--------------------------------\n")
-            # reading the fact list
-            fact_list = pd.read_csv(f'{args.input}/{id}.tsv', delimiter='\t', index_col=0)['fact'].tolist()
+            # reading the fact list, indexed by date
+            facts = read_facts(args.input, id, columns=["fact", "fact_date"])
+            timeline = FactTimeline(facts["fact"], facts["fact_date"])
             # get hp note
             hp_info = pd.read_json(f'{args.note}/{id}_hp.json')
             hp = hp_info[hp_info['type'] == 'Full Note'].text.item()
             del hp['original_timestamp']
+            logging.info(f"{len(timeline)} facts dated {timeline.span()}, reference {hp['reference_timestamp']}")
 
             # generate questions
-            result_list = run_parallel_parts(fact_list, hp)
+            if args.engine == "async":
+                result_list = run_async(async_run_parallel_parts(timeline, hp, window=args.fact_window,
+                                                                 scaling=args.scaling))
+            else:
+                result_list = run_parallel_parts(timeline, hp, window=args.fact_window, scaling=args.scaling)
             logging.info("--------------------------------\n")
             logging.info(f'Exporting questions \n')
             logging.info("--------------------------------\n")
             # saved questions
             df = pd.DataFrame(result_list)
             df.to_csv(f'{args.output}/{id}.csv')
-        
-        # clean up logger
-        root_logger = logging.getLogger()
-        for handler in root_logger.handlers[:]:
-            handler.close()
-            root_logger.removeHandler(handler)
+
+        telemetry.log_summary(patient_id=id)
+        return df
+
+
+def main(args):
+    id_list= args.id.split(',')
+    run_cohort(id_list, functools.partial(process_patient, args), max_patients=args.max_patients)
+    telemetry.report()
 
 
 
@@ -0,0 +1,185 @@
+"""
+Hierarchical fact windowing for patients whose fact list does not fit one question
+generation prompt.
+
+Facts are partitioned by time period relative to the reference timestamp (PERIODS) and
+by clinical category (keyword rules, FACT_CATEGORIES). Each partition gets a share of
+the fact budget proportional to its size. A partition larger than its share is condensed
+by the LLM, which picks its most important facts by index, so the selected facts stay
+verbatim and fact_subset citations still match the fact store. The selections are
+combined in chronological order and sent to the usual question generation parts.
+
+Cost per patient is bounded regardless of chart size:
+- there is at most one condense call per partition;
+- each call carries at most PARTITION_TOKENS of facts (an oversized partition keeps
+  its most recent facts);
+- the combined list stays near GENERATE_FACT_TOKENS.
+"""
+# default
+import logging
+import os
+import re
+
+# pip
+import numpy as np
+
+# custom
+from prompts.generate_questions import CONDENSE_SYS, format_condense
+from utils import send_structured_message, async_send_structured_message, gather_with_limit, worker_pool, estimate_tokens
+from timeline import day
+
+GENERATE_FACT_TOKENS = int(os.environ.get('LLM_GENERATE_FACT_TOKENS', 100000)) # fact list budget of one generation prompt
+PARTITION_TOKENS = int(os.environ.get('LLM_PARTITION_TOKENS', 20000)) # facts sent in one condense call
+CONDENSE_WORKERS = 8 # concurrent condense calls per patient
+PERIODS = [ # (label, newest, oldest) in days before the reference timestamp
+    ("last 3 months", 0, 90),
+    ("3 to 12 months before", 90, 365),
+    ("1 to 2 years before", 365, 730),
+    ("more than 2 years before", 730, None),
+]
+FACT_CATEGORIES = { # first matching pattern wins, facts matching none are "other"
+    "medications": r"\b(mg|mcg|tablets?|capsules?|dose|dosage|prescri\w*|medications?|insulin|refill\w*)\b",
+    "laboratory tests": r"\b(lab\w*|levels?|counts?|hemoglobin|glucose|creatinine|a1c|potassium|sodium|wbc|platelets?|panel|cultures?)\b",
+    "imaging": r"\b(ct|mri|x-?ray|ultrasound|imaging|radiograph\w*|echocardiogra\w*|scan)\b",
+    "procedures and devices": r"\b(surgery|surgical|procedures?|underwent|biopsy|resection|catheteriz\w*|implant\w*|devices?|stents?|pacemaker)\b",
+    "vitals": r"\b(blood pressure|heart rate|pulse|temperature|respiratory rate|oxygen saturation|spo2|weight|bmi)\b",
+    "allergies and immunizations": r"\b(allerg\w*|vaccin\w*|immuniz\w*)\b",
+    "social and family history": r"\b(smok\w*|alcohol|tobacco|lives|family history|mother|father|sibling|employ\w*|insurance)\b",
+    "diagnoses": r"\b(diagnos\w*|history of|conditions?|disease|disorder|syndrome|cancer|failure|infection)\b",
+    "symptoms": r"\b(pain|reports?|reported|complain\w*|symptoms?|nausea|fever|cough|dyspnea|shortness of breath)\b",
+    "encounters and plan": r"\b(admit\w*|admission|discharg\w*|follow[- ]up|appointments?|referr\w*|plan|visits?)\b",
+}
+CATEGORY_PATTERNS = [(name, re.compile(pattern, re.IGNORECASE)) for name, pattern in FACT_CATEGORIES.items()]
+
+
+def fact_category(fact):
+    for name, pattern in CATEGORY_PATTERNS:
+        if pattern.search(fact):
+            return name
+    return "other"
+
+
+def period_offsets(timeline, reference):
+    """
+    (label, offsets) of every time period: PERIODS, facts dated after the reference and undated facts
+    """
+    try:
+        ref = day(reference)
+    except ValueError:
+        return [("all dates", timeline.offsets), ("undated", timeline.undated)]
+    periods = [("after the reference", timeline.between(start=ref + 1))]
+    for label, newest, oldest in PERIODS:
+        start = None if oldest is None else ref - oldest + 1
+        periods.append((label, timeline.between(start, ref - newest + 1)))
+    periods.append(("undated", timeline.undated))
+    return periods
+
+
+def plan_partitions(timeline, reference, budget=GENERATE_FACT_TOKENS, partition_tokens=PARTITION_TOKENS):
+    """
+    Split the facts into (period, category) partitions with the number of facts each may keep
+
+    Returns:
+        list of dicts (period, category, offsets, keep), or None if the facts fit the budget
+    """
+    total_tokens = estimate_tokens(str(timeline.facts))
+    if total_tokens <= budget:
+        return None
+    share = budget / total_tokens
+    partitions = []
+    for period, offsets in period_offsets(timeline, reference):
+        by_category = {}
+        for offset in offsets:
+            by_category.setdefault(fact_category(timeline.facts[offset]), []).append(offset)
+        for category, members in by_category.items():
+            members = np.asarray(members, dtype=int)
+            keep = max(1, int(len(members) * share))
+            if keep < len(members):
+                # oldest first within a period, so the most recent facts are the ones that fit
+                while len(members) > keep and estimate_tokens(str(timeline.select(members))) > partition_tokens:
+                    members = members[len(members) // 4 or 1:]
+            partitions.append({"period": period, "category": category, "offsets": members, "keep": keep})
+    return partitions
+
+
+def condense_request(timeline, partition):
+    return format_condense(partition["period"], partition["category"],
+                           {str(i): timeline.facts[o] for i, o in enumerate(partition["offsets"])},
+                           partition["keep"])
+
+
+def selected_offsets(partition, response):
+    """
+    Offsets of the facts the LLM selected, at most `keep` of them
+    """
+    offsets = partition["offsets"]
+    picked = dict.fromkeys(offsets[idx] for idx in response["selected_fact_indices"] if 0 <= idx < len(offsets))
+    return list(picked)[:partition["keep"]]
+
+
+def fallback_offsets(partition, error):
+    logging.warning(f"Condensing {partition['period']} / {partition['category']} failed ({error}), "
+                    f"keeping its {partition['keep']} most recent facts")
+    return list(partition["offsets"][-partition["keep"]:])
+
+
+def condense_partition(timeline, partition):
+    if len(partition["offsets"]) <= partition["keep"]:
+        return list(partition["offsets"])
+    try:
+        response = send_structured_message(system_instructions=CONDENSE_SYS,
+                                           user_prompt=condense_request(timeline, partition),
+                                           family="condense",
+                                           stage="condense")
+        return selected_offsets(partition, response)
+    except Exception as e:
+        return fallback_offsets(partition, e)
+
+
+async def async_condense_partition(timeline, partition):
+    if len(partition["offsets"]) <= partition["keep"]:
+        return list(partition["offsets"])
+    try:
+        response = await async_send_structured_message(system_instructions=CONDENSE_SYS,
+                                                       user_prompt=condense_request(timeline, partition),
+                                                       family="condense",
+                                                       stage="condense")
+        return selected_offsets(partition, response)
+    except Exception as e:
+        return fallback_offsets(partition, e)
+
+
+def combine(timeline, partitions, selections):
+    """
+    Timeline of the selected facts: dated facts in chronological order, then the undated ones
+    """
+    chosen = set(o for selection in selections for o in selection)
+    dated = [o for o in timeline.offsets if o in chosen]
+    undated = [o for o in timeline.undated if o in chosen]
+    condensed = timeline.subset(np.asarray(dated + undated, dtype=int))
+    logging.info(f"Condensed {len(timeline)} facts in {len(partitions)} partitions to {len(condensed)} "
+                 f"(~{estimate_tokens(str(condensed.facts))} tokens)")
+    return condensed
+
+
+def condense_facts(timeline, reference, budget=GENERATE_FACT_TOKENS, max_workers=CONDENSE_WORKERS):
+    """
+    The timeline itself if it fits the budget, otherwise its condensed version
+    """
+    partitions = plan_partitions(timeline, reference, budget)
+    if partitions is None:
+        return timeline
+    with worker_pool(max_workers) as executor:
+        selections = list(executor.map(lambda p: condense_partition(timeline, p), partitions))
+    return combine(timeline, partitions, selections)
+
+
+async def async_condense_facts(timeline, reference, budget=GENERATE_FACT_TOKENS, max_workers=CONDENSE_WORKERS):
+    """
+    Async version of condense_facts
+    """
+    partitions = plan_partitions(timeline, reference, budget)
+    if partitions is None:
+        return timeline
+    selections = await gather_with_limit((async_condense_partition(timeline, p) for p in partitions), limit=max_workers)
+    return combine(timeline, partitions, selections)
@@ -0,0 +1,79 @@
+"""
+Append-only journal of finished extraction requests.
+
+Every chunk (or packed note) that was sent to the LLM gets one JSONL line keyed by a
+hash of its note and text: {"key", "status": "ok", ...record} on success or
+{"key", "status": "failed", "error"} on failure. The last line for a key wins, so a
+rerun skips completed chunks and retries only the missing or failed ones. Lines are
+flushed as they are written; a line cut off by a crash is dropped on load.
+"""
+# default
+import hashlib
+import json
+import logging
+import os
+import threading
+
+
+def chunk_key(note_date, note_title, text):
+    """
+    Journal key of one chunk of a note
+    """
+    payload = json.dumps([str(note_date), str(note_title), text])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+
+class ChunkJournal:
+    def __init__(self, path):
+        self.path = path
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.run_failures = set() # keys that failed in this process and have not succeeded since
+        if os.path.exists(path):
+            complete = 0 # bytes up to the end of the last complete line
+            with open(path, "rb") as ifile:
+                for line in ifile:
+                    if not line.endswith(b"\n"):
+                        break
+                    complete += len(line)
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        logging.info(f"Skipping incomplete journal line in {path}")
+                        continue
+                    self._entries[entry["key"]] = entry
+            if complete < os.path.getsize(path):
+                # a line cut off by a crash would run into the next appended record
+                logging.info(f"Dropping incomplete last journal line in {path}")
+                os.truncate(path, complete)
+        self._file = open(path, "a")
+
+    def __len__(self):
+        return sum(1 for entry in self._entries.values() if entry["status"] == "ok")
+
+    def _append(self, entry):
+        with self._lock:
+            self._entries[entry["key"]] = entry
+            self._file.write(json.dumps(entry, default=str) + "\n")
+            self._file.flush()
+
+    def done(self, key):
+        entry = self._entries.get(key)
+        return entry is not None and entry["status"] == "ok"
+
+    def get(self, key):
+        """
+        Journaled record of a completed chunk, or None
+        """
+        return self._entries[key] if self.done(key) else None
+
+    def record(self, key, record):
+        self._append({"key": key, "status": "ok", **record})
+        self.run_failures.discard(key)
+
+    def fail(self, key, error):
+        self._append({"key": key, "status": "failed", "error": str(error)})
+        self.run_failures.add(key)
+
+    def close(self):
+        self._file.close()
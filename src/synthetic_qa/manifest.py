@@ -0,0 +1,105 @@
+"""
+Note manifest stored next to a patient's fact files ({id}_manifest.json).
+
+For every note that went into {id}_facts.parquet it records the note date, title, a hash of
+the text and the facts extracted from it. On a refresh, comparing the manifest to the
+current notes tells which notes are new or changed (to be extracted) and which facts
+are stale (from changed or deleted notes, to be dropped), so only the delta is sent
+to the LLM.
+"""
+# default
+import hashlib
+import json
+import os
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def note_keys(notes_df):
+    """
+    Stable key per note: the note_id column if present, otherwise date and title
+    (numbered when several notes share both)
+    """
+    if "note_id" in notes_df.columns:
+        return [str(note_id) for note_id in notes_df["note_id"]]
+    seen = {}
+    keys = []
+    for note_date, note_title in zip(notes_df["note_date"], notes_df["note_title"]):
+        base = f"{note_date}|{note_title}"
+        seen[base] = seen.get(base, 0) + 1
+        keys.append(f"{base}|{seen[base] - 1}")
+    return keys
+
+
+class NoteManifest:
+    def __init__(self, notes=None):
+        self.notes = notes or {} # note key -> {"note_date", "note_title", "hash", "facts"}
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as ifile:
+            return cls(json.load(ifile)["notes"])
+
+    def save(self, path):
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as ofile:
+            json.dump({"notes": self.notes}, ofile, indent=1)
+        os.replace(tmp, path)
+
+    @classmethod
+    def from_records(cls, notes_df, fact_dict):
+        """
+        Build the manifest from the notes and the chunk records of their extraction
+        """
+        manifest = cls()
+        manifest.update(notes_df, fact_dict)
+        return manifest
+
+    def update(self, notes_df, fact_dict, keys=None):
+        """
+        Add (or replace) the notes in notes_df with the facts of their chunk records
+
+        Args:
+            keys (dict): notes_df index -> note key, computed on the full note table when
+                notes_df is a subset (the date|title numbering depends on the other notes)
+        """
+        if keys is None:
+            keys = dict(zip(notes_df.index, note_keys(notes_df)))
+        facts = {}
+        for record in fact_dict:
+            facts.setdefault(record["note_number"], []).extend(record["facts"])
+        for row_idx, row in notes_df.iterrows():
+            self.notes[keys[row_idx]] = {
+                "note_date": str(row["note_date"]),
+                "note_title": str(row["note_title"]),
+                "hash": content_hash(row["text"]),
+                "facts": facts.get(row_idx, []),
+            }
+
+    def diff(self, notes_df):
+        """
+        Compare with the current notes
+
+        Returns:
+            (boolean mask of notes_df rows that are new or changed,
+             keys of manifest notes that changed or no longer exist)
+        """
+        keys = note_keys(notes_df)
+        fresh = []
+        for key, text in zip(keys, notes_df["text"]):
+            entry = self.notes.get(key)
+            fresh.append(entry is None or entry["hash"] != content_hash(text))
+        current = dict(zip(keys, fresh))
+        stale = [key for key in self.notes if key not in current or current[key]]
+        return fresh, stale
+
+    def drop(self, keys):
+        """
+        Remove notes; returns their facts
+        """
+        facts = []
+        for key in keys:
+            facts.extend(self.notes.pop(key)["facts"])
+        return facts
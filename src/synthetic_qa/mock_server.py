@@ -0,0 +1,540 @@
+"""
+Local stand-in for the Gemini streamGenerateContent endpoint.
+
+Answers with the same streamed JSON-array format `utils.get_question` reads, so the
+whole pipeline can be run and load-tested offline. Each prompt family gets a canned
+response. These are deterministic and shaped like the real output (extraction
+turns sentences into dated claims, dedup flags exact repeats), so downstream
+parsing and fact counts stay realistic. Latency and 429/5xx failures are
+injected from configurable distributions. POST .../cachedContents registers a
+context-cache entry that later requests can refer to with "cachedContent".
+Requests with responseMimeType application/json get bare JSON instead of a fenced
+block; --rate-malformed breaks responses off mid-array, and repair turns
+(structured.REPAIR_USER) are answered with only the items that were missing.
+
+Example usage:
+    python mock_server.py --port 8080 --latency lognormal:0.0,0.5 --token-latency 0.001 --rate-429 0.05
+    GEMINI_URL=http://127.0.0.1:8080/generate SECURE_GPT_KEY=test python extract_facts.py ...
+"""
+# default
+import argparse
+import gzip
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# custom
+from prompts.extract_facts import EXTRACT_SYS, DEDUP_SYS
+from prompts.generate_questions import GENERATE_SYS, GENERATE_HP_SYS, CONDENSE_SYS
+from prompts.sample_questions import TOPIC_SYS
+from prompts.filter_questions import FILTER_SYS
+from prompts.process_hp import HP_SYS as PROCESS_HP_SYS
+from structured import REPAIR_USER
+
+CHUNK_CHARS = 400 # characters of model output per streamed chunk
+DATE_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2}")
+REPAIR_PREFIX = REPAIR_USER.split("\n")[0]
+FENCE_PREFIX, FENCE_SUFFIX = "```json\n", "\n```"
+TOPICS = ["Comorbidities", "Procedures/Surgeries", "Radiology/Imaging", "Laboratory tests",
+          "Prescriptions", "Vitals", "Appointments", "Assessment & Plan", "None"]
+
+
+def parse_distribution(spec):
+    """
+    Parse a latency spec into a sampling function: fixed:S, uniform:LO,HI,
+    lognormal:MU,SIGMA or exponential:MEAN (all in seconds)
+    """
+    kind, _, params = spec.partition(":")
+    values = [float(v) for v in params.split(",") if v]
+    if kind == "fixed":
+        return lambda rng: values[0]
+    if kind == "uniform":
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "lognormal":
+        return lambda rng: rng.lognormvariate(values[0], values[1])
+    if kind == "exponential":
+        return lambda rng: rng.expovariate(1 / values[0])
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+def prompt_family(messages):
+    """
+    Identify which pipeline prompt a request was built from
+    """
+    system = "".join(p.get("text", "") for p in messages.get("system_instruction", {}).get("parts", []))
+    if system == EXTRACT_SYS or system.startswith(EXTRACT_SYS):
+        return "extract"
+    if system == DEDUP_SYS:
+        return "dedup"
+    if system == CONDENSE_SYS:
+        return "condense"
+    if system.startswith(GENERATE_SYS) or system.startswith(GENERATE_HP_SYS):
+        return "generate"
+    if system == TOPIC_SYS:
+        return "topic"
+    if system == FILTER_SYS:
+        return "filter"
+    if system == PROCESS_HP_SYS:
+        return "hp"
+    return "other"
+
+
+def last_user_text(messages):
+    for content in reversed(messages.get("contents", [])):
+        if content.get("role") == "user":
+            return "".join(p.get("text", "") for p in content.get("parts", []))
+    return ""
+
+
+def fence(obj):
+    return FENCE_PREFIX + json.dumps(obj, indent=1) + FENCE_SUFFIX
+
+
+def unfence(text):
+    if text.startswith(FENCE_PREFIX) and text.endswith(FENCE_SUFFIX):
+        return text[len(FENCE_PREFIX):-len(FENCE_SUFFIX)]
+    return text
+
+
+def json_mode(messages):
+    return messages.get("generationConfig", {}).get("responseMimeType") == "application/json"
+
+
+def output_array(value):
+    """
+    (items, wrap) of the array in a response value: the top-level array or the only key of an object
+    """
+    if isinstance(value, list):
+        return value, lambda items: items
+    if isinstance(value, dict) and len(value) == 1 and isinstance(next(iter(value.values())), list):
+        key = next(iter(value))
+        return value[key], lambda items: {key: items}
+    return None, None
+
+
+def malformed_text(text, json_output):
+    """
+    Break a response off after half of its array items (objects are cut in the middle)
+    """
+    items, wrap = output_array(json.loads(unfence(text)))
+    if items is None:
+        return text[:len(text) // 2]
+    body = json.dumps(wrap(items[:len(items) // 2]))
+    broken = body[:-2 if body.endswith("]}") else -1] + ', "cut off'
+    return broken if json_output else FENCE_PREFIX + broken + FENCE_SUFFIX
+
+
+def repair_text(messages, seed):
+    """
+    Answer a repair turn with the items of the original answer that the previous response lacks
+    """
+    original = dict(messages, contents=messages["contents"][:-2])
+    previous = "".join(p.get("text", "") for p in messages["contents"][-2].get("parts", []))
+    full = canned_text(original, seed)
+    items, wrap = output_array(json.loads(unfence(full)))
+    if items is None:
+        return full
+    missing = wrap([item for item in items if json.dumps(item) not in previous])
+    return json.dumps(missing) if json_mode(messages) else fence(missing)
+
+
+def note_claims(note):
+    date = str(note.get("note_date", ""))[:10]
+    claims = []
+    for sentence in re.split(r"(?<=[.!?])\s+|\n+", note.get("text", "")):
+        sentence = " ".join(sentence.split())
+        if len(sentence) < 12:
+            continue
+        event_date = DATE_PATTERN.search(sentence)
+        claims.append(f"{sentence[:160].rstrip('.')} ({event_date.group(0) if event_date else date})")
+    return claims
+
+
+def respond_extract(messages, rng):
+    note = json.loads(last_user_text(messages))
+    if "notes" in note:
+        # packed request of several short notes
+        return fence({"notes": [{"note_id": n["note_id"], "claims": note_claims(n)} for n in note["notes"]]})
+    return fence({"claims": note_claims(note)})
+
+
+def respond_dedup(messages, rng):
+    facts = json.loads(last_user_text(messages))["input_fact_list"]
+    seen = set()
+    redundant = []
+    for idx, fact in facts.items():
+        key = " ".join(fact.lower().split())
+        if key in seen:
+            redundant.append(int(idx))
+        seen.add(key)
+    return fence({"redundant_fact_indices": redundant})
+
+
+def respond_condense(messages, rng):
+    request = json.loads(last_user_text(messages))
+    indices = [int(idx) for idx in request["input_fact_list"]]
+    return fence({"selected_fact_indices": sorted(rng.sample(indices, min(len(indices), request["max_facts"])))})
+
+
+def respond_generate(messages, rng):
+    system = "".join(p.get("text", "") for p in messages["system_instruction"]["parts"])
+    timestamp = DATE_PATTERN.search(system.split("Admission Information:")[-1])
+    facts = re.findall(r"'([^']*\(\d{4}-\d{2}-\d{2}\))'", system)
+    turn = sum(1 for c in messages.get("contents", []) if c.get("role") == "user")
+    questions = []
+    for i, question_type in enumerate(["single_hop_recent", "single_hop_past", "multi_hop"]):
+        subset = rng.sample(facts, min(len(facts), 2 if question_type == "multi_hop" else 1)) if facts else []
+        questions.append({
+            "question_id": i,
+            "reference_timestamp": timestamp.group(0) if timestamp else "",
+            "question_type": question_type,
+            "question": f"Mock {question_type} question {turn}-{i}?",
+            "answer": "; ".join(subset) or "Not documented",
+            "fact_subset": subset,
+            "clinical_relevance_rationale": "Mock rationale",
+        })
+    return fence(questions)
+
+
+def respond_topic(messages, rng):
+    topics = rng.sample(TOPICS, 3)
+    return fence({"topic_1": topics[0], "topic_2": topics[1], "topic_3": topics[2]})
+
+
+def respond_filter(messages, rng):
+    return fence({
+        "question-relevance": rng.choice(["Yes", "No, but for another visit", "No, never relevant"]),
+        "question-defined": rng.choice(["Yes", "No"]),
+        "question-rephrase": rng.choice(["Yes", "No"]),
+        "explanation": "Mock explanation",
+    })
+
+
+def respond_hp(messages, rng):
+    return fence({
+        "clinical_summary": "Mock patient with relevant comorbidities.",
+        "reason_for_admission": "Mock reason for admission",
+    })
+
+
+def respond_other(messages, rng):
+    return fence({"text": "mock"})
+
+
+RESPONDERS = {
+    "extract": respond_extract,
+    "dedup": respond_dedup,
+    "generate": respond_generate,
+    "topic": respond_topic,
+    "condense": respond_condense,
+    "filter": respond_filter,
+    "hp": respond_hp,
+    "other": respond_other,
+}
+
+
+def canned_text(messages, seed=42):
+    """
+    Model output for a request; the same request always gets the same response,
+    independent of arrival order
+    """
+    if last_user_text(messages).startswith(REPAIR_PREFIX):
+        return repair_text(messages, seed)
+    digest = hashlib.sha256(json.dumps(messages, sort_keys=True).encode("utf-8")).hexdigest()
+    text = RESPONDERS[prompt_family(messages)](messages, random.Random(f"{seed}-{digest}"))
+    return unfence(text) if json_mode(messages) else text
+
+
+def canned_response(messages, seed=42):
+    """
+    Non-streamed GenerateContentResponse for a request (used by the local batch executor)
+    """
+    text = canned_text(messages, seed)
+    prompt_tokens = len(json.dumps(messages)) // 4
+    output_tokens = len(text) // 4 + 1
+    return {
+        "candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "finishReason": "STOP"}],
+        "usageMetadata": {
+            "promptTokenCount": prompt_tokens,
+            "candidatesTokenCount": output_tokens,
+            "totalTokenCount": prompt_tokens + output_tokens,
+        },
+    }
+
+
+class MockConfig:
+    def __init__(self, latency="fixed:0", token_latency=0.0, rate_429=0.0, rate_5xx=0.0,
+                 retry_after=1.0, seed=42, max_output_tokens=0, rate_malformed=0.0):
+        self.latency = parse_distribution(latency)
+        self.token_latency = token_latency # seconds per output token, spread over the chunks
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.retry_after = retry_after
+        self.seed = seed
+        self.max_output_tokens = max_output_tokens # cut responses off with MAX_TOKENS above this, 0 disables
+        self.rate_malformed = rate_malformed # share of responses broken off mid-JSON (repair turns excluded)
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "throttled": 0, "server_errors": 0, "families": {},
+                      "cached_contents": 0, "cached_requests": 0, "stale_handles": 0, "truncated": 0,
+                      "malformed": 0, "repairs": 0}
+        self.cached_contents = {} # name -> (systemInstruction, expiry)
+
+    def draw(self):
+        with self.lock:
+            return self.rng.random(), self.latency(self.rng)
+
+    def roll(self):
+        with self.lock:
+            return self.rng.random()
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def count_family(self, family):
+        with self.lock:
+            self.stats["families"][family] = self.stats["families"].get(family, 0) + 1
+
+
+class MockGeminiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep-alive, chunked streaming
+    config = None # set by make_server
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_json(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        return json.loads(body or b"{}")
+
+    def send_json(self, status, obj, extra_headers=None):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (extra_headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("stats"):
+            with self.config.lock:
+                self.send_json(200, self.config.stats)
+        else:
+            self.send_json(404, {"error": {"code": 404, "message": "Not found"}})
+
+    def do_POST(self):
+        if self.path.rstrip("/").endswith("cachedContents"):
+            self.handle_create_cache(self.read_json())
+        else:
+            self.handle_generate(self.read_json())
+
+    def handle_create_cache(self, body):
+        """
+        Register a cachedContents entry ({"model", "systemInstruction", "ttl": "<s>s"})
+        """
+        config = self.config
+        ttl = float(body.get("ttl", "3600s").rstrip("s"))
+        name = f"cachedContents/{hashlib.sha256(json.dumps(body, sort_keys=True).encode()).hexdigest()[:16]}"
+        with config.lock:
+            config.cached_contents[name] = (body.get("systemInstruction"), time.time() + ttl)
+        config.count("cached_contents")
+        self.send_json(200, {
+            "name": name,
+            "model": body.get("model"),
+            "expireTime": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() + ttl)),
+            "usageMetadata": {"totalTokenCount": len(json.dumps(body.get("systemInstruction"))) // 4},
+        })
+
+    def resolve_cached_content(self, messages):
+        """
+        Replace a cachedContent handle by the registered system instruction (None if unknown or expired)
+        """
+        config = self.config
+        with config.lock:
+            system_instruction, expiry = config.cached_contents.get(messages["cachedContent"], (None, 0))
+        if system_instruction is None or expiry < time.time():
+            return None
+        resolved = {k: v for k, v in messages.items() if k != "cachedContent"}
+        resolved["system_instruction"] = system_instruction
+        return resolved
+
+    def handle_generate(self, messages):
+        config = self.config
+        roll, latency = config.draw()
+        config.count("requests")
+        if roll < config.rate_429:
+            config.count("throttled")
+            self.send_json(429, {"error": {"code": 429, "status": "RESOURCE_EXHAUSTED"}},
+                           {"Retry-After": str(config.retry_after)})
+            return
+        if roll < config.rate_429 + config.rate_5xx:
+            config.count("server_errors")
+            time.sleep(latency)
+            self.send_json(503, {"error": {"code": 503, "status": "UNAVAILABLE"}})
+            return
+
+        cached_tokens = 0
+        if "cachedContent" in messages:
+            resolved = self.resolve_cached_content(messages)
+            if resolved is None:
+                config.count("stale_handles")
+                self.send_json(404, {"error": {"code": 404, "status": "NOT_FOUND",
+                                               "message": "CachedContent not found (or permission denied)"}})
+                return
+            config.count("cached_requests")
+            cached_tokens = len(json.dumps(resolved["system_instruction"])) // 4
+            messages = resolved
+
+        family = prompt_family(messages)
+        config.count_family(family)
+        text = canned_text(messages, config.seed)
+        if last_user_text(messages).startswith(REPAIR_PREFIX):
+            config.count("repairs")
+        elif config.rate_malformed and config.roll() < config.rate_malformed:
+            config.count("malformed")
+            text = malformed_text(text, json_mode(messages))
+        self.stream_text(messages, text, latency, cached_tokens)
+
+    def stream_text(self, messages, text, latency, cached_tokens=0):
+        prompt_tokens = len(json.dumps(messages)) // 4
+        output_tokens = len(text) // 4 + 1
+        finish_reason = "STOP"
+        if self.config.max_output_tokens and output_tokens > self.config.max_output_tokens:
+            self.config.count("truncated")
+            text = text[:self.config.max_output_tokens * 4]
+            output_tokens = self.config.max_output_tokens
+            finish_reason = "MAX_TOKENS"
+        pieces = [text[i:i + CHUNK_CHARS] for i in range(0, len(text), CHUNK_CHARS)] or [""]
+        per_piece = self.config.token_latency * output_tokens / len(pieces)
+
+        time.sleep(latency) # time to first token
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        self.write_chunk(b"[")
+        for i, piece in enumerate(pieces):
+            chunk = {"candidates": [{"content": {"role": "model", "parts": [{"text": piece}]}}]}
+            if i == len(pieces) - 1:
+                chunk["candidates"][0]["finishReason"] = finish_reason
+                chunk["usageMetadata"] = {
+                    "promptTokenCount": prompt_tokens,
+                    "candidatesTokenCount": output_tokens,
+                    "totalTokenCount": prompt_tokens + output_tokens,
+                }
+                if cached_tokens:
+                    chunk["usageMetadata"]["cachedContentTokenCount"] = cached_tokens
+            self.write_chunk(((",\r\n" if i else "") + json.dumps(chunk)).encode("utf-8"))
+            if per_piece:
+                time.sleep(per_piece)
+        self.write_chunk(b"]")
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+def make_server(host="127.0.0.1", port=0, **config):
+    """
+    Build a mock server (not yet serving); port=0 picks a free port
+    """
+    handler = type("ConfiguredMockGeminiHandler", (MockGeminiHandler,), {"config": MockConfig(**config)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def start_mock_server(host="127.0.0.1", port=0, **config):
+    """
+    Serve in a background thread.
+
+    Returns:
+        (server, url to use as utils.url)
+    """
+    server = make_server(host, port, **config)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_port}/generate"
+
+
+def parse_args():
+    """
+    Description: Parse the arguments
+    Example usage: python mock_server.py --port 8080 --latency lognormal:0.0,0.5 --rate-429 0.05
+
+    """
+    parser = argparse.ArgumentParser(description="Mock Gemini server")
+    parser.add_argument('--host',
+                        type=str,
+                        default="127.0.0.1")
+    parser.add_argument('-p',
+                        '--port',
+                        type=int,
+                        default=8080)
+    parser.add_argument('-l',
+                        '--latency',
+                        type=str,
+                        help="Time to first token: fixed:S, uniform:LO,HI, lognormal:MU,SIGMA or exponential:MEAN",
+                        default="fixed:0")
+    parser.add_argument('--token-latency',
+                        type=float,
+                        help="Seconds per output token",
+                        default=0.0)
+    parser.add_argument('--rate-429',
+                        type=float,
+                        help="Fraction of requests answered with 429",
+                        default=0.0)
+    parser.add_argument('--rate-5xx',
+                        type=float,
+                        help="Fraction of requests answered with 503",
+                        default=0.0)
+    parser.add_argument('--retry-after',
+                        type=float,
+                        help="Retry-After seconds sent with 429s",
+                        default=1.0)
+    parser.add_argument('--max-output-tokens',
+                        type=int,
+                        help="Truncate longer responses with finishReason MAX_TOKENS (0 disables)",
+                        default=0)
+    parser.add_argument('--rate-malformed',
+                        type=float,
+                        help="Share of responses broken off mid-JSON",
+                        default=0.0)
+    parser.add_argument('--seed',
+                        type=int,
+                        default=42)
+    return parser.parse_args()
+
+
+def main(args):
+    server = make_server(args.host, args.port,
+                         latency=args.latency,
+                         token_latency=args.token_latency,
+                         rate_429=args.rate_429,
+                         rate_5xx=args.rate_5xx,
+                         retry_after=args.retry_after,
+                         max_output_tokens=args.max_output_tokens,
+                         rate_malformed=args.rate_malformed,
+                         seed=args.seed)
+    print(f"Mock Gemini listening on http://{args.host}:{server.server_port}/generate")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args)
@@ -0,0 +1,290 @@
+"""
+In-process pipeline runner for phase 1 (format_data -> process_hp / extract_facts ->
+generate_questions).
+
+Instead of running every script over the whole cohort before the next one starts, each
+stage has its own worker threads and a bounded queue of patient ids. A patient moves to
+the next stage as soon as the stages it depends on are done for it (e.g. question
+generation starts once its facts are deduplicated), so the cohort makespan approaches
+the time of the slowest stage rather than the sum of all stages. A full queue blocks the
+stage feeding it, which bounds how many patients are in flight. LLM calls of all stages
+share one worker pool (see cohort.py).
+
+Example usage: python pipeline.py --id 12,34,56 --notes NOTES_DIR --facts FACTS_DIR --questions QUESTIONS_DIR --phase1 PHASE1_DIR
+"""
+# default
+import argparse
+import contextvars
+import logging
+import queue
+import threading
+import time
+
+# pip
+import pandas as pd
+import tqdm
+
+# custom
+import telemetry
+from utils import SharedWorkerPool, shared_pool, run_async
+from cohort import COHORT_WORKERS
+
+PIPELINE_QUEUE = 8 # patients waiting in front of each stage
+
+
+class StageFailed(RuntimeError):
+    """Raised by a stage function when a patient cannot move on to the next stage"""
+
+
+class Stage:
+    """
+    One pipeline step, run as fn(id) for every patient after the stages in `after`
+    """
+
+    def __init__(self, name, fn, workers=1, after=()):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.after = tuple(after)
+
+
+class PipelineRunner:
+    def __init__(self, stages, max_workers=COHORT_WORKERS, queue_size=PIPELINE_QUEUE):
+        self.stages = stages
+        self.max_workers = max_workers
+        self.queue_size = queue_size
+        self.downstream = {stage.name: [s for s in stages if stage.name in s.after] for stage in stages}
+        self._lock = threading.Lock()
+
+    def run(self, id_list):
+        """
+        Push every patient through the stages
+
+        Returns:
+            dict of id -> {stage name: result, the exception it raised, or a StageFailed
+            for stages skipped because a dependency failed}
+        """
+        self.results = {id: {} for id in id_list}
+        self.timing = {stage.name: [] for stage in self.stages} # (start, end) per patient
+        self._remaining = len(id_list) * len(self.stages)
+        self._done = threading.Event()
+        if not self._remaining:
+            return self.results
+        self.progress = tqdm.tqdm(total=self._remaining)
+        queues = {stage.name: queue.Queue(maxsize=self.queue_size) for stage in self.stages}
+
+        with SharedWorkerPool(max_workers=self.max_workers) as pool:
+            token = shared_pool.set(pool)
+            try:
+                threads = [
+                    threading.Thread(target=contextvars.copy_context().run,
+                                     args=(self._work, stage, queues), daemon=True)
+                    for stage in self.stages for _ in range(stage.workers)
+                ]
+                for thread in threads:
+                    thread.start()
+                # blocks while the first stages are busy, so patients are loaded as they are needed
+                for id in id_list:
+                    for stage in self.stages:
+                        if not stage.after:
+                            queues[stage.name].put(id)
+                self._done.wait()
+                for stage in self.stages:
+                    for _ in range(stage.workers):
+                        queues[stage.name].put(None)
+                for thread in threads:
+                    thread.join()
+            finally:
+                shared_pool.reset(token)
+                self.progress.close()
+        return self.results
+
+    def _work(self, stage, queues):
+        while True:
+            id = queues[stage.name].get()
+            if id is None:
+                return
+            start = time.monotonic()
+            with telemetry.patient_context(id):
+                try:
+                    result = stage.fn(id)
+                except Exception as e:
+                    logging.exception(f"Stage {stage.name} failed for {id}")
+                    result = e
+            for ready in self._finish(stage, id, result, start):
+                queues[ready.name].put(id)
+
+    def _finish(self, stage, id, result, start):
+        """
+        Record the outcome of a stage; returns the stages that are now ready for the patient
+        """
+        with self._lock:
+            self.timing[stage.name].append((start, time.monotonic()))
+            outcomes = self.results[id]
+            outcomes[stage.name] = result
+            finished = 1
+            ready = []
+            if isinstance(result, Exception):
+                finished += self._skip(id, stage.name)
+            else:
+                for next_stage in self.downstream[stage.name]:
+                    if next_stage.name not in outcomes and all(
+                            name in outcomes and not isinstance(outcomes[name], Exception)
+                            for name in next_stage.after):
+                        ready.append(next_stage)
+            self.progress.update(finished)
+            self._remaining -= finished
+            if self._remaining == 0:
+                self._done.set()
+        return ready
+
+    def _skip(self, id, name):
+        skipped = 0
+        for next_stage in self.downstream[name]:
+            if next_stage.name not in self.results[id]:
+                self.results[id][next_stage.name] = StageFailed(f"{name} failed")
+                skipped += 1 + self._skip(id, next_stage.name)
+        return skipped
+
+    def summary(self):
+        """
+        Per-stage busy time and span (first start to last end) of the last run
+        """
+        rows = {}
+        for name, spans in self.timing.items():
+            if spans:
+                rows[name] = {
+                    "patients": len(spans),
+                    "busy_s": sum(end - start for start, end in spans),
+                    "span_s": max(end for _, end in spans) - min(start for start, _ in spans),
+                }
+        return rows
+
+
+def phase1_stages(args):
+    """
+    Stages of run_generate_question_phase1.sh, with its flags mapped onto each script's args
+    """
+    import format_data
+    import process_hp
+    import extract_facts
+    import generate_questions
+
+    def format_stage(id):
+        format_data.format_patient(id, args.notes)
+
+    def hp_stage(id):
+        row = pd.Series(process_hp.load_hp(args.notes, id))
+        if args.engine == "async":
+            return run_async(process_hp.async_apply_hp_module(row))
+        return process_hp.apply_hp_module(row)
+
+    extract_args = argparse.Namespace(input=args.notes, output=args.facts, engine=args.engine,
+                                      dedup_prefilter=args.dedup_prefilter,
+                                      allow_failed_chunks=args.allow_failed_chunks)
+
+    def extract_stage(id):
+        deduped_list = extract_facts.process_patient(extract_args, id)
+        if deduped_list is None:
+            raise StageFailed("fact extraction has failed chunks")
+        return len(deduped_list)
+
+    # question generation is a multi-turn conversation and has no batch mode
+    generate_args = argparse.Namespace(input=args.facts, note=args.notes, output=args.questions,
+                                       engine="async" if args.engine == "async" else "thread",
+                                       fact_window=args.fact_window, scaling=args.scaling)
+
+    def generate_stage(id):
+        return len(generate_questions.process_patient(generate_args, id))
+
+    stages = [
+        Stage("hp", hp_stage, workers=args.hp_workers, after=("format",)),
+        Stage("extract", extract_stage, workers=args.extract_workers, after=("format",)),
+        Stage("generate", generate_stage, workers=args.generate_workers, after=("extract",)),
+    ]
+    if args.skip_format:
+        return [Stage(s.name, s.fn, s.workers, tuple(a for a in s.after if a != "format")) for s in stages]
+    return [Stage("format", format_stage, workers=args.format_workers)] + stages
+
+
+def parse_args():
+    """
+    Description: Parse the arguments
+    Example usage: python pipeline.py --id 12,34,56 --notes NOTES_DIR --facts FACTS_DIR --questions QUESTIONS_DIR --phase1 PHASE1_DIR
+
+    """
+    parser = argparse.ArgumentParser(description="Phase 1 pipeline")
+    parser.add_argument('-i',
+                        '--id',
+                        type=str,
+                        help = "List of IDs, separated by commmas",
+                        default="12345678")
+    parser.add_argument('--notes',
+                        type=str,
+                        help="Note directory (format_data prefix, extract_facts input)")
+    parser.add_argument('--facts',
+                        type=str,
+                        help="Fact directory")
+    parser.add_argument('--questions',
+                        type=str,
+                        help="Question directory")
+    parser.add_argument('--phase1',
+                        type=str,
+                        help="Output directory of hp_combined.csv")
+    parser.add_argument('-e',
+                        '--engine',
+                        type=str,
+                        choices=["thread", "async", "batch"],
+                        help="Run LLM calls on a thread pool, the asyncio engine or as batch jobs (extraction only)",
+                        default="thread")
+    parser.add_argument('--dedup-prefilter',
+                        type=str,
+                        choices=["lsh", "none"],
+                        default="lsh")
+    parser.add_argument('--allow-failed-chunks',
+                        action='store_true')
+    parser.add_argument('--fact-window',
+                        type=str,
+                        choices=["all", "history", "recent", "past"],
+                        help="Facts sent with the question generation prompts (generate_questions.py)",
+                        default="all")
+    parser.add_argument('--scaling',
+                        type=str,
+                        choices=["full", "hierarchical"],
+                        help="Condense fact lists over the generation prompt budget (generate_questions.py)",
+                        default="hierarchical")
+    parser.add_argument('--skip-format',
+                        action='store_true',
+                        help="Notes are already pulled and formatted")
+    parser.add_argument('--format-workers', type=int, default=2, help="Concurrent BigQuery pulls")
+    parser.add_argument('--hp-workers', type=int, default=2)
+    parser.add_argument('--extract-workers', type=int, default=4)
+    parser.add_argument('--generate-workers', type=int, default=4)
+    parser.add_argument('--max-workers', type=int, default=COHORT_WORKERS, help="Shared LLM worker threads")
+    return parser.parse_args()
+
+
+def main(args):
+    id_list = args.id.split(',')
+    runner = PipelineRunner(phase1_stages(args), max_workers=args.max_workers)
+    start = time.monotonic()
+    results = runner.run(id_list)
+    elapsed = time.monotonic() - start
+
+    hp_rows = [results[id]["hp"] for id in id_list if isinstance(results[id].get("hp"), pd.Series)]
+    if hp_rows:
+        pd.DataFrame(hp_rows).to_csv(f'{args.phase1}/hp_combined.csv', index=False)
+
+    for id in id_list:
+        failed = {name: result for name, result in results[id].items() if isinstance(result, Exception)}
+        if failed:
+            print(f"{id}: " + ", ".join(f"{name}: {type(e).__name__}: {e}" for name, e in failed.items()))
+    for name, row in runner.summary().items():
+        print(f"{name:<10}{row['patients']:>6} patients  busy {row['busy_s']:>8.1f}s  span {row['span_s']:>8.1f}s")
+    print(f"makespan {elapsed:.1f}s")
+    telemetry.report()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args)
@@ -10,7 +10,8 @@ import random
 import pandas as pd
 
 # custom
-from utils import send_single_message
+from utils import send_structured_message, async_send_structured_message, gather_with_limit, run_async, worker_pool
+import telemetry
 from prompts.process_hp import HP_SYS
 
 random.seed(42)
@@ -37,14 +38,32 @@ def parse_args():
                         '--output', 
                         type=str, 
                         help="Output directory")
+    parser.add_argument('-e',
+                        '--engine',
+                        type=str,
+                        choices=["thread", "async"],
+                        help="Run LLM calls on a thread pool or the asyncio engine",
+                        default="thread")
     return parser.parse_args()
 
 def apply_hp_module(row):
-    row_copy = row.copy()
+    telemetry.current_patient.set(row['person_id'])
+    response = send_structured_message(system_instructions=HP_SYS,
+                                       user_prompt=str(row['text']),
+                                       family="hp",
+                                       stage="hp")
+    return merge_hp_response(row, response)
+
+async def async_apply_hp_module(row):
+    telemetry.current_patient.set(row['person_id'])
+    response = await async_send_structured_message(system_instructions=HP_SYS,
+                                                   user_prompt=str(row['text']),
+                                                   family="hp",
+                                                   stage="hp")
+    return merge_hp_response(row, response)
 
-    response = send_single_message(system_instructions=HP_SYS,
-                                   user_prompt=str(row['text']))
-    response = json.loads(response[7:-3])
+def merge_hp_response(row, response):
+    row_copy = row.copy()
     row_copy['reason_for_admission'] = response['reason_for_admission']
     row_copy['clinical_summary'] = response['clinical_summary']
     return row_copy
@@ -52,7 +71,7 @@ def apply_hp_module(row):
 def extract_hp(df, max_workers=25):
     ret = []
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+    with worker_pool(max_workers) as executor:
         futures = []
         for row_idx, row in df.iterrows():
             futures.append(
@@ -64,20 +83,35 @@ def extract_hp(df, max_workers=25):
     ret = pd.DataFrame(ret).sort_index()
     return ret
 
+async def async_extract_hp(df):
+    """
+    Async version of extract_hp
+    """
+    ret = await gather_with_limit([async_apply_hp_module(row) for row_idx, row in df.iterrows()])
+    ret = pd.DataFrame(ret).sort_index()
+    return ret
+
+
+def load_hp(input_dir, id):
+    """
+    Read the H&P note of one patient (as written by format_data)
+    """
+    hp_info = pd.read_json(f'{input_dir}/{id}_hp.json')
+    hp = hp_info[hp_info['type'] == 'Full Note'].text.item()
+    hp['person_id'] = id
+    return hp
+
 
 def main(args):
     id_list= args.id.split(',')
-    df = []
-
-    for index, id in enumerate(id_list):
-        hp_info = pd.read_json(f'{args.input}/{id}_hp.json')
-        hp = hp_info[hp_info['type'] == 'Full Note'].text.item()
-        hp['person_id'] = id
-        df.append(hp)
-    df = pd.DataFrame(df)
-    df = extract_hp(df)
+    df = pd.DataFrame([load_hp(args.input, id) for id in id_list])
+    if args.engine == "async":
+        df = run_async(async_extract_hp(df))
+    else:
+        df = extract_hp(df)
     df.to_csv(f'{args.output}/hp_combined.csv', index=False)
     print(df)
+    telemetry.report()
     
 if __name__ == '__main__':
     args = parse_args()
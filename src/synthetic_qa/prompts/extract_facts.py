@@ -70,6 +70,44 @@ def format_extract(note_date, text):
     }
     return json.dumps(note)
 
+EXTRACT_NOTES_SYS = EXTRACT_SYS + """
+    ## Multiple Notes
+    The input may contain several short notes instead of one. Extract the claims of every note separately,
+    resolve relative dates against that note's own note_date, and return the claims of each note under its note_id.
+    Return an entry for every note_id, with an empty "claims" list if the note has no valid claims.
+
+    Input Schema:
+    {
+        "notes": [
+            {
+                "note_id": str,
+                "note_date": str,
+                "text": str
+            }
+        ]
+    }
+
+    Output Schema:
+    {
+        "notes": [
+            {
+                "note_id": str,
+                "claims": List[str]
+            }
+        ]
+    }
+"""
+
+def format_extract_notes(notes):
+
+    input = {
+        "notes": [
+            {"note_id": note_id, "note_date": note_date, "text": text}
+            for note_id, note_date, text in notes
+        ]
+    }
+    return json.dumps(input)
+
 DEDUP_SYS="""
  ## Task Definition
 
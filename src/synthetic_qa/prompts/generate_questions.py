@@ -142,4 +142,27 @@ You have access to the full H&P note. Use the information in the note to ensure
 
 GENERATE_USER= """
 Generate three distinct complex retrieval questions that satisfy the constraints. The first must be "single-hop recent", the second "single-hop past", and the third "multi-hop". Do not generate questions about the patient's psychology, mental well being, or psychiatric care. Return only the JSON array in the specified schema and order: recent, past, multi-hop.
-"""
\ No newline at end of file
+"""
+CONDENSE_SYS = """
+## Task Definition
+You are a clinician preparing a chart review for a patient with a very long record. You are given the facts of one time period and one clinical category of the record. Select the facts that are most important for admitting the patient, so that the selection can be combined with the selections of the other periods and categories into one shorter fact list.
+
+## Instructions
+1. Select at most "max_facts" facts.
+2. Prefer facts that are clinically significant (diagnoses, procedures, abnormal results, medication changes, outcomes) over routine or repeated observations.
+3. Keep facts that describe the same event at different timepoints when they show a trend.
+4. Do not rewrite or merge facts; you only return their indices.
+
+## Output format
+Return only a JSON object: {"selected_fact_indices": [<index>, ...]}
+"""
+
+
+def format_condense(period, category, input_fact_list, max_facts):
+    input = {
+        "period": period,
+        "category": category,
+        "max_facts": max_facts,
+        "input_fact_list": input_fact_list,
+    }
+    return json.dumps(input)
@@ -12,26 +12,13 @@ PHASE1_DIR=""
 
 # format into comma separated list
 id_list=$(tail -n +2 $INPUT_FILE | cut -d',' -f2 | head -n 1 | paste -sd',' -)
-# pull data and format
-python format_data.py --id $id_list \
-    --prefix ${NOTES_DIR}
-
-# TODO: refactor all the flag names to be what they are
-# extract the reason for admission
-python process_hp.py --id ${id_list} \
-    --input ${NOTES_DIR} \
-    --output ${PHASE1_DIR}
-
-# extract the facts
-python extract_facts.py --id $id_list \
-    --input ${NOTES_DIR} \
-    --output ${FACTS_DIR}
-
-# run fact generation
-python generate_questions.py --id $id_list \
-    --input ${FACTS_DIR} \
-    --note ${NOTES_DIR} \
-    --output ${QUESTIONS_DIR}
+# pull data, extract the reason for admission, extract the facts and
+# generate questions; each patient moves on as soon as its previous stage is done
+python pipeline.py --id ${id_list} \
+    --notes ${NOTES_DIR} \
+    --facts ${FACTS_DIR} \
+    --questions ${QUESTIONS_DIR} \
+    --phase1 ${PHASE1_DIR}
 
 # prepare annotation files
 python sample_questions.py \
@@ -1,6 +1,7 @@
 # default
 import argparse
 import json
+import logging
 import ast
 import os
 import concurrent.futures
@@ -10,7 +11,10 @@ import random
 import pandas as pd
 
 # custom
-from utils import send_single_message
+from utils import send_structured_message, async_send_structured_message, gather_with_limit, run_async, ContextThreadPoolExecutor, build_single_message
+from batch import run_batch, BatchItemError
+from structured import parse_response, MalformedResponseError
+import telemetry
 from prompts.sample_questions import TOPIC_SYS, TOPIC_USER
 
 random.seed(42)
@@ -44,15 +48,55 @@ def parse_args():
                         '--output', 
                         type=str, 
                         help="Output directory")
+    parser.add_argument('-e',
+                        '--engine',
+                        type=str,
+                        choices=["thread", "async", "batch"],
+                        help="Run LLM calls on a thread pool, the asyncio engine or as batch jobs",
+                        default="thread")
     return parser.parse_args()
 
 
 def apply_topic_module(row):
-    row_copy = row.copy()
+    telemetry.current_patient.set(row['person_id'])
+    try:
+        response = send_structured_message(system_instructions=TOPIC_SYS,
+                                           user_prompt=TOPIC_USER.format(QUESTION = row['question'], ANSWER = row['answer']),
+                                           family="topic",
+                                           stage="topic")
+    except MalformedResponseError as e:
+        logging.warning(f"Failed to decode topic response for question {row.name}: {e}")
+        response = None
+    return merge_topic_response(row, response)
+
+async def async_apply_topic_module(row):
+    telemetry.current_patient.set(row['person_id'])
+    try:
+        response = await async_send_structured_message(system_instructions=TOPIC_SYS,
+                                                       user_prompt=TOPIC_USER.format(QUESTION = row['question'], ANSWER = row['answer']),
+                                                       family="topic",
+                                                       stage="topic")
+    except MalformedResponseError as e:
+        logging.warning(f"Failed to decode topic response for question {row.name}: {e}")
+        response = None
+    return merge_topic_response(row, response)
+
+def build_topic_request(row):
+    """
+    Request payload for apply_topic_module, for batch jobs
+    """
+    return build_single_message(user_prompt=TOPIC_USER.format(QUESTION = row['question'], ANSWER = row['answer']),
+                                system_instructions=TOPIC_SYS,
+                                family="topic")
 
-    response = send_single_message(system_instructions=TOPIC_SYS,
-                               user_prompt=TOPIC_USER.format(QUESTION = row['question'], ANSWER = row['answer']))
-    response = json.loads(response[7:-3])
+def merge_topic_response(row, response):
+    """
+    Add the topics to a question; they are left empty (NaN) when the response could not be used
+    """
+    row_copy = row.copy()
+    if response is None:
+        row_copy['topics'] = float("nan")
+        return row_copy
     row_copy['topics'] = ""
     for topic in [response['topic_1'], response['topic_2'], response['topic_3']]:
         if row_copy['topics'] == "":
@@ -65,7 +109,7 @@ def apply_topic_module(row):
 def extract_topics_from_notes(df, max_workers=25):
     ret = []
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+    with ContextThreadPoolExecutor(max_workers=max_workers) as executor:
         futures = []
         for row_idx, row in df.iterrows():
             futures.append(
@@ -77,6 +121,35 @@ def extract_topics_from_notes(df, max_workers=25):
     ret = pd.DataFrame(ret).sort_index()
     return ret
 
+async def async_extract_topics_from_notes(df):
+    """
+    Async version of extract_topics_from_notes
+    """
+    ret = await gather_with_limit([async_apply_topic_module(row) for row_idx, row in df.iterrows()])
+    ret = pd.DataFrame(ret).sort_index()
+    return ret
+
+
+def batch_extract_topics_from_notes(df):
+    """
+    Batch-job version of extract_topics_from_notes
+    """
+    results = run_batch({str(row_idx): build_topic_request(row) for row_idx, row in df.iterrows()},
+                        stage="topic", family="topic")
+    ret = []
+    for row_idx, row in df.iterrows():
+        try:
+            response = results[str(row_idx)]
+            if isinstance(response, BatchItemError):
+                raise response
+            response = parse_response(response, "topic")
+        except (BatchItemError, MalformedResponseError) as e:
+            logging.warning(f"Failed to get topic response for question {row_idx}: {e}")
+            response = None
+        ret.append(merge_topic_response(row, response))
+    ret = pd.DataFrame(ret).sort_index()
+    return ret
+
 
 def create_record(id, meta):
     return {"id": id, 
@@ -216,7 +289,12 @@ def main(args):
         # apply the type classification
         df = pd.concat(df+df_test).reset_index(drop=True)
         
-        df = extract_topics_from_notes(df)
+        if args.engine == "async":
+            df = run_async(async_extract_topics_from_notes(df))
+        elif args.engine == "batch":
+            df = batch_extract_topics_from_notes(df)
+        else:
+            df = extract_topics_from_notes(df)
         
 
         # append to meta
@@ -244,6 +322,7 @@ def main(args):
     for idx, annot in enumerate([annotator1, annotator2, annotator3, test]):
         print(annot.shape)
         write_json(annot, f'{args.output}/annotation_{idx}.json')
+    telemetry.report()
 
 
 
@@ -0,0 +1,284 @@
+"""
+Structured output for the LLM modules.
+
+Every prompt family has a response schema. It is sent as generationConfig
+responseMimeType/responseSchema (LLM_STRUCTURED_OUTPUT=0 leaves requests unconstrained)
+and used to check what comes back. Responses are parsed tolerantly: fenced or unfenced
+JSON with or without prose around it, and for a broken or cut-off array the items
+completed before the break are kept. Parts that do not match the schema are dropped
+and reported, so the caller can re-ask for just those parts (utils.structured_value)
+instead of re-sending the whole request.
+"""
+# default
+import copy
+import json
+import os
+import re
+
+STRUCTURED_OUTPUT = os.environ.get('LLM_STRUCTURED_OUTPUT', '1') == '1' # send responseSchema with the requests
+REPAIR_ATTEMPTS = int(os.environ.get('LLM_REPAIR_ATTEMPTS', 1)) # follow-up requests for missing/invalid parts
+FENCE_PATTERN = re.compile(r"```(?:json)?\s*(.*?)```", re.DOTALL)
+
+STRING_LIST = {"type": "ARRAY", "items": {"type": "STRING"}}
+SCHEMAS = {
+    "claims": {
+        "type": "OBJECT",
+        "properties": {"claims": STRING_LIST},
+        "required": ["claims"],
+    },
+    "notes": {
+        "type": "OBJECT",
+        "properties": {"notes": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {"note_id": {"type": "STRING"}, "claims": STRING_LIST},
+                "required": ["note_id", "claims"],
+            },
+        }},
+        "required": ["notes"],
+    },
+    "dedup": {
+        "type": "OBJECT",
+        "properties": {"redundant_fact_indices": {"type": "ARRAY", "items": {"type": "INTEGER"}}},
+        "required": ["redundant_fact_indices"],
+    },
+    "condense": {
+        "type": "OBJECT",
+        "properties": {"selected_fact_indices": {"type": "ARRAY", "items": {"type": "INTEGER"}}},
+        "required": ["selected_fact_indices"],
+    },
+    "questions": {
+        "type": "ARRAY",
+        "items": {
+            "type": "OBJECT",
+            "properties": {
+                "question_id": {"type": "INTEGER"},
+                "reference_timestamp": {"type": "STRING"},
+                "question_type": {"type": "STRING", "enum": ["single_hop_recent", "single_hop_past", "multi_hop"]},
+                "question": {"type": "STRING"},
+                "answer": {"type": "STRING"},
+                "fact_subset": STRING_LIST,
+                "clinical_relevance_rationale": {"type": "STRING"},
+            },
+            "required": ["question_type", "question", "answer", "fact_subset"],
+        },
+    },
+    "hp": {
+        "type": "OBJECT",
+        "properties": {"clinical_summary": {"type": "STRING"}, "reason_for_admission": {"type": "STRING"}},
+        "required": ["clinical_summary", "reason_for_admission"],
+    },
+    "filter": {
+        "type": "OBJECT",
+        "properties": {
+            "question-relevance": {"type": "STRING", "enum": ["Yes", "No, but for another visit", "No, never relevant"]},
+            "question-defined": {"type": "STRING", "enum": ["Yes", "No"]},
+            "question-rephrase": {"type": "STRING", "enum": ["Yes", "No"]},
+            "explanation": {"type": "STRING"},
+        },
+        "required": ["question-relevance", "question-defined", "question-rephrase", "explanation"],
+    },
+    "topic": {
+        "type": "OBJECT",
+        "properties": {"topic_1": {"type": "STRING"}, "topic_2": {"type": "STRING"}, "topic_3": {"type": "STRING"}},
+        "required": ["topic_1", "topic_2", "topic_3"],
+    },
+}
+# array whose complete items are kept from a broken response (None: the top-level array)
+ITEM_KEYS = {"claims": "claims", "notes": "notes", "dedup": "redundant_fact_indices",
+             "condense": "selected_fact_indices", "questions": None}
+
+REPAIR_USER = """Your previous response could not be used as is:
+{PROBLEMS}
+
+Return only JSON in the same output schema, containing {WHAT}. Do not repeat the parts that were valid."""
+
+
+class MalformedResponseError(ValueError):
+    """Raised when nothing usable could be parsed from a response"""
+
+
+def response_format(family):
+    """
+    generationConfig entries that constrain the output to the family's schema
+    """
+    if not STRUCTURED_OUTPUT or family is None:
+        return {}
+    return {"responseMimeType": "application/json", "responseSchema": SCHEMAS[family]}
+
+
+def extract_json(text):
+    """
+    Decode the JSON in a response: bare, inside a ```json fence, or surrounded by prose
+    """
+    text = text.strip()
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+    decoder = json.JSONDecoder()
+    candidates = [match.group(1).strip() for match in FENCE_PATTERN.finditer(text)] + [text]
+    for candidate in candidates:
+        for match in re.finditer(r"[\[{]", candidate):
+            try:
+                value, _ = decoder.raw_decode(candidate, match.start())
+                return value
+            except ValueError:
+                continue
+    raise MalformedResponseError(f"No JSON found in response: {text[:80]!r}")
+
+
+def check_schema(value, schema, path="response"):
+    """
+    Keep the parts of `value` that match `schema`. Array items with any problem are
+    dropped; objects keep their valid keys.
+
+    Returns:
+        (cleaned value or None, list of problems)
+    """
+    kind = schema["type"]
+    if kind == "OBJECT":
+        if not isinstance(value, dict):
+            return None, [f"{path} must be an object"]
+        clean, problems = {}, []
+        for key, sub_schema in schema["properties"].items():
+            if key not in value:
+                if key in schema.get("required", ()):
+                    problems.append(f'{path} is missing "{key}"')
+                continue
+            item, item_problems = check_schema(value[key], sub_schema, f'{path}["{key}"]')
+            problems.extend(item_problems)
+            if item is not None:
+                clean[key] = item
+        return clean, problems
+    if kind == "ARRAY":
+        if not isinstance(value, list):
+            return None, [f"{path} must be an array"]
+        clean, problems = [], []
+        for idx, item in enumerate(value):
+            item, item_problems = check_schema(item, schema["items"], f"{path}[{idx}]")
+            if item_problems or item is None:
+                problems.extend(item_problems)
+            else:
+                clean.append(item)
+        return clean, problems
+    if kind == "INTEGER":
+        if isinstance(value, str) and value.strip().isdigit():
+            value = int(value)
+        if isinstance(value, bool) or not isinstance(value, int):
+            return None, [f"{path} must be an integer"]
+        return value, []
+    if not isinstance(value, str):
+        return None, [f"{path} must be a string"]
+    if "enum" in schema and value not in schema["enum"]:
+        return None, [f"{path} must be one of {schema['enum']}"]
+    return value, []
+
+
+def salvage(text, family):
+    """
+    Complete array items from a response that is not valid JSON as a whole
+    """
+    from utils import JsonItemStream
+
+    if family not in ITEM_KEYS:
+        return None
+    items = JsonItemStream(ITEM_KEYS[family]).feed(text)
+    if not items:
+        return None
+    return items if ITEM_KEYS[family] is None else {ITEM_KEYS[family]: items}
+
+
+def parse_structured(text, family):
+    """
+    Parse a response against the family's schema, keeping whatever is valid
+
+    Returns:
+        (value or None if nothing was usable, list of problems)
+    """
+    try:
+        value, schema_problems = check_schema(extract_json(text), SCHEMAS[family])
+    except MalformedResponseError:
+        value, schema_problems = None, ["the response is not valid JSON"]
+    # a cut-off array decodes (if at all) as one of its inner objects; keep its complete items instead
+    if value is None or (family in ITEM_KEYS and not _has_items(value, family)):
+        salvaged = salvage(text, family)
+        if salvaged is not None:
+            kept = salvaged if ITEM_KEYS[family] is None else salvaged[ITEM_KEYS[family]]
+            value, schema_problems = check_schema(salvaged, SCHEMAS[family])
+            schema_problems = [f"the response is not valid JSON after the first {len(kept)} complete items; "
+                               "return the remaining items"] + schema_problems
+    return value, schema_problems
+
+
+def _has_items(value, family):
+    return value is not None and (ITEM_KEYS[family] is None or ITEM_KEYS[family] in value)
+
+
+def require_complete(value, family):
+    """
+    Raise unless the required top-level keys are present
+    """
+    schema = SCHEMAS[family]
+    if value is None:
+        raise MalformedResponseError(f"Unusable {family} response")
+    missing = [key for key in schema.get("required", ()) if key not in value] if schema["type"] == "OBJECT" else []
+    if missing:
+        raise MalformedResponseError(f"{family} response is missing {missing}")
+    return value
+
+
+def parse_response(text, family):
+    """
+    Tolerant parse without a follow-up request (e.g. for batch job results)
+    """
+    value, _ = parse_structured(text, family)
+    return require_complete(value, family)
+
+
+def repair_prompt(family, value, problems):
+    """
+    Follow-up user turn asking only for the parts that were missing or invalid
+    """
+    schema = SCHEMAS[family]
+    if value is None:
+        what = "the complete response"
+    elif schema["type"] == "OBJECT" and ITEM_KEYS.get(family) is None:
+        keys = [key for key in schema["properties"] if key not in value]
+        what = "only these keys: " + ", ".join(f'"{key}"' for key in keys)
+    else:
+        what = "only corrected versions of the invalid items and any items that were cut off"
+    return REPAIR_USER.format(PROBLEMS="\n".join(f"- {p}" for p in problems[:20]), WHAT=what)
+
+
+def repair_messages(messages, response, family, value, problems):
+    """
+    The original conversation followed by the response and the repair request
+    """
+    repair = copy.deepcopy(messages)
+    repair["contents"] = repair["contents"] + [
+        {"role": "model", "parts": [{"text": response}]},
+        {"role": "user", "parts": [{"text": repair_prompt(family, value, problems)}]},
+    ]
+    return repair
+
+
+def merge_repair(value, fix, family):
+    """
+    Combine the valid parts of a response with the valid parts of its repair:
+    arrays are concatenated, missing object keys are filled in
+    """
+    if fix is None:
+        return value
+    if value is None:
+        return fix
+    if isinstance(value, list):
+        return value + fix
+    merged = dict(value)
+    for key, item in fix.items():
+        if key not in merged:
+            merged[key] = item
+        elif isinstance(merged[key], list):
+            merged[key] = merged[key] + item
+    return merged
@@ -0,0 +1,252 @@
+"""
+Per-call LLM telemetry.
+
+Every get_question call produces one record (stage, patient id, prompt/response
+size, usageMetadata token counts, latency, attempts, cache hit, error). Records are
+appended to a JSONL file when LLM_TELEMETRY_PATH is set and folded into running
+totals per stage (and per stage and patient) as they arrive, so memory does not grow
+with the number of calls. The totals feed the end-of-run summary and the optional
+Prometheus textfile (LLM_TELEMETRY_PROM) for node_exporter.
+"""
+# default
+import contextvars
+import json
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+TELEMETRY_PATH = os.environ.get('LLM_TELEMETRY_PATH', '') # JSONL sink, empty disables
+PROM_PATH = os.environ.get('LLM_TELEMETRY_PROM', '') # Prometheus textfile, empty disables
+PRICE_INPUT_PER_M = float(os.environ.get('LLM_PRICE_INPUT_PER_M', 1.25)) # USD per 1M input tokens
+PRICE_CACHED_PER_M = float(os.environ.get('LLM_PRICE_CACHED_PER_M', 0.31)) # USD per 1M input tokens served from a context cache
+PRICE_OUTPUT_PER_M = float(os.environ.get('LLM_PRICE_OUTPUT_PER_M', 10.0)) # USD per 1M output (+thinking) tokens
+LATENCY_SAMPLES = int(os.environ.get('LLM_TELEMETRY_SAMPLES', 4096)) # latencies kept per stage (and patient) for the percentiles
+
+# patient the current task works on; copied into worker threads by ContextThreadPoolExecutor
+current_patient = contextvars.ContextVar("current_patient", default=None)
+
+_stages = {} # stage -> StageStats
+_patients = {} # patient id -> {stage -> StageStats}
+_calls = 0
+_sampler = random.Random(0)
+_lock = threading.Lock()
+_sink = None
+
+
+@contextmanager
+def patient_context(patient_id):
+    """
+    Attribute every LLM call made inside the block to `patient_id`
+    """
+    token = current_patient.set(patient_id)
+    try:
+        yield
+    finally:
+        current_patient.reset(token)
+
+
+def call_cost(record):
+    output_tokens = record.get("output_tokens", 0) + record.get("thinking_tokens", 0)
+    # promptTokenCount includes the cached prefix
+    cached_tokens = record.get("cached_tokens", 0)
+    return ((record.get("input_tokens", 0) - cached_tokens) * PRICE_INPUT_PER_M
+            + cached_tokens * PRICE_CACHED_PER_M
+            + output_tokens * PRICE_OUTPUT_PER_M) / 1e6
+
+
+def record_usage(record, usage):
+    """
+    Copy usageMetadata token counts into a call record
+    """
+    record["input_tokens"] = usage.get("promptTokenCount", 0)
+    record["output_tokens"] = usage.get("candidatesTokenCount", 0)
+    record["thinking_tokens"] = usage.get("thoughtsTokenCount", 0)
+    record["cached_tokens"] = usage.get("cachedContentTokenCount", 0)
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of an already sorted list"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(round(q * len(values))) - 1))]
+
+
+class StageStats:
+    """
+    Running totals of the calls of one stage. Latencies are kept as a uniform sample of
+    at most LATENCY_SAMPLES values (reservoir sampling), which the percentiles are read from.
+    """
+
+    def __init__(self):
+        self.calls = self.cache_hits = self.errors = self.retries = 0
+        self.prompt_chars = self.response_chars = 0
+        self.input_tokens = self.cached_tokens = self.output_tokens = 0
+        self.latency_total = self.cost = 0.0
+        self.latencies = []
+
+    def add(self, record):
+        self.calls += 1
+        self.errors += bool(record["error"])
+        self.retries += max(0, record["attempts"] - 1)
+        self.prompt_chars += record["prompt_chars"]
+        self.response_chars += record.get("response_chars", 0)
+        if record["cache_hit"]:
+            self.cache_hits += 1
+            return
+        self.input_tokens += record.get("input_tokens", 0)
+        self.cached_tokens += record.get("cached_tokens", 0)
+        self.output_tokens += record.get("output_tokens", 0) + record.get("thinking_tokens", 0)
+        self.cost += record["cost"]
+        self.latency_total += record["latency"]
+        sent = self.calls - self.cache_hits
+        if len(self.latencies) < LATENCY_SAMPLES:
+            self.latencies.append(record["latency"])
+        else:
+            slot = _sampler.randrange(sent)
+            if slot < LATENCY_SAMPLES:
+                self.latencies[slot] = record["latency"]
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        return {
+            "calls": self.calls,
+            "cache_hits": self.cache_hits,
+            "errors": self.errors,
+            "retries": self.retries,
+            "prompt_chars": self.prompt_chars,
+            "response_chars": self.response_chars,
+            "input_tokens": self.input_tokens,
+            "cached_tokens": self.cached_tokens,
+            "output_tokens": self.output_tokens,
+            "latency_total": self.latency_total,
+            "latency_p50": percentile(latencies, 0.50),
+            "latency_p90": percentile(latencies, 0.90),
+            "latency_p99": percentile(latencies, 0.99),
+            "cost": self.cost,
+        }
+
+
+def emit(record):
+    global _sink, _calls
+    record["cost"] = call_cost(record)
+    with _lock:
+        _calls += 1
+        _stages.setdefault(record["stage"], StageStats()).add(record)
+        _patients.setdefault(record["patient_id"], {}).setdefault(record["stage"], StageStats()).add(record)
+        if TELEMETRY_PATH:
+            if _sink is None:
+                _sink = open(TELEMETRY_PATH, "a")
+            _sink.write(json.dumps(record) + "\n")
+            _sink.flush()
+
+
+@contextmanager
+def track_call(stage, prompt_chars):
+    """
+    Time one LLM call; the yielded dict is filled in by the caller and emitted on exit
+    """
+    record = {
+        "timestamp": time.time(),
+        "stage": stage,
+        "patient_id": current_patient.get(),
+        "prompt_chars": prompt_chars,
+        "response_chars": 0,
+        "attempts": 0,
+        "cache_hit": False,
+        "error": None,
+    }
+    start = time.monotonic()
+    try:
+        yield record
+    except BaseException as e:
+        record["error"] = type(e).__name__
+        raise
+    finally:
+        record["latency"] = time.monotonic() - start
+        emit(record)
+
+
+def call_count():
+    """Number of calls recorded in this run"""
+    return _calls
+
+
+def summarize(patient_id=None):
+    """
+    Per-stage summary of this run (optionally for one patient)
+    """
+    with _lock:
+        stages = _stages if patient_id is None else _patients.get(patient_id, {})
+        return {stage: stats.summary() for stage, stats in sorted(stages.items())}
+
+
+def format_summary(summary):
+    header = f"{'stage':<10}{'calls':>8}{'hits':>7}{'errors':>8}{'retries':>9}{'in_tok':>12}{'cached':>12}{'out_tok':>12}{'p50_s':>8}{'p90_s':>8}{'p99_s':>8}{'busy_s':>10}{'cost_$':>9}"
+    lines = [header]
+    for stage, s in summary.items():
+        lines.append(
+            f"{stage:<10}{s['calls']:>8}{s['cache_hits']:>7}{s['errors']:>8}{s['retries']:>9}"
+            f"{s['input_tokens']:>12}{s['cached_tokens']:>12}{s['output_tokens']:>12}{s['latency_p50']:>8.2f}{s['latency_p90']:>8.2f}"
+            f"{s['latency_p99']:>8.2f}{s['latency_total']:>10.1f}{s['cost']:>9.2f}"
+        )
+    return "\n".join(lines)
+
+
+def log_summary(patient_id=None):
+    """
+    Write the per-stage summary to the active log
+    """
+    summary = summarize(patient_id)
+    if summary:
+        logging.info(f"LLM telemetry{'' if patient_id is None else f' for {patient_id}'}:\n{format_summary(summary)}\n")
+    return summary
+
+
+def write_prometheus(path=PROM_PATH):
+    """
+    Export the run summary in the Prometheus textfile format (written atomically)
+    """
+    if not path:
+        return
+    metrics = [
+        ("llm_calls_total", "counter", "LLM calls", "calls"),
+        ("llm_cache_hits_total", "counter", "LLM calls served from the response cache", "cache_hits"),
+        ("llm_errors_total", "counter", "LLM calls that failed", "errors"),
+        ("llm_retries_total", "counter", "LLM request retries", "retries"),
+        ("llm_input_tokens_total", "counter", "Input tokens billed", "input_tokens"),
+        ("llm_cached_tokens_total", "counter", "Input tokens served from a context cache", "cached_tokens"),
+        ("llm_output_tokens_total", "counter", "Output and thinking tokens billed", "output_tokens"),
+        ("llm_latency_seconds_total", "counter", "Wall-clock seconds spent waiting on the endpoint", "latency_total"),
+        ("llm_cost_usd_total", "counter", "Estimated cost in USD", "cost"),
+    ]
+    summary = summarize()
+    lines = []
+    for name, kind, help_text, field in metrics:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for stage, s in summary.items():
+            lines.append(f'{name}{{stage="{stage}"}} {s[field]}')
+    lines.append("# HELP llm_latency_seconds LLM call latency")
+    lines.append("# TYPE llm_latency_seconds summary")
+    for stage, s in summary.items():
+        for q in ("50", "90", "99"):
+            lines.append(f'llm_latency_seconds{{stage="{stage}",quantile="0.{q}"}} {s[f"latency_p{q}"]}')
+
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as ofile:
+        ofile.write("\n".join(lines) + "\n")
+    os.replace(tmp, path)
+
+
+def report():
+    """
+    End-of-run report: print the summary and refresh the Prometheus textfile
+    """
+    summary = summarize()
+    if summary:
+        print(format_summary(summary))
+    write_prometheus()
+    return summary
@@ -0,0 +1,85 @@
+"""
+Timeline index over a patient's facts.
+
+Every fact ends with its date, "(YYYY-MM-DD)" (extract_facts.PATTERN), which the fact
+store keeps parsed as fact_date. FactTimeline sorts those dates once into a datetime64
+array, together with each fact's offset in the original list. A date range query ("the
+last 30 days before the reference", "older than a year") is then two binary searches.
+Undated facts are kept apart and are only returned when asked for.
+"""
+# pip
+import numpy as np
+import pandas as pd
+
+# custom
+from fact_store import fact_date
+
+
+def day(value):
+    """datetime64[D] of a date, timestamp or date string"""
+    return np.datetime64(pd.Timestamp(value).date(), "D")
+
+
+class FactTimeline:
+    def __init__(self, facts, dates=None):
+        """
+        Args:
+            facts (list): fact strings
+            dates (list): date of each fact (None parses the date stamp of the facts)
+        """
+        self.facts = [str(f) for f in facts]
+        if dates is None:
+            dates = [fact_date(f) for f in self.facts]
+        dates = pd.to_datetime(pd.Series(list(dates), dtype=object), format="ISO8601", errors="coerce").to_numpy().astype("datetime64[D]")
+        self.fact_dates = dates # per fact, in list order
+        dated = ~np.isnat(dates)
+        self.offsets = np.flatnonzero(dated)[np.argsort(dates[dated], kind="stable")] # fact offsets by date
+        self.dates = dates[self.offsets] # sorted
+        self.undated = np.flatnonzero(~dated)
+
+    @classmethod
+    def of(cls, facts):
+        """The timeline of a fact list (returned as is if it already is one)"""
+        return facts if isinstance(facts, cls) else cls(facts)
+
+    def __len__(self):
+        return len(self.facts)
+
+    def between(self, start=None, end=None):
+        """
+        Offsets of the facts dated in [start, end), oldest first (None leaves a side open)
+        """
+        lo = 0 if start is None else np.searchsorted(self.dates, day(start), side="left")
+        hi = len(self.dates) if end is None else np.searchsorted(self.dates, day(end), side="left")
+        return self.offsets[lo:hi]
+
+    def until(self, reference):
+        """Offsets of the facts dated on or before the reference day"""
+        return self.between(end=day(reference) + 1)
+
+    def last(self, reference, days):
+        """Offsets of the facts dated in the `days` days up to and including the reference day"""
+        return self.between(day(reference) - days + 1, day(reference) + 1)
+
+    def older_than(self, reference, days):
+        """Offsets of the facts dated more than `days` days before the reference day"""
+        return self.between(end=day(reference) - days)
+
+    def select(self, offsets, undated=False):
+        """Facts at `offsets`, followed by the undated facts if `undated`"""
+        if undated:
+            offsets = np.concatenate([offsets, self.undated])
+        return [self.facts[i] for i in offsets]
+
+    def subset(self, offsets, undated=False):
+        """Timeline of the facts at `offsets` (then the undated ones if `undated`), in that order"""
+        if undated:
+            offsets = np.concatenate([offsets, self.undated])
+        offsets = np.asarray(offsets, dtype=int)
+        return FactTimeline([self.facts[i] for i in offsets], self.fact_dates[offsets])
+
+    def span(self):
+        """(first, last) fact date, None for a timeline without dated facts"""
+        if not len(self.dates):
+            return None
+        return str(self.dates[0]), str(self.dates[-1])
@@ -5,14 +5,32 @@ import time
 # import random
 # import itertools
 import requests
+from requests.adapters import HTTPAdapter
 from typing import Union
+from email.utils import parsedate_to_datetime
 
 
 import os
+import asyncio
+import concurrent.futures
+import contextvars
+import codecs
+import gzip
+import hashlib
+import logging
+import random
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+import telemetry
+from structured import (SCHEMAS, REPAIR_ATTEMPTS, response_format, parse_structured, check_schema,
+                        require_complete, repair_messages, merge_repair)
 
 my_key = os.environ['SECURE_GPT_KEY']
 
-url = "URL_TO_GEMINI"
+url = os.environ.get('GEMINI_URL', "URL_TO_GEMINI") # e.g. the local mock_server.py
 
 # Common headers
 headers = {
@@ -20,53 +38,1125 @@ headers = {
     "Content-Type": "application/json",
 }
 
-def post_with_retry(url, headers, payload, timeout=300, max_retries=8, backoff_factor=1.4):
+POOL_MAXSIZE = int(os.environ.get('LLM_POOL_MAXSIZE', 0)) # keep-alive connections, 0 sizes the pool to the open worker threads
+MIN_POOL_SIZE = 10 # urllib3's default pool size
+GZIP_REQUESTS = os.environ.get('LLM_GZIP_REQUESTS', '0') == '1' # gzip request bodies (the endpoint must accept Content-Encoding: gzip)
+GZIP_MIN_BYTES = 1024 # only compress payloads larger than this
+STREAM_RESPONSES = os.environ.get('LLM_STREAM', '0') == '1' # always read responses incrementally
+ASYNC_CONCURRENCY = int(os.environ.get('LLM_ASYNC_CONCURRENCY', 256)) # requests in flight on the async engine
+
+_session = None
+_session_lock = threading.Lock()
+_pool_size = 0 # connections of the current session's adapter
+_open_workers = 0 # threads of the worker pools currently open
+
+def pool_size():
+    """Connections the session should hold: LLM_POOL_MAXSIZE, else one per open worker thread"""
+    return POOL_MAXSIZE or max(MIN_POOL_SIZE, _open_workers)
+
+def new_session(size):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=size, pool_block=True)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({
+        "Accept-Encoding": "gzip, deflate",
+        "Connection": "keep-alive",
+    })
+    return session
+
+def reserve_connections(workers):
+    """
+    Account for the threads of a new worker pool (ContextThreadPoolExecutor). When they
+    outnumber the connections, a larger session replaces the shared one; the live session
+    is never re-mounted, since other threads may be looking up its adapters. Requests in
+    flight on the old session finish, their connections are closed when released.
+    """
+    global _session, _open_workers, _pool_size
+    with _session_lock:
+        _open_workers += workers
+        if _session is not None and pool_size() > _pool_size:
+            old = _session
+            _pool_size = pool_size()
+            _session = new_session(_pool_size)
+            old.close()
+
+def release_connections(workers):
+    global _open_workers
+    with _session_lock:
+        _open_workers -= workers
+
+def get_session():
+    """
+    Return the process-wide HTTP session shared by all worker threads.
+
+    The underlying urllib3 pool is thread-safe, keeps connections alive between calls
+    and blocks instead of opening throwaway connections when every slot is busy.
+    """
+    global _session, _pool_size
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _pool_size = pool_size()
+                _session = new_session(_pool_size)
+    return _session
+
+def compress_payload(payload, headers):
+    """
+    Gzip large request bodies and add the matching Content-Encoding header
+    """
+    if not GZIP_REQUESTS or len(payload) < GZIP_MIN_BYTES:
+        return payload, headers
+    if isinstance(payload, str):
+        payload = payload.encode("utf-8")
+    return gzip.compress(payload, compresslevel=5), {**headers, "Content-Encoding": "gzip"}
+
+CACHE_MODE = os.environ.get('LLM_CACHE_MODE', 'off') # off | readwrite | replay (read-only, misses raise); responses hold patient data
+CACHE_PATH = os.environ.get('LLM_CACHE_PATH', os.path.expanduser('~/.cache/synthetic_qa/responses.sqlite'))
+CACHE_MAX_BYTES = int(float(os.environ.get('LLM_CACHE_MAX_MB', 2048)) * 1024 ** 2) # evict least recently used above this
+
+
+class CacheMissError(RuntimeError):
+    """Raised in replay mode when a request is not in the response cache"""
+
+
+class ResponseCache:
+    """
+    Content-addressed on-disk cache of LLM responses backed by SQLite.
+
+    Entries are keyed by a hash of the full request payload (system instruction,
+    contents and generationConfig), so only calls whose payload changed are re-sent.
+    Total size is capped with least-recently-used eviction. In replay mode the
+    database is opened read-only and nothing is written.
+    """
+
+    def __init__(self, path=CACHE_PATH, max_bytes=CACHE_MAX_BYTES, mode=CACHE_MODE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.mode = mode
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        if mode == "replay":
+            self._conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+                "size INTEGER NOT NULL, last_access REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON responses (last_access)")
+            self._conn.commit()
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def key(messages):
+        """Hash the canonical JSON form of a request payload"""
+        canonical = json.dumps(messages, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if self.mode != "replay":
+                self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+                self._conn.commit()
+            return row[0]
+
+    def put(self, key, response):
+        if self.mode == "replay":
+            return
+        size = len(response.encode("utf-8"))
+        with self._lock:
+            old = self._conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, response, size, time.time()),
+            )
+            self._total_bytes += size - (old[0] if old else 0)
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        """Drop least recently used entries until the cache fits in max_bytes"""
+        if self._total_bytes <= self.max_bytes:
+            return
+        for key, size in self._conn.execute(
+            "SELECT key, size FROM responses ORDER BY last_access ASC"
+        ).fetchall():
+            if self._total_bytes <= self.max_bytes:
+                break
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._total_bytes -= size
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "bytes": self._total_bytes,
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    """
+    Return the process-wide response cache, or None when LLM_CACHE_MODE=off
+    """
+    global _cache
+    if CACHE_MODE == "off":
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResponseCache()
+                logging.info(f"LLM response cache ({CACHE_MODE}) at {_cache.path}")
+    return _cache
+
+RATE_LIMIT_RPM = float(os.environ.get('LLM_RATE_LIMIT_RPM', 600)) # requests/min ceiling, 0 disables limiting
+RATE_LIMIT_TPM = float(os.environ.get('LLM_RATE_LIMIT_TPM', 4_000_000)) # input tokens/min ceiling
+RATE_BURST_SECONDS = 5 # bucket capacity, in seconds of traffic at the current rate
+
+
+def estimate_tokens(text):
+    """
+    Rough token count for Gemini (~4 characters per token)
+    """
+    return len(text) // 4 + 1
+
+
+class RateLimiter:
     """
-    Send POST request with retries and exponential backoff.
+    Process-wide token bucket shared by every LLM call, with AIMD rate adaptation.
+
+    Two buckets (requests/min and input tokens/min) refill at `scale` times the
+    configured ceilings. A 429 halves `scale` for everyone at once (at most once per
+    cooldown, since concurrent calls tend to get throttled together), a latency spike
+    shrinks it gently, and every success adds back a small additive step.
+    Callers reserve capacity up front and sleep off any deficit, so waiters are
+    served in arrival order.
+    """
+
+    def __init__(self, requests_per_min=RATE_LIMIT_RPM, tokens_per_min=RATE_LIMIT_TPM,
+                 min_scale=0.05, increase_step=0.02, decrease_factor=0.5,
+                 latency_spike=4.0, latency_decrease=0.9, cooldown=2.0):
+        self.requests_per_sec = requests_per_min / 60
+        self.tokens_per_sec = tokens_per_min / 60
+        self.min_scale = min_scale
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.latency_spike = latency_spike
+        self.latency_decrease = latency_decrease
+        self.cooldown = cooldown
+
+        self.scale = 1.0
+        self.throttled = 0
+        self.latency_ewma = None
+        self._samples = 0
+        self._last_decrease = 0.0
+        self._last_refill = time.monotonic()
+        self._request_balance = self.requests_per_sec * RATE_BURST_SECONDS
+        self._token_balance = self.tokens_per_sec * RATE_BURST_SECONDS
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._request_balance = min(self._request_balance + elapsed * self.requests_per_sec * self.scale,
+                                    self.requests_per_sec * self.scale * RATE_BURST_SECONDS)
+        self._token_balance = min(self._token_balance + elapsed * self.tokens_per_sec * self.scale,
+                                  self.tokens_per_sec * self.scale * RATE_BURST_SECONDS)
+
+    def reserve(self, tokens=0):
+        """
+        Take one request and `tokens` tokens from the buckets.
+
+        Returns:
+            seconds the caller must wait before sending
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            self._request_balance -= 1
+            self._token_balance -= tokens
+            return max(0.0,
+                       -self._request_balance / (self.requests_per_sec * self.scale),
+                       -self._token_balance / (self.tokens_per_sec * self.scale))
+
+    def acquire(self, tokens=0):
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def async_acquire(self, tokens=0):
+        wait = self.reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def _decrease(self, factor):
+        now = time.monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        self.scale = max(self.min_scale, self.scale * factor)
+        # drop any accumulated burst so the lower rate applies immediately
+        self._request_balance = min(self._request_balance, 0.0)
+        self._token_balance = min(self._token_balance, 0.0)
+
+    def record_throttle(self):
+        """Multiplicative decrease after a 429"""
+        with self._lock:
+            self.throttled += 1
+            self._decrease(self.decrease_factor)
+
+    def record_success(self, latency):
+        """Additive increase, or a gentle decrease if latency spiked well above its average"""
+        with self._lock:
+            self._samples += 1
+            if self.latency_ewma is None:
+                self.latency_ewma = latency
+            spike = self._samples > 20 and latency > self.latency_spike * self.latency_ewma
+            self.latency_ewma = 0.9 * self.latency_ewma + 0.1 * latency
+            if spike:
+                self._decrease(self.latency_decrease)
+            else:
+                self.scale = min(1.0, self.scale + self.increase_step)
+
+
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+
+def get_rate_limiter():
+    """
+    Return the process-wide rate limiter, or None when LLM_RATE_LIMIT_RPM=0
+    """
+    global _rate_limiter
+    if RATE_LIMIT_RPM <= 0:
+        return None
+    if _rate_limiter is None:
+        with _rate_limiter_lock:
+            if _rate_limiter is None:
+                _rate_limiter = RateLimiter()
+    return _rate_limiter
+
+
+class TruncatedResponseError(ValueError):
+    """Raised when a response stopped at the output token limit"""
+
+
+# finishReason of the last response read in this thread/task (None for cache hits)
+response_finish_reason = contextvars.ContextVar("response_finish_reason", default=None)
+
+def raise_if_truncated():
+    """
+    Raise TruncatedResponseError if the last response hit the output token limit
+    """
+    if response_finish_reason.get() == "MAX_TOKENS":
+        raise TruncatedResponseError("Response stopped at the output token limit")
+
+
+class AdaptiveSizer:
+    """
+    Input/output token budget for one kind of request.
+
+    Batch and chunk sizes are derived from the budget times `scale`. A truncated or
+    unparsable response halves `scale` (too much was asked in one call), every
+    success adds back a small step, the same AIMD scheme as RateLimiter.
+    """
+
+    def __init__(self, name, input_tokens, output_tokens, min_scale=1/16, increase_step=0.05):
+        self.name = name
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+        self.min_scale = min_scale
+        self.increase_step = increase_step
+        self.scale = 1.0
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    def input_budget(self):
+        return max(1, int(self.input_tokens * self.scale))
+
+    def output_budget(self):
+        return max(1, int(self.output_tokens * self.scale))
+
+    def fits(self, input_tokens, output_tokens=0):
+        return input_tokens <= self.input_budget() and output_tokens <= self.output_budget()
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.scale = max(self.min_scale, self.scale / 2)
+            logging.info(f"{self.name} batches shrunk to {self.scale:.3f} of the token budget")
+
+    def record_success(self):
+        with self._lock:
+            self.scale = min(1.0, self.scale + self.increase_step)
+
+
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504} # everything else in 4xx is fatal
+
+
+class LLMRequestError(RuntimeError):
+    """Raised when a request fails for good; `status` is the last HTTP status (None for network errors)"""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class CircuitOpenError(LLMRequestError):
+    """Raised without sending anything while the circuit breaker considers the endpoint down"""
+
+
+class RetryBudget:
+    """
+    Caps retries to a fraction of traffic: every request deposits `ratio` tokens
+    and every retry withdraws one, so a failing stage cannot multiply its load.
+    """
+
+    def __init__(self, ratio=0.2, reserve=20, cap=100):
+        self.ratio = ratio
+        self.cap = cap
+        self.balance = float(reserve)
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.balance = min(self.cap, self.balance + self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            if self.balance < 1:
+                return False
+            self.balance -= 1
+            return True
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive server/network failures and fails
+    fast for `reset_timeout` seconds, then lets a single probe through (half-open).
+    """
+
+    def __init__(self, failure_threshold=10, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if self._probing or time.monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError("Circuit open: LLM endpoint is failing, not sending request")
+            self._probing = True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._probing = False
+
+
+class RetryPolicy:
+    """
+    Retry policy for LLM requests: full-jitter exponential backoff, server hints
+    (Retry-After header or RetryInfo.retryDelay) take precedence, fatal 4xx are
+    raised immediately, and retries are drawn from a per-stage RetryBudget.
+    """
+
+    def __init__(self, max_attempts=8, base_delay=1.0, max_delay=60.0,
+                 retryable_status=RETRYABLE_STATUS, budget_ratio=0.2):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retryable_status = retryable_status
+        self.budget_ratio = budget_ratio
+        self._budgets = {}
+        self._lock = threading.Lock()
+
+    def is_retryable(self, status):
+        return status in self.retryable_status
+
+    def delay(self, attempt, retry_after=None):
+        if retry_after is not None:
+            # small jitter so hinted retries do not land together
+            return min(retry_after, self.max_delay) + random.uniform(0, self.base_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def budget(self, stage):
+        with self._lock:
+            if stage not in self._budgets:
+                self._budgets[stage] = RetryBudget(ratio=self.budget_ratio)
+            return self._budgets[stage]
+
+
+def parse_retry_after(response_headers, body=""):
+    """
+    Seconds to wait as hinted by the server, or None.
+    Understands Retry-After (seconds or HTTP date) and Google RetryInfo ("retryDelay": "30s").
+    """
+    value = response_headers.get("Retry-After")
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    match = re.search(r'"retryDelay"\s*:\s*"([\d.]+)s"', body or "")
+    if match:
+        return float(match.group(1))
+    return None
+
+
+retry_policy = RetryPolicy()
+circuit_breaker = CircuitBreaker()
+
+
+class RequestAttempts:
+    """
+    Retry bookkeeping shared by post_with_retry and async_post_with_retry: the circuit
+    breaker, the rate limiter, the per-stage retry budget and which outcomes are retried
+    (fatal 4xx are raised, retryable statuses and failed requests are retried)
+    """
+
+    def __init__(self, payload, policy=None, stage="default", stats=None, limited=True):
+        self.policy = policy or retry_policy
+        self.stage = stage
+        self.stats = stats
+        self.budget = self.policy.budget(stage)
+        self.budget.deposit()
+        self.limiter = get_rate_limiter() if limited else None
+        self.tokens = estimate_tokens(payload)
+        self.attempt = 0
+        self.last_error = None
+        self.retry_after = None
+        self.start = None
+
+    def begin(self):
+        """Start an attempt; raises CircuitOpenError while the endpoint is considered down"""
+        if self.stats is not None:
+            self.stats["attempts"] = self.attempt + 1
+        try:
+            circuit_breaker.before_call()
+        except CircuitOpenError as e:
+            raise e from self.last_error
+        self.retry_after = None
+
+    def sending(self):
+        """Called after the rate limiter let the request through"""
+        self.start = time.monotonic()
+
+    def answered(self, status, text, response_headers):
+        """
+        Judge an HTTP answer: True if it succeeded, raises LLMRequestError for a fatal
+        status, records a retryable one
+        """
+        if status < 500:
+            # the endpoint answered (4xx/429 included), which also resolves a half-open probe
+            circuit_breaker.record_success()
+        if status < 400:
+            if self.limiter is not None:
+                self.limiter.record_success(time.monotonic() - self.start)
+            return True
+        self.last_error = LLMRequestError(f"HTTP {status}: {text[:500]}", status=status)
+        if not self.policy.is_retryable(status):
+            raise self.last_error
+        record_retryable_status(status, self.limiter)
+        self.retry_after = parse_retry_after(response_headers, text)
+        return False
+
+    def failed(self, error):
+        """A request that got no usable answer (connection reset, timeout, broken body)"""
+        circuit_breaker.record_failure()
+        self.last_error = error
+
+    def next_delay(self):
+        """Seconds to wait before the next attempt, None when out of attempts or retry budget"""
+        self.attempt += 1
+        if self.attempt == self.policy.max_attempts or not self.budget.withdraw():
+            return None
+        return self.policy.delay(self.attempt - 1, self.retry_after)
+
+    def exhausted(self, method="POST"):
+        return LLMRequestError(f"{method} failed after {self.attempt} attempts (stage={self.stage})",
+                               status=getattr(self.last_error, "status", None))
+
+
+def post_with_retry(url, headers, payload, timeout=300, policy=None, stage="default", stream=False, stats=None,
+                    read=None):
+    """
+    Send POST request with retries over the shared keep-alive session.
 
     Args:
         url (str): endpoint URL
         headers (dict): request headers
         payload (dict/str): JSON or string payload
-        max_retries (int): maximum retry attempts
-        backoff_factor (float): multiplier for wait time between retries
+        timeout (int): per-attempt timeout in seconds
+        policy (RetryPolicy): defaults to the module-level retry_policy
+        stage (str): pipeline stage whose retry budget is charged
+        stream (bool): return before the body is downloaded (read it incrementally)
+        stats (dict): if given, "attempts" is kept up to date for telemetry
+        read (callable): reads the body of a successful response inside the retry loop,
+            so a connection lost while reading it is retried too
+
+    Returns:
+        requests.Response, or read(response) if `read` is given
+
+    Raises:
+        LLMRequestError: fatal status, retries or budget exhausted (chained to the last error)
+        CircuitOpenError: endpoint considered down
+    """
+    attempts = RequestAttempts(payload, policy, stage, stats)
+    payload, headers = compress_payload(payload, headers)
+    while True:
+        attempts.begin()
+        if attempts.limiter is not None:
+            attempts.limiter.acquire(attempts.tokens)
+        attempts.sending()
+        try:
+            response = get_session().post(url, headers=headers, data=payload, timeout=timeout, stream=stream)
+            if attempts.answered(response.status_code, "" if response.ok else response.text, response.headers):
+                return response if read is None else read(response)  # ✅ success
+        except LLMRequestError:
+            raise
+        except Exception as e:
+            attempts.failed(e)
+        delay = attempts.next_delay()
+        if delay is None:
+            raise attempts.exhausted() from attempts.last_error
+        time.sleep(delay)
+
+
+def get_with_retry(url, headers, timeout=300, policy=None, stage="default"):
+    """
+    Send GET request (job status, metadata) with the retries of post_with_retry. These
+    requests do not go through the rate limiter of the generate calls.
 
     Returns:
-        requests.Response
+        decoded JSON body of the successful response
     """
-    for attempt in range(max_retries):
+    attempts = RequestAttempts("", policy, stage, limited=False)
+    while True:
+        attempts.begin()
+        attempts.sending()
         try:
-            response = requests.post(url, headers=headers, data=payload, timeout=timeout)
-            if response.status_code == 429:  # rate limit
-                raise requests.exceptions.RequestException("Rate limit hit")
-            response.raise_for_status()
-            return response  # ✅ success
+            response = get_session().get(url, headers=headers, timeout=timeout)
+            if attempts.answered(response.status_code, "" if response.ok else response.text, response.headers):
+                return response.json()
+        except LLMRequestError:
+            raise
         except Exception as e:
-            sleep_time = backoff_factor ** attempt
-            time.sleep(sleep_time)
+            attempts.failed(e)
+        delay = attempts.next_delay()
+        if delay is None:
+            raise attempts.exhausted("GET") from attempts.last_error
+        time.sleep(delay)
+
+
+def record_retryable_status(status, limiter):
+    """
+    Feed a retryable HTTP failure to the rate limiter / circuit breaker
+    """
+    if status == 429:  # rate limit, the endpoint itself is up
+        if limiter is not None:
+            limiter.record_throttle()
+    else:
+        circuit_breaker.record_failure()
+
+
+class JsonItemStream:
+    """
+    Incremental JSON parser that returns each element of a JSON array as soon as it is complete.
+
+    The array is the first top-level array in the text or, with `key`, the array value
+    of that key (e.g. "claims"). Anything before it, such as a ```json fence, is skipped.
+    Consumed text is dropped so only the element being read is buffered.
+    """
+
+    def __init__(self, key=None):
+        self.key = key
+        self.done = False
+        self._pattern = re.compile(r'"%s"\s*:\s*\[' % re.escape(key)) if key is not None else None
+        self._buf = ""
+        self._pos = 0 # next character to scan
+        self._start = None # start of the current element, None until the array opens
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def _open_array(self):
+        if self._pattern is None:
+            idx = self._buf.find("[", self._pos)
+        else:
+            match = self._pattern.search(self._buf, self._pos)
+            idx = match.end() - 1 if match else -1
+        if idx < 0:
+            # keep a tail in case the key or bracket is split across fragments
+            self._pos = max(self._pos, len(self._buf) - len(self.key or "") - 16)
+            return False
+        self._pos = self._start = idx + 1
+        return True
+
+    def _emit(self, text, items):
+        text = text.strip()
+        if not text:
+            return
+        try:
+            items.append(json.loads(text))
+        except ValueError:
+            # leave malformed output to the caller's full parse
+            self.done = True
 
-    # if all retries fail, raise last exception
-    raise RuntimeError(f"POST failed after {max_retries} retries")
+    def feed(self, text):
+        """
+        Add a text fragment and return the array elements completed by it
+        """
+        items = []
+        if self.done:
+            return items
+        self._buf += text
+        if self._start is None and not self._open_array():
+            return items
 
+        buf = self._buf
+        i = self._pos
+        while i < len(buf) and not self.done:
+            c = buf[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+            elif c == '"':
+                self._in_string = True
+            elif c in "[{":
+                self._depth += 1
+            elif c in "]}":
+                if self._depth == 0: # end of the target array
+                    self._emit(buf[self._start:i], items)
+                    self.done = True
+                self._depth -= 1
+            elif c == "," and self._depth == 0:
+                self._emit(buf[self._start:i], items)
+                self._start = i + 1
+            i += 1
 
-def get_question(messages:str):
+        # drop everything before the element being read
+        self._buf = buf[self._start:]
+        self._pos = i - self._start
+        self._start = 0
+        return items
+
+
+def stream_response_chunks(response):
+    """
+    Yield each chunk of a streamed generateContent response (a JSON array) as it arrives
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    chunks = JsonItemStream()
+    for raw in response.iter_content(chunk_size=None):
+        for chunk in chunks.feed(decoder.decode(raw)):
+            yield chunk
+
+
+def read_streamed_content(response, on_item=None, item_key=None, meta=None):
     """
-    Helper function to send current conversation to API and get the API
+    Accumulate a streamed response, passing each completed element of the JSON array
+    in the model output (see JsonItemStream) to `on_item` along the way
     """
+    items = JsonItemStream(item_key) if on_item is not None else None
+    parts = []
+    for chunk in stream_response_chunks(response):
+        if meta is not None:
+            update_response_metadata(meta, chunk)
+        text = join_response_chunks([chunk])
+        parts.append(text)
+        if items is not None:
+            for item in items.feed(text):
+                on_item(item)
+    return "".join(parts)
+
 
-    response = post_with_retry(url=url, headers=headers, payload = json.dumps(messages))
-    response.raise_for_status()
+def check_cache(messages):
+    """
+    Look up a request in the response cache.
+
+    Returns:
+        (cache, key, cached response or None); cache is None when caching is off
+    """
+    cache = get_cache()
+    if cache is None:
+        return None, None, None
+    key = cache.key(messages)
+    cached = cache.get(key)
+    if cached is None and cache.mode == "replay":
+        raise CacheMissError(f"No cached response for request {key}")
+    return cache, key, cached
+
+
+def cacheable(content, finish_reason, family=None):
+    """
+    Whether a response is worth replaying: not empty, not cut off and, for a response
+    family, parsed against its schema without problems
+    """
+    if not content or finish_reason == "MAX_TOKENS":
+        return False
+    return family is None or not parse_structured(content, family)[1]
+
+
+def join_response_chunks(chunks):
+    """
+    Join the text parts of a streamed generateContent response (list of chunks)
+    """
     content = ""
-    for i in response.json():
+    for i in chunks:
         content += i['candidates'][0]['content']['parts'][0]['text']
     return content
 
 
-def send_single_message(user_prompt:str, 
-                        system_instructions: Union[str,None] = None):
+def update_response_metadata(meta, chunk):
+    """
+    Keep the latest usageMetadata and finishReason seen in the response chunks
+    """
+    if "usageMetadata" in chunk:
+        meta["usage"] = chunk["usageMetadata"]
+    finish_reason = (chunk.get("candidates") or [{}])[0].get("finishReason")
+    if finish_reason:
+        meta["finish_reason"] = finish_reason
+
+
+def record_response(call, content, meta):
+    response_finish_reason.set(meta.get("finish_reason"))
+    call["response_chars"] = len(content)
+    call["finish_reason"] = meta.get("finish_reason")
+    telemetry.record_usage(call, meta.get("usage", {}))
+
+
+class ContextThreadPoolExecutor(concurrent.futures.ThreadPoolExecutor):
+    """
+    ThreadPoolExecutor that runs each task in a copy of the submitter's context,
+    so context variables such as the current patient reach the worker threads.
+    Its threads are counted towards the HTTP connection pool size while it is open.
+    """
+
+    def __init__(self, max_workers=None, *args, **kwargs):
+        super().__init__(max_workers, *args, **kwargs)
+        self._reserved = self._max_workers
+        reserve_connections(self._reserved)
+
+    def submit(self, fn, *args, **kwargs):
+        return super().submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+    def shutdown(self, *args, **kwargs):
+        super().shutdown(*args, **kwargs)
+        reserved, self._reserved = self._reserved, 0
+        release_connections(reserved)
+
+
+# worker pool shared by every patient of a cohort run (see cohort.py); fan-outs submit to
+# it instead of starting their own pool so the tasks of concurrent patients interleave
+shared_pool = contextvars.ContextVar("shared_pool", default=None)
+
+
+class SharedWorkerPool(ContextThreadPoolExecutor):
+    """
+    Cohort-wide worker pool. Its tasks run without a shared pool set, so a fan-out
+    nested inside a task starts a private pool instead of waiting on its own workers
+    """
+
+    def submit(self, fn, *args, **kwargs):
+        return super().submit(self._run_task, fn, *args, **kwargs)
+
+    @staticmethod
+    def _run_task(fn, *args, **kwargs):
+        shared_pool.set(None)
+        return fn(*args, **kwargs)
+
+
+@contextmanager
+def worker_pool(max_workers):
+    """
+    Executor for one fan-out: the cohort's shared pool when running under the cohort
+    scheduler, otherwise a private pool of `max_workers` threads
+    """
+    pool = shared_pool.get()
+    if pool is not None:
+        yield pool
+    else:
+        with ContextThreadPoolExecutor(max_workers=max_workers) as executor:
+            yield executor
+
+
+# ---------------------------------------------------------------------------
+# Context caching: a large system instruction that is re-sent with many requests
+# (the generation prompt holding the fact list and H&P note, the extract/dedup
+# instructions) is registered once as a cachedContents resource; later requests
+# refer to it by name and the prefix is billed at the cached-token rate.
+# ---------------------------------------------------------------------------
+CONTEXT_CACHE = os.environ.get('LLM_CONTEXT_CACHE', '0') == '1' # register large system prompts as cachedContents
+CONTEXT_CACHE_URL = os.environ.get('GEMINI_CACHE_URL', '') # .../cachedContents, derived from GEMINI_URL when empty
+CONTEXT_CACHE_MODEL = os.environ.get('GEMINI_MODEL', 'models/gemini-2.5-pro')
+CONTEXT_CACHE_TTL = int(os.environ.get('LLM_CONTEXT_CACHE_TTL', 3600)) # seconds a registered prefix lives
+CONTEXT_CACHE_MIN_TOKENS = int(os.environ.get('LLM_CONTEXT_CACHE_MIN_TOKENS', 4096)) # API minimum, smaller prefixes are sent inline
+CONTEXT_CACHE_MARGIN = 60 # stop using a handle this many seconds before it expires
+STALE_CONTEXT_STATUS = {400, 403, 404} # returned for an expired or deleted cachedContent
+
+
+def context_cache_url(generate_url):
+    """
+    cachedContents endpoint next to the generate endpoint
+    """
+    if "/models/" in generate_url:
+        return generate_url.split("/models/")[0] + "/cachedContents"
+    return generate_url.rsplit("/", 1)[0] + "/cachedContents"
+
+
+class ContextCache:
+    """
+    Registry of system instructions registered as cachedContents.
+
+    Handles are kept per prefix (hash of the system instruction) with their expiry;
+    a prefix is registered on first use and re-registered once its TTL runs out.
+    Failed registrations are remembered for one TTL so the prefix is simply sent inline.
+    """
+
+    def __init__(self, cache_url=None, model=CONTEXT_CACHE_MODEL, ttl=CONTEXT_CACHE_TTL,
+                 min_tokens=CONTEXT_CACHE_MIN_TOKENS):
+        self.cache_url = cache_url or CONTEXT_CACHE_URL or context_cache_url(url)
+        self.model = model
+        self.ttl = ttl
+        self.min_tokens = min_tokens
+        self._entries = {} # prefix key -> (name or None, monotonic expiry)
+        self._key_locks = {}
+        self._lock = threading.Lock()
+        self.stats = {"registered": 0, "hits": 0, "expired": 0, "fallbacks": 0, "failed": 0}
+
+    @staticmethod
+    def prefix_key(system_instruction):
+        return hashlib.sha256(json.dumps(system_instruction, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def register(self, system_instruction):
+        """
+        Create a cachedContents entry for the system instruction.
+
+        Returns:
+            resource name, or None if the endpoint refused it
+        """
+        payload = {
+            "model": self.model,
+            "systemInstruction": system_instruction,
+            "ttl": f"{self.ttl}s",
+        }
+        try:
+            response = post_with_retry(self.cache_url, headers, json.dumps(payload), stage="cache")
+            return response.json()["name"]
+        except (LLMRequestError, KeyError, ValueError) as e:
+            logging.info(f"Context cache registration failed, sending prefix inline: {e}")
+            return None
+
+    def lookup(self, system_instruction):
+        """
+        Handle for the system instruction, registering it when needed (None = send inline)
+        """
+        if estimate_tokens(json.dumps(system_instruction)) < self.min_tokens:
+            return None
+        key = self.prefix_key(system_instruction)
+        with self._lock:
+            entry = self._entries.get(key)
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        if entry is not None and entry[1] > time.monotonic():
+            self._count("hits" if entry[0] else "failed")
+            return entry[0]
+
+        # one registration per prefix even if several threads need it at once
+        with key_lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self._count("hits" if entry[0] else "failed")
+                return entry[0]
+            if entry is not None and entry[0]:
+                self._count("expired")
+            name = self.register(system_instruction)
+            self._count("registered" if name else "failed")
+            with self._lock:
+                self._entries[key] = (name, time.monotonic() + max(self.ttl - CONTEXT_CACHE_MARGIN, 1))
+            return name
+
+    def invalidate(self, name):
+        """
+        Forget a handle the endpoint no longer knows; the next lookup re-registers
+        """
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if entry[0] == name:
+                    del self._entries[key]
+        self._count("fallbacks")
+
+    def apply(self, messages):
+        """
+        Swap the system instruction of a request for its cachedContent handle.
+
+        Returns:
+            (request to send, handle or None)
+        """
+        system_instruction = messages.get("system_instruction")
+        if system_instruction is None:
+            return messages, None
+        name = self.lookup(system_instruction)
+        if name is None:
+            return messages, None
+        request = {k: v for k, v in messages.items() if k != "system_instruction"}
+        request["cachedContent"] = name
+        return request, name
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+
+_context_cache = None
+_context_cache_lock = threading.Lock()
+
+def get_context_cache():
+    """
+    Return the process-wide context cache, or None when LLM_CONTEXT_CACHE is off
+    """
+    global _context_cache
+    if not CONTEXT_CACHE:
+        return None
+    if _context_cache is None:
+        with _context_cache_lock:
+            if _context_cache is None:
+                _context_cache = ContextCache()
+    return _context_cache
+
+
+def is_stale_context(error, handle):
+    return handle is not None and isinstance(error, LLMRequestError) and error.status in STALE_CONTEXT_STATUS
+
+
+def post_messages(messages, stage, call, on_item=None, item_key=None):
+    """
+    Send one generate request and read the full response text. The body is read inside
+    the retry loop; when a stream breaks off and is resent, the items already passed to
+    `on_item` are not passed again.
+    """
+    payload = json.dumps(messages)
+    meta = {}
+    passed = 0
+
+    def read_stream(response):
+        nonlocal passed
+        position = 0
+
+        def on_new_item(item):
+            nonlocal position, passed
+            position += 1
+            if position > passed:
+                passed = position
+                on_item(item)
+
+        meta.clear()
+        with response:
+            return read_streamed_content(response, on_new_item if on_item is not None else None, item_key, meta)
+
+    def read_json(response):
+        meta.clear()
+        chunks = response.json()
+        for chunk in chunks:
+            update_response_metadata(meta, chunk)
+        return join_response_chunks(chunks)
+
+    if on_item is not None or STREAM_RESPONSES:
+        content = post_with_retry(url=url, headers=headers, payload=payload, stage=stage, stream=True, stats=call,
+                                  read=read_stream)
+    else:
+        content = post_with_retry(url=url, headers=headers, payload=payload, stage=stage, stats=call, read=read_json)
+    record_response(call, content, meta)
+    return content
+
+
+def get_question(messages:str, stage:str = "default", on_item=None, item_key=None, cache_prefix=False, family=None):
+    """
+    Helper function to send current conversation to API and get the API.
+    Responses are served from the persistent cache when the same payload was sent before.
+    `stage` names the pipeline stage for retry budgeting and telemetry.
+
+    With `on_item`, the response is read as it streams in and every element of the
+    JSON array in the output (under `item_key`, or the top-level array) is passed to
+    `on_item` as soon as it is complete. The full text is returned either way.
+
+    With `cache_prefix`, the system instruction is sent as a context-cache handle
+    (see ContextCache); if the handle has expired the request is resent in full.
+
+    With `family`, a response is only cached if it parses against the family's schema,
+    so a broken response is asked for again on the next run instead of being replayed.
+    """
+    payload = json.dumps(messages)
+    response_finish_reason.set(None)
+    with telemetry.track_call(stage, len(payload)) as call:
+        cache, key, cached = check_cache(messages)
+        if cached is not None:
+            call["cache_hit"] = True
+            call["response_chars"] = len(cached)
+            if on_item is not None:
+                for item in JsonItemStream(item_key).feed(cached):
+                    on_item(item)
+            return cached
+
+        context_cache = get_context_cache() if cache_prefix else None
+        request, handle = context_cache.apply(messages) if context_cache else (messages, None)
+        try:
+            content = post_messages(request, stage, call, on_item, item_key)
+        except LLMRequestError as e:
+            if not is_stale_context(e, handle):
+                raise
+            context_cache.invalidate(handle)
+            content = post_messages(messages, stage, call, on_item, item_key)
+
+    # empty, truncated or unparsable responses are not worth replaying
+    if cache is not None and cacheable(content, response_finish_reason.get(), family):
+        cache.put(key, content)
+    return content
+
+
+def build_single_message(user_prompt:str,
+                         system_instructions: Union[str,None] = None,
+                         family: Union[str,None] = None):
+    """
+    Build the request payload for a single-turn conversation, constrained to the
+    response schema of `family` (see structured.SCHEMAS) if given
+    """
     messages = {
                 "generationConfig": {
                 "maxOutputTokens": 65535,
+                **response_format(family),
             },
             "contents" :[{
                 "role": "user",
@@ -82,7 +1172,232 @@ def send_single_message(user_prompt:str,
                                                 {"text": system_instructions}
                                             ]
                                         }
-    return get_question(messages)
+    return messages
+
+
+def send_single_message(user_prompt:str, 
+                        system_instructions: Union[str,None] = None,
+                        stage:str = "default",
+                        on_item=None,
+                        item_key=None,
+                        cache_prefix=False):
+    return get_question(build_single_message(user_prompt, system_instructions), stage=stage,
+                        on_item=on_item, item_key=item_key, cache_prefix=cache_prefix)
+
+
+def structured_value(messages, response, family, stage="default", cache_prefix=False):
+    """
+    Parse a response against the family's schema. Missing or invalid parts are asked
+    for again in a follow-up turn (up to REPAIR_ATTEMPTS times) and merged in, so only
+    the broken part of the output is paid for twice.
+    """
+    value, problems = parse_structured(response, family)
+    for _ in range(REPAIR_ATTEMPTS):
+        if not problems:
+            break
+        logging.info(f"Repairing {family} response ({len(problems)} problems): {problems[:3]}")
+        repair = get_question(repair_messages(messages, response, family, value, problems),
+                              stage=stage, cache_prefix=cache_prefix)
+        fix, _ = parse_structured(repair, family)
+        value = merge_repair(value, fix, family)
+        problems = [] if value is None else check_schema(value, SCHEMAS[family])[1]
+    return require_complete(value, family)
+
+
+def send_structured_message(user_prompt:str,
+                            system_instructions: Union[str,None] = None,
+                            family:str = None,
+                            stage:str = "default",
+                            on_item=None,
+                            item_key=None,
+                            cache_prefix=False,
+                            raise_truncated=False):
+    """
+    send_single_message constrained to the family's response schema; returns the parsed value.
+    With `raise_truncated` a response cut off at the token limit raises TruncatedResponseError
+    (for callers that retry on smaller inputs) instead of being repaired.
+    """
+    messages = build_single_message(user_prompt, system_instructions, family)
+    response = get_question(messages, stage=stage, on_item=on_item, item_key=item_key, cache_prefix=cache_prefix,
+                            family=family)
+    if raise_truncated:
+        raise_if_truncated()
+    return structured_value(messages, response, family, stage=stage, cache_prefix=cache_prefix)
+
+
+# ---------------------------------------------------------------------------
+# asyncio engine: same request/cache semantics as above, but a single event loop
+# keeps up to ASYNC_CONCURRENCY requests in flight instead of one OS thread each.
+# Requires the optional `aiohttp` dependency (pip install synthetic_qa[async]).
+# ---------------------------------------------------------------------------
+
+_async_sessions = {}
+
+async def get_async_session():
+    """
+    Return the keep-alive aiohttp session bound to the running event loop
+    """
+    import aiohttp
+
+    loop = asyncio.get_running_loop()
+    session = _async_sessions.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=ASYNC_CONCURRENCY, keepalive_timeout=60)
+        session = aiohttp.ClientSession(connector=connector,
+                                        headers={"Accept-Encoding": "gzip, deflate"})
+        _async_sessions[loop] = session
+    return session
+
+
+async def close_async_session():
+    session = _async_sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+
+def run_async(coro):
+    """
+    Run a coroutine from synchronous code and close its HTTP session afterwards
+    """
+    async def runner():
+        try:
+            return await coro
+        finally:
+            await close_async_session()
+    return asyncio.run(runner())
+
+
+async def gather_with_limit(coros, limit=ASYNC_CONCURRENCY, return_exceptions=False):
+    """
+    asyncio.gather with at most `limit` coroutines running at once. Results keep input order.
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def bounded(coro):
+        async with semaphore:
+            return await coro
+
+    return await asyncio.gather(*(bounded(c) for c in coros), return_exceptions=return_exceptions)
+
+
+async def async_post_with_retry(url, headers, payload, timeout=300, policy=None, stage="default", stats=None):
+    """
+    Async version of post_with_retry.
+
+    Returns:
+        decoded JSON body of the successful response
+    """
+    import aiohttp
+
+    attempts = RequestAttempts(payload, policy, stage, stats)
+    session = await get_async_session()
+    payload, headers = compress_payload(payload, headers)
+    while True:
+        attempts.begin()
+        if attempts.limiter is not None:
+            await attempts.limiter.async_acquire(attempts.tokens)
+        attempts.sending()
+        try:
+            async with session.post(url, headers=headers, data=payload,
+                                    timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                text = "" if response.ok else await response.text()
+                if attempts.answered(response.status, text, response.headers):
+                    return await response.json(content_type=None)
+        except LLMRequestError:
+            raise
+        except Exception as e:
+            attempts.failed(e)
+        delay = attempts.next_delay()
+        if delay is None:
+            raise attempts.exhausted() from attempts.last_error
+        await asyncio.sleep(delay)
+
+
+async def async_post_messages(messages, stage, call):
+    """
+    Async version of post_messages
+    """
+    body = await async_post_with_retry(url=url, headers=headers, payload=json.dumps(messages), stage=stage, stats=call)
+    meta = {}
+    for chunk in body:
+        update_response_metadata(meta, chunk)
+    content = join_response_chunks(body)
+    record_response(call, content, meta)
+    return content
+
+
+async def async_get_question(messages, stage="default", cache_prefix=False, family=None):
+    """
+    Async version of get_question
+    """
+    payload = json.dumps(messages)
+    response_finish_reason.set(None)
+    with telemetry.track_call(stage, len(payload)) as call:
+        # sqlite lookups block, keep them off the event loop
+        cache, key, cached = await asyncio.to_thread(check_cache, messages)
+        if cached is not None:
+            call["cache_hit"] = True
+            call["response_chars"] = len(cached)
+            return cached
+
+        context_cache = get_context_cache() if cache_prefix else None
+        if context_cache is not None:
+            # registration is a blocking request, keep it off the event loop
+            request, handle = await asyncio.to_thread(context_cache.apply, messages)
+        else:
+            request, handle = messages, None
+        try:
+            content = await async_post_messages(request, stage, call)
+        except LLMRequestError as e:
+            if not is_stale_context(e, handle):
+                raise
+            context_cache.invalidate(handle)
+            content = await async_post_messages(messages, stage, call)
+
+    if cache is not None and cacheable(content, response_finish_reason.get(), family):
+        await asyncio.to_thread(cache.put, key, content)
+    return content
+
+
+async def async_send_single_message(user_prompt:str,
+                                    system_instructions: Union[str,None] = None,
+                                    stage:str = "default",
+                                    cache_prefix=False):
+    return await async_get_question(build_single_message(user_prompt, system_instructions), stage=stage,
+                                    cache_prefix=cache_prefix)
+
+
+async def async_structured_value(messages, response, family, stage="default", cache_prefix=False):
+    """
+    Async version of structured_value
+    """
+    value, problems = parse_structured(response, family)
+    for _ in range(REPAIR_ATTEMPTS):
+        if not problems:
+            break
+        logging.info(f"Repairing {family} response ({len(problems)} problems): {problems[:3]}")
+        repair = await async_get_question(repair_messages(messages, response, family, value, problems),
+                                          stage=stage, cache_prefix=cache_prefix)
+        fix, _ = parse_structured(repair, family)
+        value = merge_repair(value, fix, family)
+        problems = [] if value is None else check_schema(value, SCHEMAS[family])[1]
+    return require_complete(value, family)
+
+
+async def async_send_structured_message(user_prompt:str,
+                                        system_instructions: Union[str,None] = None,
+                                        family:str = None,
+                                        stage:str = "default",
+                                        cache_prefix=False,
+                                        raise_truncated=False):
+    """
+    Async version of send_structured_message
+    """
+    messages = build_single_message(user_prompt, system_instructions, family)
+    response = await async_get_question(messages, stage=stage, cache_prefix=cache_prefix, family=family)
+    if raise_truncated:
+        raise_if_truncated()
+    return await async_structured_value(messages, response, family, stage=stage, cache_prefix=cache_prefix)
 
 def load_notes(path_to_file):
     """
@@ -105,3 +1420,28 @@ def load_notes(path_to_file):
     if notes_df is not None:
         notes_df['note_date'] = pd.to_datetime(notes_df['note_date'])
     return notes_df
+
+
+def iter_notes(path_to_file, block_size=1 << 16):
+    """
+    Description: read notes file one note at a time (same columns and note_date
+    parsing as load_notes) without holding the whole chart in memory
+
+    Yields:
+        pd.Series per note, named by its position in the file
+    """
+    suffix = path_to_file.lower().split('.')[-1]
+    if suffix == 'csv':
+        for chunk in pd.read_csv(path_to_file, chunksize=256):
+            chunk['note_date'] = pd.to_datetime(chunk['note_date'])
+            for _, row in chunk.iterrows():
+                yield row
+    elif suffix == 'json':
+        stream = JsonItemStream()
+        index = 0
+        with open(path_to_file) as ifile:
+            for block in iter(lambda: ifile.read(block_size), ""):
+                for record in stream.feed(block):
+                    record['note_date'] = pd.to_datetime(record['note_date'])
+                    yield pd.Series(record, name=index)
+                    index += 1